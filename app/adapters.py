@@ -0,0 +1,194 @@
+"""
+adapters.py - Database Adapter Interface
+
+This module defines the asynchronous interface LogicHandler uses to talk to a
+database adapter and a shim that exposes synchronous adapters through it.
+
+Classes:
+- ConsentLookup: Everything needed to check a consent of a user, returned by a single lookup.
+- AsyncDatabaseAdapter: Protocol of an asynchronous database adapter.
+- AsyncAdapterShim: Asynchronous wrapper around a synchronous database adapter.
+
+Functions:
+- as_async_adapter(database_adapter): Return an asynchronous interface to any database adapter.
+- compose_lookup_user_consent(adapter, username, consent_name): Lookup for adapters without lookup_user_consent.
+
+"""
+import inspect
+from datetime import datetime, timedelta
+from typing import AsyncIterator, NamedTuple, Optional, Protocol
+from fastapi.concurrency import run_in_threadpool
+from .models import Consent, User
+
+
+class ConsentLookup(NamedTuple):
+    """
+    Result of looking up a consent of a user. granted_at is None if the user has not
+    given the consent and validity is None if the consent does not exist.
+    """
+
+    user_exists: bool
+    consent_exists: bool
+    granted_at: Optional[datetime]
+    validity: Optional[timedelta]
+
+
+class AsyncDatabaseAdapter(Protocol):
+    """
+    Methods of an asynchronous database adapter. They behave the same as the
+    synchronous methods of DBMockup, but have to be awaited.
+    """
+
+    async def get_users(self) -> list[str]: ...
+
+    async def get_consents(self) -> dict[str, Consent]: ...
+
+    async def user_exists(self, username: str) -> bool: ...
+
+    async def consent_exists(self, consent_name: str) -> bool: ...
+
+    async def get_user_consents(self, username: str) -> User: ...
+
+    async def get_user_consents_bulk(self, usernames: list[str]) -> dict[str, User]: ...
+
+    async def user_has_consent(self, username: str, consent_name: str) -> bool: ...
+
+    async def user_has_valid_consent(self, username: str, consent_name: str) -> bool: ...
+
+    async def lookup_user_consent(self, username: str, consent_name: str) -> ConsentLookup: ...
+
+    # Optional, without them LogicHandler does not return ETags
+    async def get_user_version(self, username: str) -> Optional[str]: ...
+
+    async def get_consents_version(self) -> str: ...
+
+    async def get_expiring_user_consents(
+        self, consent_name: str, before: datetime, after: Optional[datetime] = None
+    ) -> list[tuple[str, datetime]]: ...
+
+    async def get_consent_stats(
+        self, now: datetime, include_expired: bool = False
+    ) -> tuple[dict[str, dict[str, int]], Optional[list[tuple[str, str]]]]: ...
+
+    async def get_consent_users(
+        self,
+        consent_name: str,
+        valid_only: bool = False,
+        after: Optional[tuple[datetime, str]] = None,
+        limit: int = 100,
+    ) -> list[tuple[str, datetime]]: ...
+
+    # Optional, without them expired grants are never archived
+    async def get_archived_user_consents(self, username: str) -> list[tuple[str, datetime]]: ...
+
+    async def get_archived_user_consents_bulk(
+        self, usernames: list[str]
+    ) -> dict[str, dict[str, datetime]]: ...
+
+    async def archive_expired_grants(self, before: datetime, limit: int = 1000) -> int: ...
+
+    # Optional, without it consents cannot be checked at past times
+    async def lookup_user_consents_at(
+        self, queries: list[tuple[str, str, datetime]]
+    ) -> list[ConsentLookup]: ...
+
+    def iter_users(
+        self, since: Optional[datetime] = None, batch_size: int = 1000
+    ) -> AsyncIterator[list[User]]: ...
+
+    async def add_consent(self, consent: Consent) -> None: ...
+
+    async def add_user(self, user: User) -> None: ...
+
+    async def bulk_write(
+        self,
+        consents: list[Consent] = (),
+        usernames: list[str] = (),
+        grants: list[tuple[str, str, datetime]] = (),
+    ) -> None: ...
+
+    async def add_user_consent(self, username: str, consent_name: str) -> None: ...
+
+    async def revoke_user_consent(self, username: str, consent_name: str) -> None: ...
+
+
+# Returned by next() when a wrapped generator is exhausted
+STOP = object()
+
+
+class AsyncAdapterShim:
+    """
+    Exposes the methods of a synchronous database adapter as coroutines and its
+    generators as asynchronous generators.
+
+    Adapters that keep data in memory are called directly, as handing the call to a
+    thread would cost more than the call itself. Adapters that do blocking I/O set
+    blocking_io = True and are called in the threadpool, so they do not block the
+    event loop. Adapters where only some methods block name them in
+    blocking_methods, and only those are called in the threadpool.
+    """
+
+    def __init__(self, database_adapter, offload=False, blocking_methods=frozenset()):
+        self.database_adapter = database_adapter
+        self.offload = offload
+        self.blocking_methods = blocking_methods
+
+    def __getattr__(self, name):
+        method = getattr(self.database_adapter, name)
+        if not callable(method):
+            return method
+        offload = self.offload or name in self.blocking_methods
+        if inspect.isgeneratorfunction(method):
+
+            async def call(*args, **kwargs):
+                iterator = method(*args, **kwargs)
+                while True:
+                    if offload:
+                        item = await run_in_threadpool(next, iterator, STOP)
+                    else:
+                        item = next(iterator, STOP)
+                    if item is STOP:
+                        return
+                    yield item
+
+        elif offload:
+
+            async def call(*args, **kwargs):
+                return await run_in_threadpool(method, *args, **kwargs)
+
+        else:
+
+            async def call(*args, **kwargs):
+                return method(*args, **kwargs)
+
+        # Cache the wrapper so __getattr__ is called only once per method
+        setattr(self, name, call)
+        return call
+
+
+def as_async_adapter(database_adapter) -> AsyncDatabaseAdapter:
+    """
+    Return database_adapter if it is already asynchronous, otherwise wrap it in AsyncAdapterShim.
+    """
+    if inspect.iscoroutinefunction(database_adapter.user_exists):
+        return database_adapter
+    return AsyncAdapterShim(
+        database_adapter,
+        offload=getattr(database_adapter, "blocking_io", False),
+        blocking_methods=getattr(database_adapter, "blocking_methods", frozenset()),
+    )
+
+
+async def compose_lookup_user_consent(adapter: AsyncDatabaseAdapter, username, consent_name):
+    """
+    Build a ConsentLookup from the other methods of an adapter that does not
+    implement lookup_user_consent itself.
+    """
+    user_exists = await adapter.user_exists(username)
+    consent_exists = await adapter.consent_exists(consent_name)
+    granted_at = validity = None
+    if consent_exists:
+        validity = (await adapter.get_consents())[consent_name].validity
+    if user_exists and await adapter.user_has_consent(username, consent_name):
+        granted_at = (await adapter.get_user_consents(username)).consents[consent_name]
+    return ConsentLookup(user_exists, consent_exists, granted_at, validity)
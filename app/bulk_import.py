@@ -0,0 +1,162 @@
+"""
+bulk_import.py - Bulk Import
+
+This module parses consent definitions, users and grants from newline delimited
+JSON or CSV for bulk imports, and contains the command line entry point for them.
+
+Every record has a type and the fields of that type:
+- consent: consent_name, validity_seconds
+- user: username
+- grant: username, consent_name, granted_at (ISO 8601 time of granting)
+
+In CSV the first line is a header naming the columns, for example
+type,username,consent_name,validity_seconds,granted_at. Every CSV record has to
+be on a single line.
+
+Rows of consent audits are read the same way and have no type, only username,
+consent_name and at (ISO 8601 time at which the consent is checked).
+
+Functions:
+- parse_lines(lines, format, parse): Parse an asynchronous iterator of lines into records.
+- iter_lines(chunks): Split an asynchronous iterator of byte chunks into lines.
+- main(): Import a file into a database from the command line.
+
+"""
+import argparse
+import asyncio
+import csv
+import json
+from datetime import datetime, timedelta
+from .models import Consent
+
+FORMATS = ("ndjson", "csv")
+
+
+def parse_time(value, field: str):
+    """Parse an ISO 8601 time into naive local time, which is how grant times are stored"""
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} should be an ISO 8601 time")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+
+def parse_record(fields: dict):
+    """
+    Convert fields of one record to ("consent", Consent), ("user", username) or
+    ("grant", (username, consent_name, granted_at)). Raises ValueError with a
+    description of the problem for invalid records.
+    """
+    record_type = fields.get("type")
+    if record_type == "consent":
+        consent_name = fields.get("consent_name")
+        if not consent_name or not str(consent_name).replace("_", "").isalnum():
+            raise ValueError(
+                "Invalid consent name. It should include only alphanumeric characters and _"
+            )
+        try:
+            validity = timedelta(seconds=float(fields.get("validity_seconds")))
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError("validity_seconds should be a number")
+        return "consent", Consent(consent_name=consent_name, validity=validity)
+    if record_type == "user":
+        username = fields.get("username")
+        if not username or not isinstance(username, str):
+            raise ValueError("username is required")
+        return "user", username
+    if record_type == "grant":
+        username = fields.get("username")
+        consent_name = fields.get("consent_name")
+        if not username or not consent_name:
+            raise ValueError("username and consent_name are required")
+        granted_at = parse_time(fields.get("granted_at"), "granted_at")
+        return "grant", (str(username), str(consent_name), granted_at)
+    raise ValueError("type should be one of consent, user or grant")
+
+
+def parse_audit_row(fields: dict):
+    """
+    Convert fields of one audit row to (username, consent_name, at). Raises
+    ValueError with a description of the problem for invalid rows.
+    """
+    username = fields.get("username")
+    consent_name = fields.get("consent_name")
+    if not username or not consent_name:
+        raise ValueError("username and consent_name are required")
+    return str(username), str(consent_name), parse_time(fields.get("at"), "at")
+
+
+async def parse_lines(lines, format="ndjson", parse=parse_record):
+    """
+    Yield (row number, record or None, error or None) for every non empty line of
+    an asynchronous iterator of lines, with records converted by parse. Row numbers
+    start at 1 and count header and empty lines, so they match line numbers of the file.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"format should be one of {', '.join(FORMATS)}")
+    header = None
+    row = 0
+    async for line in lines:
+        row += 1
+        if not line.strip():
+            continue
+        try:
+            if format == "ndjson":
+                fields = json.loads(line)
+                if not isinstance(fields, dict):
+                    raise ValueError("Every line should be a JSON object")
+            else:
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = [name.strip() for name in values]
+                    continue
+                fields = {name: value for name, value in zip(header, values) if value != ""}
+            yield row, parse(fields), None
+        except ValueError as e:
+            yield row, None, str(e)
+
+
+async def iter_lines(chunks):
+    """Split an asynchronous iterator of UTF-8 encoded byte chunks into lines"""
+    rest = b""
+    async for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8", errors="replace")
+    if rest:
+        yield rest.decode("utf-8", errors="replace")
+
+
+async def iter_file_lines(file):
+    for line in file:
+        yield line
+
+
+def main():
+    """Import a file into an SQLite database"""
+    from .logic_handler import LogicHandler
+    from .sqlite_adapter import SQLiteAdapter
+
+    parser = argparse.ArgumentParser(
+        description="Import consents, users and grants into the consent database."
+    )
+    parser.add_argument("file", help="File with one record per line")
+    parser.add_argument("--format", choices=FORMATS, help="Defaults to the file extension")
+    parser.add_argument("--sqlite", default="consents.db", help="Path of the SQLite database")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="Records written at once")
+    args = parser.parse_args()
+
+    format = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+    logic_handler = LogicHandler(SQLiteAdapter(args.sqlite))
+    with open(args.file, encoding="utf-8", newline="") as file:
+        summary = asyncio.run(
+            logic_handler.import_records(iter_file_lines(file), format, args.chunk_size)
+        )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+change_feed.py - Change Feed
+
+This module keeps an ordered feed of consent changes for downstream systems, which
+can follow it over Server-Sent Events or long polling instead of polling the read
+endpoints.
+
+Every event has a sequence number, so a subscriber resumes after the last event it
+has seen. Subscribers read from one shared buffer at their own pace, a slow
+subscriber only falls behind and never holds up writers or other subscribers. The
+buffer keeps at least the latest capacity events. A subscriber that falls further behind is
+told with a reset that it missed events and has to resynchronize, for example
+with GET /export.
+
+Events are encoded once when they are published and shared by all subscribers.
+
+Classes:
+- ChangeFeed: Buffer of the latest events with their sequence numbers.
+
+"""
+import asyncio
+import json
+from datetime import datetime
+from typing import Optional
+
+GRANTED = "granted"
+REVOKED = "revoked"
+EXPIRED = "expired"
+CONSENT_CREATED = "consent_created"
+
+
+class ChangeFeed:
+    """
+    At least the latest capacity events in order of their sequence numbers, which start at 1.
+
+    Events are dicts with seq, type, time and the fields of their type, username and
+    consent_name for granted, revoked and expired, and consent_name and
+    validity_seconds for consent_created. Expired events have the time of expiry.
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        # Events and their SSE encoding, trimmed in halves so trimming is amortized O(1)
+        self.events = []
+        self.encoded = []
+        self.first_seq = 1
+        self.last_seq = 0
+        # Futures of subscribers waiting for the next event
+        self.waiters = set()
+        # Grants that expired before this time have been published
+        self.expired_until = datetime.now()
+
+    def publish(self, type: str, time: Optional[datetime] = None, **fields):
+        """Append an event and wake up waiting subscribers"""
+        self.last_seq += 1
+        event = {"seq": self.last_seq, "type": type, "time": (time or datetime.now()).isoformat()}
+        event.update(fields)
+        self.events.append(event)
+        self.encoded.append(
+            f"id: {self.last_seq}\nevent: {type}\ndata: {json.dumps(event)}\n\n".encode()
+        )
+        if len(self.events) >= 2 * self.capacity:
+            del self.events[: self.capacity]
+            del self.encoded[: self.capacity]
+            self.first_seq += self.capacity
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+    def _start(self, after: int):
+        """Index of the first event after the sequence number and whether events were missed"""
+        # Sequence numbers past the last event come from before a restart
+        if after + 1 < self.first_seq or after > self.last_seq:
+            return 0, True
+        return after + 1 - self.first_seq, False
+
+    def read(self, after: int, limit: int = 1000):
+        """
+        Returns up to limit events after the sequence number and True if events after
+        it were already dropped from the buffer or the sequence number is unknown, then
+        the oldest kept events are returned.
+        """
+        start, reset = self._start(after)
+        return self.events[start : start + limit], reset
+
+    def read_encoded(self, after: int, limit: int = 1000):
+        """
+        Same as read, but returns the events encoded as Server-Sent Events, followed
+        by the sequence number of the last returned event to resume after.
+        """
+        start, reset = self._start(after)
+        chunks = self.encoded[start : start + limit]
+        if chunks:
+            after = self.first_seq + start + len(chunks) - 1
+        elif reset:
+            after = self.first_seq - 1
+        return chunks, reset, after
+
+    async def wait(self, after: int, timeout: Optional[float] = None):
+        """Wait until there are events after the sequence number, return False on timeout"""
+        if self.last_seq > after:
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiters.discard(waiter)
+        return True
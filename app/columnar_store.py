@@ -0,0 +1,313 @@
+"""
+columnar_store.py - Compact In-Memory Data Persistence
+
+This module handles data persistence in memory using packed arrays instead of
+one model object per user.
+
+Classes:
+- ColumnarDB: In-memory database with the same methods as DBMockup, storing grants in columns.
+
+"""
+import heapq
+from array import array
+from datetime import datetime
+from .adapters import ConsentLookup
+from .database_mockup import MICROSECOND, DBMockup, from_micros, to_micros, valid_since_micros
+from .models import Consent, User
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, without it statistics are computed in pure Python
+    numpy = None
+
+# Value of a column for users that have not granted the consent
+NOT_GRANTED = -(2**63)
+
+
+class ColumnarDB:
+    """
+    In-memory database for storing consents and user data in packed columns.
+
+    Usernames are mapped to integer ids and consent names are interned to integer
+    ids. Every consent has one array('q') column indexed by user id, holding the time
+    of granting in microseconds since the epoch or NOT_GRANTED. A grant therefore
+    takes 8 bytes and no Python objects, and User and Consent models are only
+    created when they are returned. One more column holds the time of the last
+    change of every user for incremental exports.
+    """
+
+    def __init__(self, create_sample_data=False):
+        self.user_ids = {}
+        self.usernames = []
+        self.consent_ids = {}
+        self.consent_names = []
+        # Validity in microseconds per consent id, None for consents that were
+        # granted by a user but are not registered
+        self.validities = []
+        self.columns = []
+        # Time of the last change of the consents of every user id in microseconds
+        self.changed_at = array("q")
+        if create_sample_data:
+            self.initialize_data()
+
+    def initialize_data(self):
+        """Fill the database with the same sample data as DBMockup"""
+        DBMockup.initialize_data(self)
+
+    def _intern_consent(self, consent_name):
+        consent_id = self.consent_ids.get(consent_name)
+        if consent_id is None:
+            consent_id = len(self.consent_names)
+            self.consent_ids[consent_name] = consent_id
+            self.consent_names.append(consent_name)
+            self.validities.append(None)
+            self.columns.append(array("q", [NOT_GRANTED]) * len(self.usernames))
+        return consent_id
+
+    def _materialize_user(self, user_id):
+        consents = {}
+        for consent_id, column in enumerate(self.columns):
+            granted_at = column[user_id]
+            if granted_at != NOT_GRANTED:
+                consents[self.consent_names[consent_id]] = from_micros(granted_at)
+        return User.model_construct(username=self.usernames[user_id], consents=consents)
+
+    def _granted_at(self, username, consent_name):
+        """Time of granting in microseconds or NOT_GRANTED, raises KeyError for unknown users"""
+        user_id = self.user_ids[username]
+        consent_id = self.consent_ids.get(consent_name)
+        if consent_id is None:
+            return NOT_GRANTED
+        return self.columns[consent_id][user_id]
+
+    def _validity(self, consent_name):
+        """Validity in microseconds, raises KeyError for unknown consents"""
+        consent_id = self.consent_ids[consent_name]
+        validity = self.validities[consent_id]
+        if validity is None:
+            raise KeyError(consent_name)
+        return consent_id, validity
+
+    def get_users(self):
+        "Get all users in the data source"
+        return list(self.usernames)
+
+    def get_consents(self):
+        """Get all consents in the datasource"""
+        return {
+            consent_name: Consent.model_construct(
+                consent_name=consent_name, validity=validity * MICROSECOND
+            )
+            for consent_name, validity in zip(self.consent_names, self.validities)
+            if validity is not None
+        }
+
+    def user_exists(self, username):
+        """Check if user is present in the datasource"""
+        return username in self.user_ids
+
+    def consent_exists(self, consent_name):
+        """Check if consent is present in the datasource"""
+        consent_id = self.consent_ids.get(consent_name)
+        return consent_id is not None and self.validities[consent_id] is not None
+
+    def get_user_consents(self, username):
+        """Returns all consents of the user"""
+        return self._materialize_user(self.user_ids[username])
+
+    def get_user_consents_bulk(self, usernames):
+        """Returns consents of all given users that are present in the datasource"""
+        user_ids = self.user_ids
+        return {
+            username: self._materialize_user(user_ids[username])
+            for username in usernames
+            if username in user_ids
+        }
+
+    def user_has_consent(self, username, consent_name):
+        """Returns True if user has consent, False otherwise"""
+        return self._granted_at(username, consent_name) != NOT_GRANTED
+
+    def user_has_valid_consent(self, username, consent_name):
+        """Returns True if user has valid consent, False otherwise"""
+        granted_at = self._granted_at(username, consent_name)
+        if granted_at == NOT_GRANTED:
+            raise KeyError((username, consent_name))
+        _, validity = self._validity(consent_name)
+        return to_micros(datetime.now()) <= granted_at + validity
+
+    def lookup_user_consent(self, username, consent_name):
+        """Returns everything needed to check a consent of the user in one call"""
+        user_id = self.user_ids.get(username)
+        consent_id = self.consent_ids.get(consent_name)
+        validity = granted_at = None
+        if consent_id is not None:
+            validity = self.validities[consent_id]
+            if user_id is not None and self.columns[consent_id][user_id] != NOT_GRANTED:
+                granted_at = from_micros(self.columns[consent_id][user_id])
+        return ConsentLookup(
+            user_exists=user_id is not None,
+            consent_exists=validity is not None,
+            granted_at=granted_at,
+            validity=None if validity is None else validity * MICROSECOND,
+        )
+
+    def get_expiring_user_consents(self, consent_name, before, after=None):
+        """
+        Returns (username, expires_on) of all grants of the consent that expire before
+        the given time, ordered by expiry. If after is given only grants that are still
+        valid at that time are returned.
+        This scans the whole column, there is no index to keep the store compact.
+        """
+        consent_id, validity = self._validity(consent_name)
+        start = NOT_GRANTED + 1 if after is None else valid_since_micros(to_micros(after), validity)
+        end = valid_since_micros(to_micros(before), validity)
+        grants = sorted(
+            (granted_at, self.usernames[user_id])
+            for user_id, granted_at in enumerate(self.columns[consent_id])
+            if start <= granted_at < end
+        )
+        return [(username, from_micros(granted_at + validity)) for granted_at, username in grants]
+
+    def get_consent_stats(self, now, include_expired=False):
+        """
+        Returns the number of valid and expired grants of every consent at the given
+        time and, if include_expired is True, a list of (username, consent_name) of
+        all expired grants.
+        With numpy installed every column is evaluated at once as an int64 array
+        sharing memory with the column.
+        """
+        now = to_micros(now)
+        counts = {}
+        expired = [] if include_expired else None
+        for consent_id, (consent_name, validity) in enumerate(zip(self.consent_names, self.validities)):
+            if validity is None:
+                continue
+            column = self.columns[consent_id]
+            # Grants given before this are expired
+            valid_from = valid_since_micros(now, validity)
+            if numpy is not None:
+                granted_at = numpy.frombuffer(column, dtype=numpy.int64)
+                is_granted = granted_at != NOT_GRANTED
+                is_expired = (granted_at < valid_from) & is_granted
+                n_expired = int(numpy.count_nonzero(is_expired))
+                n_valid = int(numpy.count_nonzero((granted_at >= valid_from) & is_granted))
+                if include_expired:
+                    expired_ids = numpy.flatnonzero(is_expired).tolist()
+            else:
+                expired_ids = [
+                    user_id
+                    for user_id, granted_at in enumerate(column)
+                    if NOT_GRANTED < granted_at < valid_from
+                ]
+                n_expired = len(expired_ids)
+                n_valid = sum(
+                    1 for granted_at in column if granted_at != NOT_GRANTED and granted_at >= valid_from
+                )
+            counts[consent_name] = {"valid": n_valid, "expired": n_expired}
+            if include_expired:
+                expired.extend((self.usernames[user_id], consent_name) for user_id in expired_ids)
+        return counts, expired
+
+    def get_consent_users(self, consent_name, valid_only=False, after=None, limit=100):
+        """
+        Returns up to limit (username, granted_at) of users that hold the consent,
+        ordered by granting time. If valid_only is True only valid grants are returned.
+        after is the (granted_at, username) of the last grant of the previous page.
+        This scans the whole column, there is no index to keep the store compact.
+        """
+        consent_id, validity = self._validity(consent_name)
+        start = NOT_GRANTED + 1
+        if valid_only:
+            start = valid_since_micros(to_micros(datetime.now()), validity)
+        after = (start - 1, "") if after is None else (to_micros(after[0]), after[1])
+        usernames = self.usernames
+        grants = heapq.nsmallest(
+            limit,
+            (
+                (granted_at, usernames[user_id])
+                for user_id, granted_at in enumerate(self.columns[consent_id])
+                if granted_at >= start and (granted_at, usernames[user_id]) > after
+            ),
+        )
+        return [(username, from_micros(granted_at)) for granted_at, username in grants]
+
+    def iter_users(self, since=None, batch_size=1000):
+        """
+        Yields all users in batches of batch_size. If since is given only users
+        whose consents were granted or revoked at or after that time are yielded.
+        User ids only grow, so users added during iteration are yielded as well.
+        """
+        since = None if since is None else to_micros(since)
+        start = 0
+        while start < len(self.usernames):
+            user_ids = range(start, min(start + batch_size, len(self.usernames)))
+            if since is not None:
+                changed_at = self.changed_at
+                user_ids = [user_id for user_id in user_ids if changed_at[user_id] >= since]
+            if user_ids:
+                yield [self._materialize_user(user_id) for user_id in user_ids]
+            start += batch_size
+
+    def add_consent(self, consent: Consent):
+        """
+        Add a new consent to the database.
+        """
+        consent_id = self._intern_consent(consent.consent_name)
+        self.validities[consent_id] = consent.validity // MICROSECOND
+
+    def add_user(self, user: User):
+        """
+        Add a user together with consents they already granted.
+        """
+        user_id = self.user_ids.get(user.username)
+        if user_id is None:
+            user_id = len(self.usernames)
+            self.user_ids[user.username] = user_id
+            self.usernames.append(user.username)
+            for column in self.columns:
+                column.append(NOT_GRANTED)
+            self.changed_at.append(to_micros(datetime.now()))
+        else:
+            for column in self.columns:
+                column[user_id] = NOT_GRANTED
+            self.changed_at[user_id] = to_micros(datetime.now())
+        for consent_name, granted_at in user.consents.items():
+            self.columns[self._intern_consent(consent_name)][user_id] = to_micros(granted_at)
+
+    def bulk_write(self, consents=(), usernames=(), grants=()):
+        """
+        Write many consents, users and grants at once, in that order.
+        Users that already exist keep their consents. grants are
+        (username, consent_name, granted_at) tuples.
+        """
+        for consent in consents:
+            self.add_consent(consent)
+        for username in usernames:
+            if username not in self.user_ids:
+                self.add_user(User.model_construct(username=username, consents={}))
+        user_ids = self.user_ids
+        now = to_micros(datetime.now())
+        for username, consent_name, granted_at in grants:
+            user_id = user_ids[username]
+            self.columns[self._intern_consent(consent_name)][user_id] = to_micros(granted_at)
+            self.changed_at[user_id] = now
+
+    def add_user_consent(self, username, consent_name):
+        """
+        Add a consent to user.
+        """
+        user_id = self.user_ids[username]
+        now = to_micros(datetime.now())
+        self.columns[self._intern_consent(consent_name)][user_id] = now
+        self.changed_at[user_id] = now
+
+    def revoke_user_consent(self, username, consent_name):
+        """
+        Revoke a consent from user.
+        """
+        if self._granted_at(username, consent_name) == NOT_GRANTED:
+            raise KeyError((username, consent_name))
+        user_id = self.user_ids[username]
+        self.columns[self.consent_ids[consent_name]][user_id] = NOT_GRANTED
+        self.changed_at[user_id] = to_micros(datetime.now())
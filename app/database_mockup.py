@@ -1,25 +1,114 @@
 """
-database.py - Data Persistence
+database_mockup.py - In-Memory Data Persistence
 
 This module handles data persistence using an in-memory database.
 
+DBMockup is safe to call from many threads. Writes are serialized with a lock,
+reads take no locks and run concurrently with writes. The consents of a user and
+the consent catalogue are replaced instead of changed in place, and consent
+indexes are only changed with single list operations, so a reader never sees
+consents or an index in the middle of a change.
+
+Every grant and revocation is also kept in an append-only history, so the
+consents of a user can be checked at any past time.
+
 Classes:
-- MemoryDB: In-memory database class for storing consents and user data.
+- DBMockup: In-memory database class for storing consents and user data.
+
+Functions:
+- to_micros(moment), from_micros(micros): Convert times to and from microseconds since the epoch.
+- valid_since(moment, validity): Oldest time of granting that is still valid at a moment.
+- valid_since_micros(moment, validity): valid_since in microseconds, clamped to signed 64 bits.
+- replace_consents(user, consents): Replace the consents of a user without validation.
 
 """
+import secrets
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
 from datetime import datetime, timedelta
 from typing import Optional
+from .adapters import ConsentLookup
 from .models import Consent, User
 
+# Compact stores keep times as integer microseconds since the (naive) epoch, so they round trip exactly
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_micros(moment: datetime):
+    return (moment - EPOCH) // MICROSECOND
+
+
+def from_micros(micros: int):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def valid_since(moment: datetime, validity: timedelta):
+    """
+    Oldest time of granting that is still valid at the given moment, datetime.min
+    for validities reaching back further than datetime can.
+    """
+    try:
+        return moment - validity
+    except OverflowError:
+        return datetime.min
+
+
+def valid_since_micros(moment: int, validity: int):
+    """
+    valid_since in microseconds since the epoch for stores that keep times as signed
+    64-bit integers. Validities reaching back further are clamped to just above
+    -(2**63), which ColumnarDB uses for consents that were not granted.
+    """
+    return max(moment - validity, -(2**63) + 1)
+
+
+def replace_consents(user: User, consents: dict):
+    # Skips pydantic's __setattr__, which costs more than the rest of a grant
+    object.__setattr__(user, "consents", consents)
+
 
 class DBMockup:
     """
     In-memory database for storing consents and user data.
     """
 
+    # Concurrent calls need no outside lock
+    thread_safe = True
+
     def __init__(self, create_sample_data=False):
         self.consents = {}
         self.users = {}
+        # Grants of every consent as (granted_at, username) tuples ordered by granting time.
+        # All grants of a consent share the same validity, so this is also their expiry order.
+        self.consent_grants = {}
+        # Every mutation takes the next version, users and the consent catalogue keep
+        # the version of their last change. Users that are not in user_versions have
+        # not changed since they were loaded and are at version 0. Versions are
+        # prefixed with a random epoch, so they never match those of another instance.
+        # Changes of users take the time in microseconds as their version if it is
+        # larger, so user versions also tell since when a user is unchanged. Loaded
+        # users count as changed when the instance was created.
+        self.version_epoch = secrets.token_hex(4)
+        self.version = 0
+        self.user_versions = {}
+        self.consents_version = 0
+        self.created_at = to_micros(datetime.now())
+        # Grants archived by archive_expired_grants, per username an array of pairs of
+        # an archived consent id and the time of granting in microseconds
+        self.archive = {}
+        self.archived_consent_ids = {}
+        self.archived_consent_names = []
+        # Grants and revocations of every user, per username a dict of history
+        # consent ids to arrays of events ordered by time. An event is the time in
+        # microseconds times two, plus one for a revocation, so a revocation sorts
+        # after a grant in the same microsecond.
+        self.history = {}
+        self.history_consent_ids = {}
+        self.history_consent_names = []
+        # Held by writers, readers never wait for it
+        self.lock = threading.Lock()
         if create_sample_data:
             self.initialize_data()
 
@@ -53,7 +142,7 @@ class DBMockup:
             )
         )
         for user in users:
-            self.users[user.username] = user
+            self.add_user(user)
 
     def get_users(self):
         "Get all users in the data source"
@@ -79,6 +168,11 @@ class DBMockup:
         """Returns all consents of the user"""
         return self.users[username]
 
+    def get_user_consents_bulk(self, usernames):
+        """Returns consents of all given users that are present in the datasource"""
+        users = self.users
+        return {username: users[username] for username in usernames if username in users}
+
     def user_has_consent(self, username, consent_name):
         """Returns True if user has consent, False otherwise"""
         if consent_name in self.users[username].consents:
@@ -87,28 +181,396 @@ class DBMockup:
 
     def user_has_valid_consent(self, username, consent_name):
         """Returns True if user has valid consent, False otherwise"""
-        consent_expires_on = (
-            self.users[username].consents[consent_name]
-            + self.consents[consent_name].validity
-        )
-        if datetime.now() <= consent_expires_on:
+        granted_at = self.users[username].consents[consent_name]
+        if granted_at >= valid_since(datetime.now(), self.consents[consent_name].validity):
             return True
         return False
 
+    def lookup_user_consent(self, username, consent_name):
+        """
+        Returns everything needed to check a consent of the user in one call.
+        Archived grants are still found, so they are reported as expired.
+        """
+        user = self.users.get(username)
+        consent = self.consents.get(consent_name)
+        granted_at = None if user is None else user.consents.get(consent_name)
+        if granted_at is None and username in self.archive:
+            granted_at = self._archived_granted_at(username, consent_name)
+        return ConsentLookup(
+            user_exists=user is not None,
+            consent_exists=consent is not None,
+            granted_at=granted_at,
+            validity=None if consent is None else consent.validity,
+        )
+
+    def get_user_version(self, username):
+        """
+        Returns a token that changes whenever the consents of the user change,
+        None if the user does not exist.
+        """
+        if username not in self.users:
+            return None
+        return f"{self.version_epoch}.{self.user_versions.get(username, 0)}"
+
+    def get_consents_version(self):
+        """Returns a token that changes whenever a consent is added or changed"""
+        return f"{self.version_epoch}.{self.consents_version}"
+
+    def get_expiring_user_consents(self, consent_name, before, after=None):
+        """
+        Returns (username, expires_on) of all grants of the consent that expire before
+        the given time, ordered by expiry. If after is given only grants that are still
+        valid at that time are returned.
+        """
+        grants = self.consent_grants[consent_name]
+        validity = self.consents[consent_name].validity
+        start = 0 if after is None else bisect_left(grants, (valid_since(after, validity),))
+        end = bisect_left(grants, (valid_since(before, validity),))
+        return [(username, granted_at + validity) for granted_at, username in grants[start:end]]
+
+    def get_consent_stats(self, now, include_expired=False):
+        """
+        Returns the number of valid and expired grants of every consent at the given
+        time and, if include_expired is True, a list of (username, consent_name) of
+        all expired grants.
+        Expired grants are a prefix of consent_grants, so counting takes one bisect per consent.
+        """
+        counts = {}
+        expired = [] if include_expired else None
+        for consent_name, consent in self.consents.items():
+            grants = self.consent_grants[consent_name]
+            n_expired = bisect_left(grants, (valid_since(now, consent.validity),))
+            counts[consent_name] = {"valid": len(grants) - n_expired, "expired": n_expired}
+            if include_expired:
+                expired.extend((username, consent_name) for _, username in grants[:n_expired])
+        return counts, expired
+
+    def get_consent_users(self, consent_name, valid_only=False, after=None, limit=100):
+        """
+        Returns up to limit (username, granted_at) of users that hold the consent,
+        ordered by granting time. If valid_only is True only valid grants are returned.
+        after is the (granted_at, username) of the last grant of the previous page.
+        """
+        grants = self.consent_grants[consent_name]
+        start = 0
+        if valid_only:
+            start = bisect_left(grants, (valid_since(datetime.now(), self.consents[consent_name].validity),))
+        if after is not None:
+            start = max(start, bisect_right(grants, after))
+        return [(username, granted_at) for granted_at, username in grants[start : start + limit]]
+
+    def iter_users(self, since=None, batch_size=1000):
+        """
+        Yields all users in batches of batch_size. If since is given only users
+        whose consents were granted, revoked or archived at or after that time are
+        yielded.
+        Iterates over a snapshot of usernames, because add_user may add users
+        while the caller is between batches.
+        """
+        usernames = list(self.users)
+        if since is not None:
+            since = to_micros(since)
+            user_versions = self.user_versions
+            created_at = self.created_at
+            usernames = [
+                username for username in usernames if user_versions.get(username, created_at) >= since
+            ]
+        for start in range(0, len(usernames), batch_size):
+            yield [self.users[username] for username in usernames[start : start + batch_size]]
+
+    def get_archived_user_consents(self, username):
+        """Returns (consent_name, granted_at) of all archived grants of the user in order of archiving"""
+        archived = self.archive.get(username, ())
+        return [
+            (self.archived_consent_names[archived[i]], from_micros(archived[i + 1]))
+            for i in range(0, len(archived), 2)
+        ]
+
+    def get_archived_user_consents_bulk(self, usernames):
+        """
+        Returns {consent_name: granted_at} of the latest archived grant of every
+        consent of the given users, for users that have archived grants.
+        """
+        archived = {}
+        for username in usernames:
+            if username in self.archive:
+                archived[username] = dict(self.get_archived_user_consents(username))
+        return archived
+
+    def archive_expired_grants(self, before, limit=1000):
+        """
+        Move up to limit grants that expired before the given time from the users to
+        the archive and return how many were moved. Expired grants are a prefix of
+        consent_grants, so the work is proportional to the number of moved grants.
+        """
+        with self.lock:
+            counts = self._archivable_grants(before, limit)
+            for consent_name, count in counts:
+                self._archive_grants(consent_name, count)
+        return sum(count for _, count in counts)
+
+    def _archivable_grants(self, before, limit):
+        """(consent_name, count) of up to limit grants that expired before the given time"""
+        counts = []
+        for consent_name, consent in self.consents.items():
+            if limit <= 0:
+                break
+            grants = self.consent_grants[consent_name]
+            count = min(bisect_left(grants, (valid_since(before, consent.validity),)), limit)
+            if count:
+                counts.append((consent_name, count))
+                limit -= count
+        return counts
+
+    def _archived_consent_id(self, consent_name):
+        """Id of the consent in the archive, added if it has none yet, callers hold the lock"""
+        consent_id = self.archived_consent_ids.get(consent_name)
+        if consent_id is None:
+            consent_id = len(self.archived_consent_names)
+            self.archived_consent_names.append(consent_name)
+            self.archived_consent_ids[consent_name] = consent_id
+        return consent_id
+
+    def _archive_grants(self, consent_name, count):
+        """Move the count oldest grants of the consent to the archive, callers hold the lock"""
+        consent_id = self._archived_consent_id(consent_name)
+        grants = self.consent_grants[consent_name]
+        for granted_at, username in grants[:count]:
+            user = self.users[username]
+            consents = dict(user.consents)
+            del consents[consent_name]
+            replace_consents(user, consents)
+            archived = self.archive.get(username)
+            if archived is None:
+                archived = self.archive[username] = array("q")
+            archived.append(consent_id)
+            archived.append(to_micros(granted_at))
+            self._user_changed(username)
+        del grants[:count]
+
+    def _archived_granted_at(self, username, consent_name):
+        """Time of granting of the latest archived grant of the consent, None if there is none"""
+        consent_id = self.archived_consent_ids.get(consent_name)
+        if consent_id is None:
+            return None
+        archived = self.archive[username]
+        for i in range(len(archived) - 2, -1, -2):
+            if archived[i] == consent_id:
+                return from_micros(archived[i + 1])
+        return None
+
+    def lookup_user_consents_at(self, queries):
+        """
+        Returns a ConsentLookup for every (username, consent_name, at) query, with
+        the time of granting of the grant the user held at that time. granted_at is
+        None if the user had not granted the consent or had revoked it by then.
+        Validity is the current validity of the consent.
+        """
+        lookups = []
+        for username, consent_name, at in queries:
+            consent = self.consents.get(consent_name)
+            granted_at = None
+            events = self.history.get(username, {}).get(self.history_consent_ids.get(consent_name))
+            if events:
+                # Last event at or before the given time, including revocations at that time
+                index = bisect_right(events, to_micros(at) * 2 + 1)
+                if index and not events[index - 1] & 1:
+                    granted_at = from_micros(events[index - 1] >> 1)
+            lookups.append(
+                ConsentLookup(
+                    user_exists=username in self.users,
+                    consent_exists=consent is not None,
+                    granted_at=granted_at,
+                    validity=None if consent is None else consent.validity,
+                )
+            )
+        return lookups
+
+    def get_user_history_bulk(self, usernames):
+        """
+        Returns (events, archived) of the given users that have a history or archived
+        grants, to copy them to another adapter with restore_user_history. events are
+        (consent_name, moment, revoked) of all grants and revocations, archived are
+        (consent_name, granted_at) of all archived grants in order of archiving.
+        """
+        histories = {}
+        for username in usernames:
+            user_history = self.history.get(username, {})
+            if not user_history and username not in self.archive:
+                continue
+            events = [
+                (self.history_consent_names[consent_id], from_micros(event >> 1), bool(event & 1))
+                for consent_id, consent_events in user_history.items()
+                for event in consent_events
+            ]
+            histories[username] = (events, self.get_archived_user_consents(username))
+        return histories
+
+    def restore_user_history(self, histories):
+        """
+        Replace the history and archived grants of users with those returned by
+        get_user_history_bulk. Current consents are not changed.
+        """
+        with self.lock:
+            for username, (events, archived) in histories.items():
+                self._restore_user_history(username, events, archived)
+
+    def _restore_user_history(self, username, events, archived):
+        """Replace the history and archived grants of a user, callers hold the lock"""
+        self.history.pop(username, None)
+        for consent_name, moment, revoked in events:
+            self._record_event(username, consent_name, moment, revoked)
+        self.archive.pop(username, None)
+        if archived:
+            user_archive = array("q")
+            for consent_name, granted_at in archived:
+                user_archive.append(self._archived_consent_id(consent_name))
+                user_archive.append(to_micros(granted_at))
+            self.archive[username] = user_archive
+
+    def _record_event(self, username, consent_name, moment, revoked=False):
+        """Add a grant or revocation to the history of the user, callers hold the lock"""
+        consent_id = self.history_consent_ids.get(consent_name)
+        if consent_id is None:
+            consent_id = len(self.history_consent_names)
+            self.history_consent_names.append(consent_name)
+            self.history_consent_ids[consent_name] = consent_id
+        user_history = self.history.get(username)
+        if user_history is None:
+            user_history = self.history[username] = {}
+        events = user_history.get(consent_id)
+        if events is None:
+            events = user_history[consent_id] = array("q")
+        event = to_micros(moment) * 2 + revoked
+        # Events mostly arrive in order, imported grants can be older than the last event
+        if not events or events[-1] <= event:
+            events.append(event)
+        else:
+            insort(events, event)
+
     def add_consent(self, consent: Consent):
         """
         Add a new consent to the database.
+        Changing the validity of an existing consent keeps its grants, their expiry
+        order does not change as all of them are shifted by the same amount.
         """
-        self.consents[consent.consent_name] = consent
+        with self.lock:
+            consents = dict(self.consents)
+            consents[consent.consent_name] = consent
+            self.consent_grants.setdefault(consent.consent_name, [])
+            self.consents = consents
+            self.version += 1
+            self.consents_version = self.version
+
+    def add_user(self, user: User):
+        """
+        Add a user together with consents they already granted.
+        """
+        with self.lock:
+            previous = {}
+            if user.username in self.users:
+                previous = self.users[user.username].consents
+                now = datetime.now()
+                for consent_name, granted_at in previous.items():
+                    self._unindex_grant(user.username, consent_name, granted_at)
+                    if consent_name not in user.consents:
+                        self._record_event(user.username, consent_name, now, revoked=True)
+            self.users[user.username] = user
+            for consent_name, granted_at in user.consents.items():
+                self._index_grant(user.username, consent_name, granted_at)
+                if previous.get(consent_name) != granted_at:
+                    self._record_event(user.username, consent_name, granted_at)
+            self._user_changed(user.username)
+
+    def bulk_write(self, consents=(), usernames=(), grants=()):
+        """
+        Write many consents, users and grants at once, in that order.
+        Users that already exist keep their consents. grants are
+        (username, consent_name, granted_at) tuples.
+        """
+        for consent in consents:
+            self.add_consent(consent)
+        with self.lock:
+            for username in usernames:
+                if username not in self.users:
+                    self.users[username] = User.model_construct(username=username, consents={})
+                    self._user_changed(username)
+            # Grants can be in any time order, so instead of inserting them into the
+            # index one by one each affected consent is sorted once
+            added = {}
+            replaced = {}
+            changed = {}
+            for username, consent_name, granted_at in grants:
+                user_consents = changed.get(username)
+                if user_consents is None:
+                    user_consents = changed[username] = dict(self.users[username].consents)
+                previous = user_consents.get(consent_name)
+                if previous == granted_at:
+                    continue
+                # Only the last grant of a user is indexed, an earlier one of this
+                # batch is replaced in added, one from before in the index
+                new_grants = added.setdefault(consent_name, {})
+                if previous is not None and username not in new_grants:
+                    replaced.setdefault(consent_name, set()).add((previous, username))
+                user_consents[consent_name] = granted_at
+                self._record_event(username, consent_name, granted_at)
+                new_grants[username] = granted_at
+            for username, user_consents in changed.items():
+                replace_consents(self.users[username], user_consents)
+                self._user_changed(username)
+            # Readers keep the old index until the new one is complete
+            for consent_name, new_grants in added.items():
+                index = self.consent_grants.get(consent_name, [])
+                if consent_name in replaced:
+                    index = [grant for grant in index if grant not in replaced[consent_name]]
+                else:
+                    index = index.copy()
+                index.extend((granted_at, username) for username, granted_at in new_grants.items())
+                index.sort()
+                self.consent_grants[consent_name] = index
 
     def add_user_consent(self, username, consent_name):
         """
         Add a consent to user.
         """
-        self.users[username].consents[consent_name] = datetime.now()
+        with self.lock:
+            user = self.users[username]
+            consents = dict(user.consents)
+            if consent_name in consents:
+                self._unindex_grant(username, consent_name, consents[consent_name])
+            granted_at = datetime.now()
+            consents[consent_name] = granted_at
+            replace_consents(user, consents)
+            self._index_grant(username, consent_name, granted_at)
+            self._record_event(username, consent_name, granted_at)
+            self._user_changed(username)
 
     def revoke_user_consent(self, username, consent_name):
         """
-        Add a consent to user.
+        Revoke a consent from user.
         """
-        del self.users[username].consents[consent_name]
+        self._revoke_user_consent(username, consent_name)
+
+    def _revoke_user_consent(self, username, consent_name, revoked_at=None):
+        """Revoke a consent from user, recording the revocation at the given time or now"""
+        with self.lock:
+            if revoked_at is None:
+                revoked_at = datetime.now()
+            user = self.users[username]
+            consents = dict(user.consents)
+            granted_at = consents.pop(consent_name)
+            replace_consents(user, consents)
+            self._unindex_grant(username, consent_name, granted_at)
+            self._record_event(username, consent_name, revoked_at, revoked=True)
+            self._user_changed(username)
+
+    def _user_changed(self, username):
+        self.version = max(self.version + 1, to_micros(datetime.now()))
+        self.user_versions[username] = self.version
+
+    def _index_grant(self, username, consent_name, granted_at):
+        insort(self.consent_grants.setdefault(consent_name, []), (granted_at, username))
+
+    def _unindex_grant(self, username, consent_name, granted_at):
+        grants = self.consent_grants[consent_name]
+        del grants[bisect_left(grants, (granted_at, username))]
@@ -0,0 +1,63 @@
+"""
+errors.py - Error Responses
+
+This module turns exceptions raised while handling a request into error responses
+with proper status codes. Endpoints let HTTPException and ValidationError propagate
+instead of catching them.
+
+Most errors carry one of a few fixed messages, such as "User not found", so their
+JSON bodies are encoded once and reused.
+
+Functions:
+- add_error_handlers(app, not_found_max_age): Register the error handlers on the application.
+
+"""
+import json
+from functools import lru_cache
+from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from pydantic import ValidationError
+from starlette.exceptions import HTTPException
+
+
+@lru_cache(maxsize=256)
+def encode_detail(detail: str) -> bytes:
+    """JSON body of an error with a text detail"""
+    return json.dumps({"detail": detail}).encode()
+
+
+def add_error_handlers(app: FastAPI, not_found_max_age: int = 0):
+    """
+    Register handlers that answer HTTPException with its status code and
+    ValidationError with 400 and the validation errors.
+
+    If not_found_max_age is positive, 404 responses may be cached for that many
+    seconds, so proxies can answer repeated lookups of unknown users and consents.
+    """
+    not_found_headers = {}
+    if not_found_max_age > 0:
+        not_found_headers["Cache-Control"] = f"public, max-age={not_found_max_age}"
+
+    @app.exception_handler(HTTPException)
+    async def http_exception_handler(request: Request, exc: HTTPException):
+        headers = dict(exc.headers or {})
+        if exc.status_code == 404:
+            headers.update(not_found_headers)
+        if isinstance(exc.detail, str):
+            return Response(
+                encode_detail(exc.detail),
+                status_code=exc.status_code,
+                headers=headers,
+                media_type="application/json",
+            )
+        return JSONResponse(
+            {"detail": jsonable_encoder(exc.detail)}, status_code=exc.status_code, headers=headers
+        )
+
+    @app.exception_handler(ValidationError)
+    async def validation_error_handler(request: Request, exc: ValidationError):
+        return JSONResponse(
+            {"detail": jsonable_encoder(exc.errors(include_url=False, include_context=False))},
+            status_code=400,
+        )
@@ -0,0 +1,637 @@
+"""
+journal.py - Durable In-Memory Data Persistence
+
+This module makes the in-memory database durable with an append-only journal of
+mutations and periodic snapshots, while reads stay purely in memory.
+
+Files in the journal directory:
+- journal.<generation>.log: Mutations in the order they were applied, each framed
+  with its length and CRC32, so a torn write at a crash ends replay cleanly.
+- snapshot.<generation>.bin: Complete state at the start of journal.<generation>.log.
+
+On start the latest snapshot is loaded and all journals from its generation on are
+replayed. Writing then continues in a new journal generation.
+
+Classes:
+- Journal: Append-only journal file with group commit.
+- JournaledDBMockup: DBMockup that journals its mutations and recovers them on start.
+
+"""
+import gc
+import logging
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime
+from .database_mockup import MICROSECOND, DBMockup, from_micros, to_micros
+from .models import Consent, User
+
+ADD_CONSENT = 1
+ADD_USER = 2
+CREATE_USER = 3
+GRANT = 4
+REVOKE = 5
+ARCHIVE = 6
+# History and archived grants of a user copied from another adapter
+HISTORY = 7
+
+FRAME = struct.Struct("<II")
+UINT32 = struct.Struct("<I")
+INT64 = struct.Struct("<q")
+SNAPSHOT_MAGIC = b"CONSENTSNAPSHOT1"
+# Validity of consent names that were granted by a user but are not registered
+UNREGISTERED = -(2**63)
+
+logger = logging.getLogger(__name__)
+
+FILE_NAME = re.compile(r"^(journal|snapshot)\.(\d+)\.(log|bin)$")
+
+
+def pack_str(value: str):
+    encoded = value.encode()
+    return UINT32.pack(len(encoded)) + encoded
+
+
+class Reader:
+    """Reads values packed with pack_str, UINT32 and INT64 from a buffer"""
+
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+
+    def uint32(self):
+        (value,) = UINT32.unpack_from(self.buffer, self.offset)
+        self.offset += 4
+        return value
+
+    def int64(self):
+        (value,) = INT64.unpack_from(self.buffer, self.offset)
+        self.offset += 8
+        return value
+
+    def str(self):
+        length = self.uint32()
+        value = bytes(self.buffer[self.offset : self.offset + length]).decode()
+        self.offset += length
+        return value
+
+
+def encode_add_consent(consent: Consent):
+    return (
+        bytes([ADD_CONSENT])
+        + pack_str(consent.consent_name)
+        + INT64.pack(consent.validity // MICROSECOND)
+    )
+
+
+def encode_add_user(user: User):
+    return (
+        bytes([ADD_USER])
+        + pack_str(user.username)
+        + UINT32.pack(len(user.consents))
+        + b"".join(
+            pack_str(consent_name) + INT64.pack(to_micros(granted_at))
+            for consent_name, granted_at in user.consents.items()
+        )
+    )
+
+
+def encode_create_user(username: str):
+    return bytes([CREATE_USER]) + pack_str(username)
+
+
+def encode_grant(username: str, consent_name: str, granted_at):
+    return bytes([GRANT]) + pack_str(username) + pack_str(consent_name) + INT64.pack(to_micros(granted_at))
+
+
+def encode_revoke(username: str, consent_name: str, revoked_at):
+    return bytes([REVOKE]) + pack_str(username) + pack_str(consent_name) + INT64.pack(to_micros(revoked_at))
+
+
+def encode_archive(counts):
+    return (
+        bytes([ARCHIVE])
+        + UINT32.pack(len(counts))
+        + b"".join(pack_str(consent_name) + UINT32.pack(count) for consent_name, count in counts)
+    )
+
+
+def encode_history(username: str, events, archived):
+    return (
+        bytes([HISTORY])
+        + pack_str(username)
+        + UINT32.pack(len(events))
+        + b"".join(
+            pack_str(consent_name) + INT64.pack(to_micros(moment) * 2 + revoked)
+            for consent_name, moment, revoked in events
+        )
+        + UINT32.pack(len(archived))
+        + b"".join(
+            pack_str(consent_name) + INT64.pack(to_micros(granted_at))
+            for consent_name, granted_at in archived
+        )
+    )
+
+
+def pack_array(values: array):
+    """Length in bytes and the little endian values of an array of int64"""
+    if sys.byteorder == "big":
+        values = array("q", values)
+        values.byteswap()
+    encoded = values.tobytes()
+    return UINT32.pack(len(encoded)) + encoded
+
+
+def read_journal(path):
+    """Yield the payloads of all complete records of a journal file"""
+    with open(path, "rb") as file:
+        data = file.read()
+    offset = 0
+    while offset + FRAME.size <= len(data):
+        length, checksum = FRAME.unpack_from(data, offset)
+        payload = data[offset + FRAME.size : offset + FRAME.size + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            # Torn write of the last group commit before a crash
+            return
+        yield payload
+        offset += FRAME.size + length
+
+
+class Journal:
+    """
+    Append-only journal file with group commit.
+
+    append() only adds a record to an in-memory buffer. A writer thread waits
+    commit_interval for more records to join the group, then writes the whole
+    group and fsyncs once. wait() blocks until a record is durable, so concurrent
+    writers share one fsync.
+    """
+
+    def __init__(self, path, commit_interval=0.002):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.file = open(path, "ab")
+        self.condition = threading.Condition()
+        self.buffer = []
+        self.appended = 0
+        self.durable = 0
+        self.error = None
+        self.closing = False
+        self.writer = threading.Thread(target=self._write_groups, name="journal-writer", daemon=True)
+        self.writer.start()
+
+    def append(self, payload: bytes):
+        """Add a record and return its sequence number to wait for"""
+        with self.condition:
+            if self.closing:
+                raise RuntimeError("Journal is closed")
+            self.buffer.append(FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.appended += 1
+            self.condition.notify_all()
+            return self.appended
+
+    def wait(self, sequence: int):
+        """Block until the record with the given sequence number is on disk"""
+        with self.condition:
+            while self.durable < sequence and self.error is None:
+                self.condition.wait()
+            if self.durable < sequence:
+                raise self.error
+
+    def close(self):
+        """Write all appended records and close the file"""
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.writer.join()
+        self.file.close()
+
+    def _write_groups(self):
+        while True:
+            with self.condition:
+                while not self.buffer and not self.closing:
+                    self.condition.wait()
+                if not self.buffer:
+                    return
+            if self.commit_interval and not self.closing:
+                time.sleep(self.commit_interval)
+            with self.condition:
+                group, self.buffer = self.buffer, []
+                sequence = self.appended
+            try:
+                self.file.write(b"".join(group))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.durable = sequence
+                self.condition.notify_all()
+
+
+class JournaledDBMockup(DBMockup):
+    """
+    In-memory database whose mutations are journaled to disk.
+
+    Mutations are applied and appended to the journal under one lock, so the
+    journal has them in the order they were applied, and return once their group
+    commit is on disk. Reads do not take the lock and never touch the disk.
+
+    Mutations are visible to readers as soon as they are applied, before their
+    group commit is on disk. Until then a reader can see a grant or revocation
+    that a crash would lose, and if writing the journal fails the mutation stays
+    in memory although its caller gets the error. Applying only after the fsync
+    would keep writers from sharing group commits, as each would have to apply
+    in journal order after waiting.
+    Every snapshot_interval seconds the state is written to a snapshot and older
+    journals are removed. Writers wait only while the state is taken for a
+    snapshot, it is written while they continue in a new journal.
+    """
+
+    # Mutations block until fsync, so LogicHandler runs them in the threadpool,
+    # where concurrent writers share group commits. Reads are called directly.
+    blocking_methods = frozenset(
+        {
+            "add_consent",
+            "add_user",
+            "bulk_write",
+            "add_user_consent",
+            "revoke_user_consent",
+            "restore_user_history",
+            "archive_expired_grants",
+        }
+    )
+
+    def __init__(
+        self, directory, commit_interval=0.002, snapshot_interval=None, create_sample_data=False
+    ):
+        super().__init__()
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.write_lock = threading.Lock()
+        # Held while a snapshot is written, so snapshots are written one at a time
+        self.snapshot_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.generation = self._recover() + 1
+        self.journal = Journal(self._path("journal", self.generation), commit_interval)
+        self.closed = threading.Event()
+        self.snapshotter = None
+        if snapshot_interval:
+            self.snapshotter = threading.Thread(
+                target=self._snapshot_periodically, args=(snapshot_interval,), daemon=True
+            )
+            self.snapshotter.start()
+        if create_sample_data and not self.consents:
+            self.initialize_data()
+
+    def _path(self, kind, generation):
+        extension = "log" if kind == "journal" else "bin"
+        return os.path.join(self.directory, f"{kind}.{generation}.{extension}")
+
+    def _files(self, kind):
+        """Generations of the journal or snapshot files in the directory, in order"""
+        generations = []
+        for name in os.listdir(self.directory):
+            match = FILE_NAME.match(name)
+            if match and match.group(1) == kind:
+                generations.append(int(match.group(2)))
+        return sorted(generations)
+
+    def _recover(self):
+        """Load the latest snapshot and replay the journals after it, return the last generation"""
+        snapshots = self._files("snapshot")
+        generation = 0
+        if snapshots:
+            generation = snapshots[-1]
+            self._load_snapshot(self._path("snapshot", generation))
+        for journal_generation in self._files("journal"):
+            if journal_generation >= generation:
+                self._replay(read_journal(self._path("journal", journal_generation)))
+                generation = journal_generation
+        return generation
+
+    def _replay(self, payloads):
+        # Consecutive users and grants are applied with one bulk_write, which sorts
+        # each consent's index once instead of inserting every grant into it
+        usernames = []
+        grants = {}
+
+        def flush():
+            DBMockup.bulk_write(self, usernames=usernames, grants=list(grants.values()))
+            usernames.clear()
+            grants.clear()
+
+        for payload in payloads:
+            reader = Reader(payload, 1)
+            operation = payload[0]
+            if operation == CREATE_USER:
+                usernames.append(reader.str())
+                continue
+            if operation == GRANT:
+                username = reader.str()
+                consent_name = reader.str()
+                if (username, consent_name) in grants:
+                    flush()
+                grants[username, consent_name] = (username, consent_name, from_micros(reader.int64()))
+                continue
+            flush()
+            if operation == ADD_CONSENT:
+                consent_name = reader.str()
+                validity = reader.int64() * MICROSECOND
+                DBMockup.add_consent(
+                    self, Consent.model_construct(consent_name=consent_name, validity=validity)
+                )
+            elif operation == ADD_USER:
+                username = reader.str()
+                consents = {}
+                for _ in range(reader.uint32()):
+                    consent_name = reader.str()
+                    consents[consent_name] = from_micros(reader.int64())
+                DBMockup.add_user(self, User.model_construct(username=username, consents=consents))
+            elif operation == REVOKE:
+                username = reader.str()
+                consent_name = reader.str()
+                DBMockup._revoke_user_consent(self, username, consent_name, from_micros(reader.int64()))
+            elif operation == ARCHIVE:
+                # The oldest grants of a consent are the same ones as when they were archived
+                for _ in range(reader.uint32()):
+                    consent_name = reader.str()
+                    self._archive_grants(consent_name, reader.uint32())
+            elif operation == HISTORY:
+                username = reader.str()
+                events = []
+                for _ in range(reader.uint32()):
+                    consent_name = reader.str()
+                    event = reader.int64()
+                    events.append((consent_name, from_micros(event >> 1), bool(event & 1)))
+                archived = []
+                for _ in range(reader.uint32()):
+                    consent_name = reader.str()
+                    archived.append((consent_name, from_micros(reader.int64())))
+                self._restore_user_history(username, events, archived)
+        flush()
+
+    def _load_snapshot(self, path):
+        with open(path, "rb") as file:
+            data = file.read()
+        if data[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a consent snapshot")
+        reader = Reader(memoryview(data), len(SNAPSHOT_MAGIC))
+        consent_names = []
+        for _ in range(reader.uint32()):
+            consent_name = reader.str()
+            validity = reader.int64()
+            consent_names.append(consent_name)
+            if validity != UNREGISTERED:
+                self.consents[consent_name] = Consent.model_construct(
+                    consent_name=consent_name, validity=validity * MICROSECOND
+                )
+        grants = {consent_name: [] for consent_name in consent_names}
+        for _ in range(reader.uint32()):
+            username = reader.str()
+            consents = {}
+            for _ in range(reader.uint32()):
+                consent_name = consent_names[reader.uint32()]
+                granted_at = from_micros(reader.int64())
+                consents[consent_name] = granted_at
+                grants[consent_name].append((granted_at, username))
+            # Snapshot data was validated when it was written
+            self.users[username] = User.model_construct(username=username, consents=consents)
+        for consent_name, consent_grants in grants.items():
+            consent_grants.sort()
+            self.consent_grants[consent_name] = consent_grants
+        self._load_archive(reader)
+        self._load_history(reader)
+
+    def _load_archive(self, reader):
+        for _ in range(reader.uint32()):
+            consent_name = reader.str()
+            self.archived_consent_ids[consent_name] = len(self.archived_consent_names)
+            self.archived_consent_names.append(consent_name)
+        for _ in range(reader.uint32()):
+            username = reader.str()
+            length = reader.uint32()
+            archived = array("q")
+            archived.frombytes(reader.buffer[reader.offset : reader.offset + length])
+            reader.offset += length
+            if sys.byteorder == "big":
+                archived.byteswap()
+            self.archive[username] = archived
+
+    def _load_history(self, reader):
+        for _ in range(reader.uint32()):
+            consent_name = reader.str()
+            self.history_consent_ids[consent_name] = len(self.history_consent_names)
+            self.history_consent_names.append(consent_name)
+        for _ in range(reader.uint32()):
+            username = reader.str()
+            user_history = self.history[username] = {}
+            for _ in range(reader.uint32()):
+                consent_id = reader.uint32()
+                length = reader.uint32()
+                events = array("q")
+                events.frombytes(reader.buffer[reader.offset : reader.offset + length])
+                reader.offset += length
+                if sys.byteorder == "big":
+                    events.byteswap()
+                user_history[consent_id] = events
+
+    def _take_state(self):
+        """
+        References to everything a snapshot holds, taken while writers wait. The
+        consent catalogue and the consents of users are replaced on every change, so
+        they are not copied. Arrays of the archive and the history grow in place and
+        are copied.
+        """
+        return (
+            self.consents,
+            [(user.username, user.consents) for user in self.users.values()],
+            list(self.archived_consent_names),
+            [(username, archived[:]) for username, archived in self.archive.items()],
+            list(self.history_consent_names),
+            [
+                (username, [(consent_id, events[:]) for consent_id, events in user_history.items()])
+                for username, user_history in self.history.items()
+            ],
+        )
+
+    def _write_snapshot(self, path, state):
+        consents, users, archived_consent_names, archive, history_consent_names, history = state
+        consent_ids = {}
+        packed_users = []
+        for username, user_consents in users:
+            packed = [pack_str(username), UINT32.pack(len(user_consents))]
+            for consent_name, granted_at in user_consents.items():
+                consent_id = consent_ids.setdefault(consent_name, len(consent_ids))
+                packed.append(UINT32.pack(consent_id) + INT64.pack(to_micros(granted_at)))
+            packed_users.append(b"".join(packed))
+        for consent_name in consents:
+            consent_ids.setdefault(consent_name, len(consent_ids))
+
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(SNAPSHOT_MAGIC)
+            file.write(UINT32.pack(len(consent_ids)))
+            for consent_name in consent_ids:
+                consent = consents.get(consent_name)
+                validity = UNREGISTERED if consent is None else consent.validity // MICROSECOND
+                file.write(pack_str(consent_name) + INT64.pack(validity))
+            file.write(UINT32.pack(len(packed_users)))
+            file.writelines(packed_users)
+            file.write(UINT32.pack(len(archived_consent_names)))
+            file.writelines(pack_str(consent_name) for consent_name in archived_consent_names)
+            file.write(UINT32.pack(len(archive)))
+            for username, archived in archive:
+                file.write(pack_str(username) + pack_array(archived))
+            file.write(UINT32.pack(len(history_consent_names)))
+            file.writelines(pack_str(consent_name) for consent_name in history_consent_names)
+            file.write(UINT32.pack(len(history)))
+            for username, user_history in history:
+                file.write(pack_str(username) + UINT32.pack(len(user_history)))
+                for consent_id, events in user_history:
+                    file.write(UINT32.pack(consent_id) + pack_array(events))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+
+    def snapshot(self):
+        """
+        Write the current state to a snapshot, continue in a new journal and remove
+        the files the snapshot replaces. Writers only wait while the journal is
+        swapped and the state is taken, not while the snapshot is written.
+        """
+        with self.snapshot_lock:
+            with self.write_lock:
+                self.journal.close()
+                self.generation += 1
+                generation = self.generation
+                self.journal = Journal(self._path("journal", generation), self.commit_interval)
+                # The state holds no reference cycles, and collections triggered by
+                # its millions of allocations would take most of the time
+                gc_enabled = gc.isenabled()
+                gc.disable()
+                try:
+                    state = self._take_state()
+                finally:
+                    if gc_enabled:
+                        gc.enable()
+            self._write_snapshot(self._path("snapshot", generation), state)
+            for kind in ("journal", "snapshot"):
+                for older in self._files(kind):
+                    if older < generation:
+                        os.remove(self._path(kind, older))
+
+    def _snapshot_periodically(self, interval):
+        while not self.closed.wait(interval):
+            # A failed snapshot, for example on a full disk, is tried again next time.
+            # The journals it would have replaced are kept until one succeeds.
+            try:
+                self.snapshot()
+            except Exception:
+                logger.exception("Writing a snapshot failed")
+
+    def close(self):
+        """Stop taking snapshots and write all journaled mutations to disk"""
+        self.closed.set()
+        if self.snapshotter is not None:
+            self.snapshotter.join()
+        self.journal.close()
+
+    def _journaled(self, apply, *payloads):
+        with self.write_lock:
+            apply()
+            journal = self.journal
+            for payload in payloads:
+                sequence = journal.append(payload(self) if callable(payload) else payload)
+        journal.wait(sequence)
+
+    def add_consent(self, consent: Consent):
+        """
+        Add a new consent to the database.
+        """
+        self._journaled(lambda: DBMockup.add_consent(self, consent), encode_add_consent(consent))
+
+    def add_user(self, user: User):
+        """
+        Add a user together with consents they already granted.
+        """
+        self._journaled(lambda: DBMockup.add_user(self, user), encode_add_user(user))
+
+    def bulk_write(self, consents=(), usernames=(), grants=()):
+        """
+        Write many consents, users and grants at once, in that order.
+        Users that already exist keep their consents. grants are
+        (username, consent_name, granted_at) tuples.
+        """
+        payloads = (
+            [encode_add_consent(consent) for consent in consents]
+            + [encode_create_user(username) for username in usernames]
+            + [encode_grant(*grant) for grant in grants]
+        )
+
+        def apply():
+            # DBMockup.bulk_write adds consents with add_consent, which would journal them again
+            for consent in consents:
+                DBMockup.add_consent(self, consent)
+            DBMockup.bulk_write(self, usernames=usernames, grants=grants)
+
+        if payloads:
+            self._journaled(apply, *payloads)
+
+    def add_user_consent(self, username, consent_name):
+        """
+        Add a consent to user.
+        """
+        self._journaled(
+            lambda: DBMockup.add_user_consent(self, username, consent_name),
+            # The time of granting is only known once the grant is applied
+            lambda database: encode_grant(
+                username, consent_name, database.users[username].consents[consent_name]
+            ),
+        )
+
+    def revoke_user_consent(self, username, consent_name):
+        """
+        Revoke a consent from user.
+        """
+        # The time of the revocation is taken when it is applied, in journal order
+        revoked_at = []
+
+        def apply():
+            revoked_at.append(datetime.now())
+            DBMockup._revoke_user_consent(self, username, consent_name, revoked_at[0])
+
+        self._journaled(apply, lambda database: encode_revoke(username, consent_name, revoked_at[0]))
+
+    def restore_user_history(self, histories):
+        """
+        Replace the history and archived grants of users with those returned by
+        get_user_history_bulk. Current consents are not changed.
+        """
+        payloads = [encode_history(username, *history) for username, history in histories.items()]
+        if payloads:
+            self._journaled(lambda: DBMockup.restore_user_history(self, histories), *payloads)
+
+    def archive_expired_grants(self, before, limit=1000):
+        """
+        Move up to limit grants that expired before the given time to the archive and
+        return how many were moved.
+        """
+        with self.write_lock, self.lock:
+            counts = self._archivable_grants(before, limit)
+            if not counts:
+                return 0
+            for consent_name, count in counts:
+                self._archive_grants(consent_name, count)
+            journal = self.journal
+            sequence = journal.append(encode_archive(counts))
+        journal.wait(sequence)
+        return sum(count for _, count in counts)
@@ -1,34 +1,147 @@
 """
-consent_logic.py - Consent Logic
+logic_handler.py - Consent Logic
 
-This module contains the logic for creating consents.
+This module contains the logic behind the API routes: checking consents one by one,
+in bulk, against policies and at past times, creating consents, granting and
+revoking them, statistics, exports, imports and audits, and publishing changes to
+the change feed. It talks to the database only through the asynchronous adapter
+interface of adapters.py and imports no adapter module.
+
+Classes:
+- LogicHandler: Consent logic on top of a database adapter, with an optional verdict cache, metrics and change feed.
 
 Functions:
-- create_consent(consent: Consent): Create a new consent.
+- to_local_naive(moment): Convert a timezone aware datetime to naive local time.
+- encode_cursor(granted_at, username): Encode the position of a grant as an opaque cursor.
+- decode_cursor(cursor): Decode a cursor back to (granted_at, username).
+- grant_expires_on(granted_at, validity): Expiry of a grant, capped at datetime.max.
+- verdict_at(lookup, at): (valid, reason) of a looked up consent at a given time.
+- etag_matches(if_none_match, etag): Check if an If-None-Match header matches an ETag.
 
 """
+import asyncio
+import base64
+import binascii
+import contextlib
+import json
 from datetime import datetime, timedelta
+from typing import Optional
 from fastapi import HTTPException
+from functools import partial
+from .adapters import ConsentLookup, as_async_adapter, compose_lookup_user_consent
+from .bulk_import import FORMATS, parse_audit_row, parse_lines
+from .change_feed import CONSENT_CREATED, EXPIRED, GRANTED, REVOKED
+from .metrics import TimedAdapter
 from .models import Consent
+from .policy import compile_policy
+
+
+def to_local_naive(moment: datetime):
+    """
+    Convert a timezone aware datetime to naive local time, which is how grant times are stored.
+    """
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone().replace(tzinfo=None)
+
+
+def encode_cursor(granted_at: datetime, username: str):
+    """
+    Encode the position of a grant in a consent's grant list as an opaque cursor.
+    """
+    position = f"{granted_at.isoformat()}|{username}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+    Decode a cursor created by encode_cursor back to (granted_at, username).
+    """
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode()).decode()
+        granted_at, username = position.split("|", 1)
+        return to_local_naive(datetime.fromisoformat(granted_at)), username
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def grant_expires_on(granted_at: datetime, validity: timedelta):
+    """
+    Time a grant expires, datetime.max for validities reaching past what datetime can hold.
+    """
+    try:
+        return granted_at + validity
+    except OverflowError:
+        return datetime.max
+
+
+def verdict_at(lookup: ConsentLookup, at: datetime):
+    """
+    (valid, reason) of a consent of an existing user at the given time.
+    """
+    if lookup.granted_at is None:
+        return False, "User has not given consent"
+    if at <= grant_expires_on(lookup.granted_at, lookup.validity):
+        return True, "User has given consent"
+    return False, "User consent has expired"
+
+
+def etag_matches(if_none_match: Optional[str], etag: str):
+    """
+    Check if an If-None-Match header matches the ETag. The header is * or a comma
+    separated list of ETags, which are compared weakly as GET requests allow.
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(",")
+    )
 
 
 class LogicHandler:
-    def __init__(self, database_adapter):
+    def __init__(self, database_adapter, verdict_cache=None, metrics=None, change_feed=None):
         self.database_adapter = database_adapter
+        # Optional VerdictCache for check_user_consent_valid
+        self.verdict_cache = verdict_cache
+        # Optional ChangeFeed that gets an event for every grant, revocation, expiry and new consent
+        self.change_feed = change_feed
+        # Changes are applied and published one at a time, so that the feed has the order
+        # in which the adapter applied them, also when calls return from the threadpool
+        # in a different order
+        self.feed_lock = asyncio.Lock() if change_feed is not None else contextlib.nullcontext()
+        # All calls go through the asynchronous interface, synchronous adapters get wrapped
+        self.adapter = as_async_adapter(database_adapter)
+        # Optional Metrics timing every method and adapter call
+        if metrics is not None:
+            self.adapter = TimedAdapter(self.adapter, metrics)
+        if hasattr(self.adapter, "lookup_user_consent"):
+            self.lookup_user_consent = self.adapter.lookup_user_consent
+        else:
+            self.lookup_user_consent = partial(compose_lookup_user_consent, self.adapter)
+        # Adapters that keep version counters allow conditional GETs with ETags
+        self.versioned = hasattr(self.adapter, "get_user_version")
+        # Adapters with an archive can move long expired grants out of the way
+        self.archiving = hasattr(self.adapter, "archive_expired_grants")
+        # Adapters that keep a history of grants and revocations answer checks at past times
+        self.history = hasattr(self.adapter, "lookup_user_consents_at")
+        if metrics is not None:
+            metrics.time_logic_handler(self)
 
-    def get_all_users(self):
+    async def get_all_users(self):
         """
         Get all users from the database
         """
-        return self.database_adapter.get_users()
+        return await self.adapter.get_users()
 
-    def get_all_consents(self):
+    async def get_all_consents(self):
         """
         Get all consents from the database
         """
-        return self.database_adapter.get_consents()
+        return await self.adapter.get_consents()
 
-    def get_user_consents(self, username: str):
+    async def get_user_consents(self, username: str):
         """
         Get a user's consents.
 
@@ -36,13 +149,37 @@ class LogicHandler:
         - username (str): The username of the user.
         """
         # Check if the username exists
-        if not self.database_adapter.user_exists(username):
+        if not await self.adapter.user_exists(username):
             raise HTTPException(status_code=404, detail="User not found")
 
         # Get the user's consents
-        return self.database_adapter.get_user_consents(username)
+        return await self.adapter.get_user_consents(username)
+
+    async def get_user_consents_etag(self, username: str):
+        """
+        Get the ETag of a user's consents. It changes whenever the consents change.
+        Returns None if the user does not exist or the adapter keeps no versions.
+
+        Parameters:
+        - username (str): The username of the user.
+        """
+        if not self.versioned:
+            return None
+        version = await self.adapter.get_user_version(username)
+        if version is None:
+            return None
+        return f'"u{version}"'
 
-    def check_user_consent_valid(self, username: str, consent_name: str):
+    async def get_all_consents_etag(self):
+        """
+        Get the ETag of all consents. It changes whenever a consent is added or changed.
+        Returns None if the adapter keeps no versions.
+        """
+        if not self.versioned:
+            return None
+        return f'"c{await self.adapter.get_consents_version()}"'
+
+    async def check_user_consent_valid(self, username: str, consent_name: str):
         """
         Check if user has given specific consent and that it is still valid.
 
@@ -50,11 +187,19 @@ class LogicHandler:
         - username (str): The username of the user.
         - consent_name (str): The name of the consent.
         """
+        now = datetime.now()
+        if self.verdict_cache is not None:
+            respone = self.verdict_cache.get(username, consent_name, now)
+            if respone is not None:
+                return respone
+            cache_version = self.verdict_cache.version
+
+        lookup = await self.lookup_user_consent(username, consent_name)
         # Check if the username exists
-        if not self.database_adapter.user_exists(username):
+        if not lookup.user_exists:
             raise HTTPException(status_code=404, detail="User not found")
         # Check if the consent exists
-        if not self.database_adapter.consent_exists(consent_name):
+        if not lookup.consent_exists:
             raise HTTPException(status_code=404, detail="Consent not found")
         respone = {
             "username": username,
@@ -62,15 +207,453 @@ class LogicHandler:
             "valid": False,
             "reason": "User has not given consent",
         }
-        if self.database_adapter.user_has_consent(username, consent_name):
-            if self.database_adapter.user_has_valid_consent(username, consent_name):
+        valid_until = None
+        if lookup.granted_at is not None:
+            expires_on = grant_expires_on(lookup.granted_at, lookup.validity)
+            if now <= expires_on:
                 respone["valid"] = True
                 respone["reason"] = "User has given consent"
+                valid_until = expires_on
             else:
                 respone["reason"] = "User consent has expired"
+
+        if self.verdict_cache is not None:
+            self.verdict_cache.put(
+                username, consent_name, respone, now, valid_until, version=cache_version
+            )
         return respone
 
-    def create_consent(self, consent: Consent):
+    async def check_user_consents_valid_bulk(self, usernames: list[str], consent_names: list[str]):
+        """
+        Check validity of every given consent for every given user in one pass.
+
+        Consent definitions and user consents are fetched once for the whole batch
+        and all validity checks are done against the same point in time.
+        Unknown users or consents do not fail the whole batch, they are reported
+        as invalid with the same reason as the single check would give. Archived
+        grants are reported as expired, as by the single check.
+
+        Parameters:
+        - usernames (list[str]): The usernames of the users.
+        - consent_names (list[str]): The names of the consents for which to check.
+        """
+        consents = await self.adapter.get_consents()
+        users = await self.adapter.get_user_consents_bulk(usernames)
+        archived = await self._get_archived_user_consents_bulk(usernames)
+        now = datetime.now()
+        validities = {
+            consent_name: consents[consent_name].validity
+            for consent_name in consent_names
+            if consent_name in consents
+        }
+
+        results = {}
+        for username in usernames:
+            user = users.get(username)
+            user_results = {}
+            if user is not None and username in archived:
+                granted = {**archived[username], **user.consents}
+            elif user is not None:
+                granted = user.consents
+            for consent_name in consent_names:
+                if user is None:
+                    user_results[consent_name] = {"valid": False, "reason": "User not found"}
+                elif consent_name not in validities:
+                    user_results[consent_name] = {"valid": False, "reason": "Consent not found"}
+                elif consent_name not in granted:
+                    user_results[consent_name] = {
+                        "valid": False,
+                        "reason": "User has not given consent",
+                    }
+                elif now <= grant_expires_on(granted[consent_name], validities[consent_name]):
+                    user_results[consent_name] = {"valid": True, "reason": "User has given consent"}
+                else:
+                    user_results[consent_name] = {
+                        "valid": False,
+                        "reason": "User consent has expired",
+                    }
+            results[username] = user_results
+        return {"results": results}
+
+    async def _get_archived_user_consents_bulk(self, usernames: list[str]):
+        """
+        {consent_name: granted_at} of the latest archived grants of the users that have
+        any, so checks report archived grants as expired like lookup_user_consent does.
+        Called after the grants of the users were read, a grant archived in between is
+        then found here.
+        """
+        if not self.archiving:
+            return {}
+        return await self.adapter.get_archived_user_consents_bulk(usernames)
+
+    async def _compile_policy(self, expression: str):
+        """
+        Compile a policy expression and return it with the cutoffs of its consents now.
+        """
+        try:
+            policy = compile_policy(expression)
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=f"Invalid policy: {error}")
+        consents = await self.adapter.get_consents()
+        if not policy.consent_names <= consents.keys():
+            raise HTTPException(status_code=404, detail="Consent not found")
+        validities = {
+            consent_name: consents[consent_name].validity for consent_name in policy.consent_names
+        }
+        return policy, policy.cutoffs(validities, datetime.now())
+
+    async def check_user_policy(self, username: str, expression: str):
+        """
+        Check if user's consents satisfy a policy expression, see policy.py.
+        Archived grants count as expired grants.
+
+        Parameters:
+        - username (str): The username of the user.
+        - expression (str): The policy, for example "telemarketing AND NOT EXPIRED promotions".
+        """
+        policy, cutoffs = await self._compile_policy(expression)
+        users = await self.adapter.get_user_consents_bulk([username])
+        if username not in users:
+            raise HTTPException(status_code=404, detail="User not found")
+        consents = users[username].consents
+        archived = await self._get_archived_user_consents_bulk([username])
+        if username in archived:
+            consents = {**archived[username], **consents}
+        valid = policy.evaluate(consents, cutoffs)
+        return {
+            "username": username,
+            "policy": expression,
+            "valid": valid,
+            "reason": "Policy is satisfied" if valid else "Policy is not satisfied",
+        }
+
+    async def check_users_policy_bulk(self, usernames: list[str], expression: str):
+        """
+        Check one policy expression for many users against the same point in time.
+        Unknown users do not fail the whole batch, they are reported as not satisfying it.
+
+        Parameters:
+        - usernames (list[str]): The usernames of the users.
+        - expression (str): The policy, see policy.py.
+        """
+        policy, cutoffs = await self._compile_policy(expression)
+        users = await self.adapter.get_user_consents_bulk(usernames)
+        archived = await self._get_archived_user_consents_bulk(usernames)
+        evaluate = policy.evaluate
+        satisfied = {"valid": True, "reason": "Policy is satisfied"}
+        not_satisfied = {"valid": False, "reason": "Policy is not satisfied"}
+        not_found = {"valid": False, "reason": "User not found"}
+        results = {}
+        for username in usernames:
+            user = users.get(username)
+            if user is None:
+                results[username] = not_found
+            elif evaluate(
+                {**archived[username], **user.consents} if username in archived else user.consents,
+                cutoffs,
+            ):
+                results[username] = satisfied
+            else:
+                results[username] = not_satisfied
+        return {"policy": expression, "results": results}
+
+    async def check_user_consent_valid_at(self, username: str, consent_name: str, at: datetime):
+        """
+        Check if user had given specific consent and that it was valid at the given time.
+        Consents are checked with their current validity.
+
+        Parameters:
+        - username (str): The username of the user.
+        - consent_name (str): The name of the consent.
+        - at (datetime): The time at which the consent is checked.
+        """
+        if not self.history:
+            raise HTTPException(status_code=501, detail="Consent history is not kept by this database")
+        at = to_local_naive(at)
+        lookup = (await self.adapter.lookup_user_consents_at([(username, consent_name, at)]))[0]
+        if not lookup.user_exists:
+            raise HTTPException(status_code=404, detail="User not found")
+        if not lookup.consent_exists:
+            raise HTTPException(status_code=404, detail="Consent not found")
+        valid, reason = verdict_at(lookup, at)
+        return {
+            "username": username,
+            "consent_name": consent_name,
+            "at": at,
+            "valid": valid,
+            "reason": reason,
+        }
+
+    async def audit_user_consents(self, lines, format: str = "ndjson", chunk_size: int = 10000):
+        """
+        Check consents of users at past times, for example for every call of a call log.
+        Returns an asynchronous iterator of encoded newline delimited JSON, one line
+        per row with the verdict or the error of an invalid row. Rows are looked up
+        in chunks of chunk_size with one adapter call each, as they arrive.
+
+        Parameters:
+        - lines: Asynchronous iterator of lines with username, consent_name and at, see bulk_import.
+        - format (str): Either ndjson or csv.
+        - chunk_size (int): Number of rows looked up at once.
+        """
+        if not self.history:
+            raise HTTPException(status_code=501, detail="Consent history is not kept by this database")
+        if format not in FORMATS:
+            raise HTTPException(
+                status_code=400, detail=f"Invalid format. It should be one of {', '.join(FORMATS)}"
+            )
+        return self._audit_chunks(lines, format, chunk_size)
+
+    async def _audit_chunks(self, lines, format, chunk_size):
+        rows = []
+
+        async def check_chunk():
+            queries = [query for _, query, error in rows if error is None]
+            lookups = iter(await self.adapter.lookup_user_consents_at(queries))
+            encoded = []
+            for row, query, error in rows:
+                if error is not None:
+                    encoded.append(json.dumps({"row": row, "error": error}))
+                    continue
+                username, consent_name, at = query
+                lookup = next(lookups)
+                if not lookup.user_exists:
+                    valid, reason = False, "User not found"
+                elif not lookup.consent_exists:
+                    valid, reason = False, "Consent not found"
+                else:
+                    valid, reason = verdict_at(lookup, at)
+                encoded.append(
+                    json.dumps(
+                        {
+                            "row": row,
+                            "username": username,
+                            "consent_name": consent_name,
+                            "at": at.isoformat(),
+                            "valid": valid,
+                            "reason": reason,
+                        }
+                    )
+                )
+            rows.clear()
+            return ("\n".join(encoded) + "\n").encode()
+
+        async for row in parse_lines(lines, format, parse_audit_row):
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                yield await check_chunk()
+        if rows:
+            yield await check_chunk()
+
+    async def get_expiring_user_consents(
+        self, consent_name: str, before: datetime, after: Optional[datetime] = None
+    ):
+        """
+        Get users whose consent expires before the given time.
+
+        Parameters:
+        - consent_name (str): The name of the consent.
+        - before (datetime): Only grants expiring before this time are returned.
+        - after (datetime): If given, only grants still valid at this time are returned.
+        """
+        if not await self.adapter.consent_exists(consent_name):
+            raise HTTPException(status_code=404, detail="Consent not found")
+        expiring = await self.adapter.get_expiring_user_consents(
+            consent_name,
+            to_local_naive(before),
+            None if after is None else to_local_naive(after),
+        )
+        return {
+            "consent_name": consent_name,
+            "users": [
+                {"username": username, "expires_on": expires_on}
+                for username, expires_on in expiring
+            ],
+        }
+
+    async def get_consent_stats(self, include_expired: bool = False):
+        """
+        Count valid and expired grants of every consent.
+
+        Parameters:
+        - include_expired (bool): If True also list users and consents of all expired grants.
+        """
+        now = datetime.now()
+        counts, expired = await self.adapter.get_consent_stats(now, include_expired)
+        response = {"at": now, "consents": counts}
+        if include_expired:
+            response["expired"] = [
+                {"username": username, "consent_name": consent_name}
+                for username, consent_name in expired
+            ]
+        return response
+
+    async def get_archived_user_consents(self, username: str):
+        """
+        Get the grants of a user that were archived after they expired, in order of archiving.
+
+        Parameters:
+        - username (str): The username of the user.
+        """
+        if not await self.adapter.user_exists(username):
+            raise HTTPException(status_code=404, detail="User not found")
+        archived = []
+        if self.archiving:
+            archived = await self.adapter.get_archived_user_consents(username)
+        consents = await self.adapter.get_consents()
+        return {
+            "username": username,
+            "consents": [
+                {
+                    "consent_name": consent_name,
+                    "granted_at": granted_at,
+                    "expired_on": (
+                        grant_expires_on(granted_at, consents[consent_name].validity)
+                        if consent_name in consents
+                        else None
+                    ),
+                }
+                for consent_name, granted_at in archived
+            ],
+        }
+
+    async def get_consent_users(
+        self,
+        consent_name: str,
+        valid_only: bool = False,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+    ):
+        """
+        Get a page of users that hold a consent, ordered by the time of granting.
+
+        Parameters:
+        - consent_name (str): The name of the consent.
+        - valid_only (bool): If True only users whose consent is still valid are returned.
+        - cursor (str): The next_cursor from the previous page, None for the first page.
+        - limit (int): Maximal number of users on the page.
+        """
+        if not await self.adapter.consent_exists(consent_name):
+            raise HTTPException(status_code=404, detail="Consent not found")
+        after = None if cursor is None else decode_cursor(cursor)
+        # Ask for one more user to know if there is a next page
+        grants = await self.adapter.get_consent_users(
+            consent_name, valid_only=valid_only, after=after, limit=limit + 1
+        )
+        next_cursor = None
+        if len(grants) > limit:
+            grants = grants[:limit]
+            username, granted_at = grants[-1]
+            next_cursor = encode_cursor(granted_at, username)
+        return {
+            "consent_name": consent_name,
+            "users": [
+                {"username": username, "granted_at": granted_at}
+                for username, granted_at in grants
+            ],
+            "next_cursor": next_cursor,
+        }
+
+    async def export_user_consents(self, since: Optional[datetime] = None):
+        """
+        Export all users with their consents and validity of each consent as
+        newline delimited JSON, one line per user. Yields encoded chunks of lines
+        as users are read from the database, so memory use does not grow with the
+        number of users. Validity is evaluated at the start of the export.
+
+        Parameters:
+        - since (datetime): If given, only users whose consents were granted, revoked or archived at or after this time are exported.
+        """
+        validities = {
+            consent_name: consent.validity
+            for consent_name, consent in (await self.adapter.get_consents()).items()
+        }
+        now = datetime.now()
+        since = None if since is None else to_local_naive(since)
+        async for users in self.adapter.iter_users(since=since):
+            lines = []
+            for user in users:
+                consents = {}
+                for consent_name, granted_at in user.consents.items():
+                    validity = validities.get(consent_name)
+                    expires_on = None if validity is None else grant_expires_on(granted_at, validity)
+                    consents[consent_name] = {
+                        "granted_at": granted_at.isoformat(),
+                        "expires_on": None if expires_on is None else expires_on.isoformat(),
+                        "valid": expires_on is not None and now <= expires_on,
+                    }
+                lines.append(json.dumps({"username": user.username, "consents": consents}))
+            yield ("\n".join(lines) + "\n").encode()
+
+    async def import_records(self, lines, format: str = "ndjson", chunk_size: int = 1000):
+        """
+        Import consents, users and grants, keeping the original times of granting.
+
+        Lines are parsed and validated as they arrive and valid records are written
+        in chunks of chunk_size with one bulk write each. Invalid records are skipped
+        and reported, they do not stop the import. Grants have to reference consents
+        and users that exist or were imported on an earlier line.
+
+        Parameters:
+        - lines: Asynchronous iterator of lines, see bulk_import for the record format.
+        - format (str): Either ndjson or csv.
+        - chunk_size (int): Number of records written at once.
+        """
+        if format not in FORMATS:
+            raise HTTPException(
+                status_code=400, detail=f"Invalid format. It should be one of {', '.join(FORMATS)}"
+            )
+        known_consents = set(await self.adapter.get_consents())
+        known_users = set()
+        imported = {"consents": 0, "users": 0, "grants": 0}
+        errors = []
+        error_count = 0
+        records = 0
+        consents, usernames, grants = [], [], []
+
+        async def write_chunk():
+            await self.adapter.bulk_write(consents, usernames, grants)
+            if self.verdict_cache is not None:
+                for consent in consents:
+                    self.verdict_cache.invalidate_consent(consent.consent_name)
+                for username, consent_name, _ in grants:
+                    self.verdict_cache.invalidate(username, consent_name)
+            imported["consents"] += len(consents)
+            imported["users"] += len(usernames)
+            imported["grants"] += len(grants)
+
+        async for row, record, error in parse_lines(lines, format):
+            records += 1
+            if error is None:
+                record_type, value = record
+                if record_type == "consent":
+                    consents.append(value)
+                    known_consents.add(value.consent_name)
+                elif record_type == "user":
+                    usernames.append(value)
+                    known_users.add(value)
+                else:
+                    username, consent_name, _ = value
+                    if consent_name not in known_consents:
+                        error = "Consent not found"
+                    elif username not in known_users and not await self.adapter.user_exists(
+                        username
+                    ):
+                        error = "User not found"
+                    else:
+                        known_users.add(username)
+                        grants.append(value)
+            if error is not None:
+                error_count += 1
+                if len(errors) < 1000:
+                    errors.append({"row": row, "error": error})
+            if len(consents) + len(usernames) + len(grants) >= chunk_size:
+                await write_chunk()
+                consents, usernames, grants = [], [], []
+        await write_chunk()
+        return {"records": records, "imported": imported, "error_count": error_count, "errors": errors}
+
+    async def create_consent(self, consent: Consent):
         """
         Create a new consent.
 
@@ -87,10 +670,19 @@ class LogicHandler:
                 ),
             )
         # Create the consent
-        self.database_adapter.add_consent(consent)
+        async with self.feed_lock:
+            await self.adapter.add_consent(consent)
+            if self.verdict_cache is not None:
+                self.verdict_cache.invalidate_consent(consent.consent_name)
+            if self.change_feed is not None:
+                self.change_feed.publish(
+                    CONSENT_CREATED,
+                    consent_name=consent.consent_name,
+                    validity_seconds=consent.validity.total_seconds(),
+                )
         return consent
 
-    def add_user_consent(self, username: str, consent_name: str):
+    async def add_user_consent(self, username: str, consent_name: str):
         """
         Add a consent to a user.
 
@@ -99,16 +691,22 @@ class LogicHandler:
         - consent_name (str): The name of the consent to add.
         """
         # Check if both the username and consent exist
-        if not self.database_adapter.user_exists(username):
+        lookup = await self.lookup_user_consent(username, consent_name)
+        if not lookup.user_exists:
             raise HTTPException(status_code=404, detail="User not found")
 
-        if not self.database_adapter.consent_exists(consent_name):
+        if not lookup.consent_exists:
             raise HTTPException(status_code=404, detail="Consent not found")
 
         # Add consent to the user
-        self.database_adapter.add_user_consent(username, consent_name)
+        async with self.feed_lock:
+            await self.adapter.add_user_consent(username, consent_name)
+            if self.verdict_cache is not None:
+                self.verdict_cache.invalidate(username, consent_name)
+            if self.change_feed is not None:
+                self.change_feed.publish(GRANTED, username=username, consent_name=consent_name)
 
-    def revoke_user_consent(self, username: str, consent_name: str):
+    async def revoke_user_consent(self, username: str, consent_name: str):
         """
         Revoke a consent from a user.
 
@@ -117,11 +715,104 @@ class LogicHandler:
         - consent_name (str): The name of the consent to revoke.
         """
         # Check if both the username and consent exist
-        if not self.database_adapter.user_exists(username):
+        lookup = await self.lookup_user_consent(username, consent_name)
+        if not lookup.user_exists:
             raise HTTPException(status_code=404, detail="User not found")
 
-        if not self.database_adapter.consent_exists(consent_name):
+        if not lookup.consent_exists:
             raise HTTPException(status_code=404, detail="Consent not found")
 
-        if self.database_adapter.user_has_consent(username, consent_name):
-            self.database_adapter.revoke_user_consent(username, consent_name)
+        if lookup.granted_at is not None:
+            async with self.feed_lock:
+                try:
+                    await self.adapter.revoke_user_consent(username, consent_name)
+                except KeyError:
+                    # A concurrent request revoked it first, or the grant was archived
+                    return
+                if self.verdict_cache is not None:
+                    self.verdict_cache.invalidate(username, consent_name)
+                if self.change_feed is not None:
+                    self.change_feed.publish(REVOKED, username=username, consent_name=consent_name)
+
+    async def publish_expired_grants(self, now: Optional[datetime] = None):
+        """
+        Publish an expired event for every grant that expired since the last call,
+        in order of expiry. Grants that were revoked before they expired get none.
+
+        Parameters:
+        - now (datetime): Grants that expired before this time are published. Defaults to now.
+        """
+        now = now or datetime.now()
+        async with self.feed_lock:
+            expired_after = self.change_feed.expired_until
+            if now <= expired_after:
+                return
+            expired = []
+            for consent_name in await self.adapter.get_consents():
+                for username, expires_on in await self.adapter.get_expiring_user_consents(
+                    consent_name, now, expired_after
+                ):
+                    expired.append((expires_on, username, consent_name))
+            expired.sort()
+            for expires_on, username, consent_name in expired:
+                self.change_feed.publish(
+                    EXPIRED, time=expires_on, username=username, consent_name=consent_name
+                )
+            self.change_feed.expired_until = now
+
+    async def archive_expired_grants(
+        self, grace: timedelta, limit: int = 1000, now: Optional[datetime] = None
+    ):
+        """
+        Move up to limit grants that expired more than grace ago to the archive and
+        return how many were moved. Returns 0 if the adapter has no archive.
+
+        Parameters:
+        - grace (timedelta): How long expired grants stay with the user.
+        - limit (int): Maximal number of grants moved in one call.
+        - now (datetime): Defaults to now.
+        """
+        if not self.archiving:
+            return 0
+        try:
+            before = (now or datetime.now()) - grace
+        except OverflowError:
+            # Nothing expired that long ago
+            return 0
+        return await self.adapter.archive_expired_grants(before, limit)
+
+    async def get_changes(self, after: int = 0, limit: int = 100, timeout: float = 0):
+        """
+        Get events of the change feed after a sequence number, waiting up to timeout
+        seconds for new events if there are none yet.
+
+        Parameters:
+        - after (int): Sequence number of the last event the caller has seen, 0 for all kept events.
+        - limit (int): Maximal number of returned events.
+        - timeout (float): Maximal number of seconds to wait for an event.
+        """
+        await self.change_feed.wait(after, timeout)
+        events, reset = self.change_feed.read(after, limit)
+        last_seq = events[-1]["seq"] if events else (0 if reset else after)
+        return {"events": events, "last_seq": last_seq, "reset": reset}
+
+    async def stream_changes(self, after: int = 0, keepalive: float = 15):
+        """
+        Yield events of the change feed after a sequence number as Server-Sent Events,
+        waiting for new ones. A reset event tells that events were missed. A comment is
+        sent every keepalive seconds without events.
+        Every chunk is awaited by the server before the next one is read, so a slow
+        subscriber only falls behind in the feed.
+
+        Parameters:
+        - after (int): Sequence number of the last event the caller has seen, 0 for all kept events.
+        """
+        while True:
+            if not await self.change_feed.wait(after, keepalive):
+                yield b": keepalive\n\n"
+                continue
+            chunks, reset, after = self.change_feed.read_encoded(after, 1000)
+            if reset:
+                yield b"event: reset\ndata: {}\n\n"
+            for chunk in chunks:
+                yield chunk
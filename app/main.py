@@ -1,52 +1,318 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import ValidationError
-from .models import Consent
-from .logic_handler import LogicHandler
-from .database_mockup import DBMockup
-from datetime import timedelta
+"""
+main.py - Consent API Application
 
-databse_adapter = DBMockup(create_sample_data=True)
-logicHandler = LogicHandler(databse_adapter)
-app = FastAPI()
+This module contains the FastAPI application, its settings, read from CONSENT_API_*
+environment variables, and its routes.
 
+The application starts without data. Its lifespan loads the selected database in a
+thread, which for large journaled databases can take a while, and then starts the
+background tasks. Until then /health answers liveness checks, /ready and all data
+routes answer 503. Adapter modules are imported only when they are selected.
 
-@app.get("/users/")
-def get_users():
+Functions:
+- create_app(): Create the application with the routes enabled by the settings.
+- create_database_adapter(): Import and create the selected database adapter.
+- initialize(): Load the database now instead of in the lifespan.
+
+"""
+from fastapi import APIRouter, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from .bulk_import import iter_lines
+from .change_feed import ChangeFeed
+from .errors import add_error_handlers
+from .models import BulkConsentCheck, BulkPolicyCheck, Consent
+from .responses import FastJSONResponse
+from .logic_handler import LogicHandler, etag_matches
+from .metrics import Metrics, MetricsMiddleware
+from .verdict_cache import VerdictCache
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from typing import Optional
+import asyncio
+import logging
+import os
+import tempfile
+
+DATABASES = ("memory", "journaled", "columnar", "sqlite", "store", "sharded")
+
+# Select the data persistence layer with CONSENT_API_DATABASE, "memory", "journaled", "columnar", "sqlite", "store" or "sharded"
+DATABASE = os.environ.get("CONSENT_API_DATABASE", "memory")
+SQLITE_PATH = os.environ.get("CONSENT_API_SQLITE_PATH", "consents.db")
+# The journaled in-memory database waits up to COMMIT_INTERVAL seconds to fsync writes together
+JOURNAL_DIR = os.environ.get("CONSENT_API_JOURNAL_DIR", "journal")
+COMMIT_INTERVAL = float(os.environ.get("CONSENT_API_COMMIT_INTERVAL", "0.002"))
+SNAPSHOT_INTERVAL = float(os.environ.get("CONSENT_API_SNAPSHOT_INTERVAL", "3600"))
+# With several workers, "store" connects every worker to one store server started with python -m app.store_server
+STORE_ADDRESS = os.environ.get("CONSENT_API_STORE_ADDRESS", "127.0.0.1:8765")
+STORE_AUTHKEY = os.environ.get("CONSENT_API_STORE_AUTHKEY", "")
+# "sharded" spreads users over the store servers at the comma separated CONSENT_API_SHARD_ADDRESSES
+SHARD_ADDRESSES = os.environ.get("CONSENT_API_SHARD_ADDRESSES", "")
+
+# Settings are checked at import, so a misconfigured worker fails before it reports to be alive
+if DATABASE not in DATABASES:
+    raise ValueError(
+        f"Unknown CONSENT_API_DATABASE {DATABASE!r}, use 'memory', 'journaled', 'columnar', 'sqlite', 'store' or 'sharded'"
+    )
+if DATABASE in ("store", "sharded") and not STORE_AUTHKEY:
+    raise ValueError("CONSENT_API_STORE_AUTHKEY has to be set to the key of the store servers")
+if DATABASE == "sharded" and not SHARD_ADDRESSES:
+    raise ValueError("CONSENT_API_SHARD_ADDRESSES has to be set for sharded stores")
+
+# Cache consent check verdicts when CONSENT_API_CACHE_SIZE is set to the maximal number of entries
+CACHE_SIZE = int(os.environ.get("CONSENT_API_CACHE_SIZE", "0"))
+CACHE_TTL = float(os.environ.get("CONSENT_API_CACHE_TTL", "30"))
+
+verdict_cache = None
+if CACHE_SIZE > 0:
+    verdict_cache = VerdictCache(maxsize=CACHE_SIZE, ttl=timedelta(seconds=CACHE_TTL))
+
+# 404 responses may be cached by proxies for CONSENT_API_NOT_FOUND_MAX_AGE seconds
+NOT_FOUND_MAX_AGE = int(os.environ.get("CONSENT_API_NOT_FOUND_MAX_AGE", "0"))
+
+# Audit results are kept in memory up to CONSENT_API_AUDIT_SPOOL_SIZE bytes, larger ones in a temporary file
+AUDIT_SPOOL_SIZE = int(os.environ.get("CONSENT_API_AUDIT_SPOOL_SIZE", str(16 * 1024 * 1024)))
+
+# Request and call metrics are served on /metrics unless CONSENT_API_METRICS is set to 0
+METRICS = os.environ.get("CONSENT_API_METRICS", "1") != "0"
+
+# Changes are kept for subscribers of /changes in a feed of CONSENT_API_CHANGE_FEED_SIZE
+# events, 0 turns it off. Expired grants are looked for every EXPIRY_SCAN_INTERVAL seconds.
+CHANGE_FEED_SIZE = int(os.environ.get("CONSENT_API_CHANGE_FEED_SIZE", "100000"))
+EXPIRY_SCAN_INTERVAL = float(os.environ.get("CONSENT_API_EXPIRY_SCAN_INTERVAL", "1"))
+
+# Every CONSENT_API_SWEEP_INTERVAL seconds grants that expired more than
+# CONSENT_API_ARCHIVE_GRACE seconds ago are moved to the archive, at most
+# CONSENT_API_SWEEP_BATCH_SIZE at a time. A negative grace turns it off.
+ARCHIVE_GRACE = float(os.environ.get("CONSENT_API_ARCHIVE_GRACE", str(30 * 24 * 3600)))
+SWEEP_INTERVAL = float(os.environ.get("CONSENT_API_SWEEP_INTERVAL", "60"))
+SWEEP_BATCH_SIZE = int(os.environ.get("CONSENT_API_SWEEP_BATCH_SIZE", "1000"))
+
+logger = logging.getLogger(__name__)
+
+
+class Starting:
+    """Stands in for the logic handler until the database is loaded, every call is answered with 503"""
+
+    def __getattr__(self, name):
+        raise HTTPException(status_code=503, detail="Service is starting", headers={"Retry-After": "1"})
+
+
+metrics = Metrics(verdict_cache=verdict_cache) if METRICS else None
+change_feed = ChangeFeed(CHANGE_FEED_SIZE) if CHANGE_FEED_SIZE > 0 else None
+# Set when the database is loaded, by the lifespan or by initialize()
+databse_adapter = None
+logicHandler = Starting()
+# The exception that stopped loading the database, if any
+startup_error = None
+
+
+def create_database_adapter():
+    """
+    Import and create the database adapter selected by CONSENT_API_DATABASE, with
+    sample data if the database is empty. Loading a journaled database replays it.
+    """
+    if DATABASE == "sqlite":
+        from .sqlite_adapter import SQLiteAdapter
+
+        return SQLiteAdapter(SQLITE_PATH, create_sample_data=True)
+    if DATABASE == "columnar":
+        from .columnar_store import ColumnarDB
+
+        return ColumnarDB(create_sample_data=True)
+    if DATABASE == "journaled":
+        from .journal import JournaledDBMockup
+
+        return JournaledDBMockup(
+            JOURNAL_DIR,
+            commit_interval=COMMIT_INTERVAL,
+            snapshot_interval=SNAPSHOT_INTERVAL,
+            create_sample_data=True,
+        )
+    if DATABASE == "store":
+        from .store_server import StoreClient, parse_address
+
+        return StoreClient(parse_address(STORE_ADDRESS), STORE_AUTHKEY.encode())
+    if DATABASE == "sharded":
+        from .sharded_store import ShardedDB
+        from .store_server import StoreClient, parse_address
+
+        return ShardedDB(
+            StoreClient(parse_address(address.strip()), STORE_AUTHKEY.encode())
+            for address in SHARD_ADDRESSES.split(",")
+        )
+    from .database_mockup import DBMockup
+
+    return DBMockup(create_sample_data=True)
+
+
+def initialize():
+    """
+    Create the database adapter and the logic handler unless that was done already,
+    for callers that use the application without running its lifespan.
+    """
+    global databse_adapter, logicHandler
+    if databse_adapter is None:
+        databse_adapter = create_database_adapter()
+    if isinstance(logicHandler, Starting):
+        logicHandler = LogicHandler(
+            databse_adapter, verdict_cache=verdict_cache, metrics=metrics, change_feed=change_feed
+        )
+    return logicHandler
+
+
+async def publish_expired_grants_periodically():
+    while True:
+        await asyncio.sleep(EXPIRY_SCAN_INTERVAL)
+        # A failed scan, for example while the store is unreachable, is retried next time
+        try:
+            await logicHandler.publish_expired_grants()
+        except Exception:
+            logger.exception("Publishing expired grants failed")
+
+
+async def archive_expired_grants_periodically():
+    grace = timedelta(seconds=ARCHIVE_GRACE)
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            # Requests are handled between batches, so a large backlog does not hold them up
+            while await logicHandler.archive_expired_grants(grace, SWEEP_BATCH_SIZE) >= SWEEP_BATCH_SIZE:
+                await asyncio.sleep(0)
+        except Exception:
+            logger.exception("Archiving expired grants failed")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    tasks = []
+
+    async def start():
+        global databse_adapter, startup_error
+        try:
+            # The event loop keeps answering liveness checks while the database loads
+            if databse_adapter is None:
+                databse_adapter = await asyncio.to_thread(create_database_adapter)
+            initialize()
+        except Exception as error:
+            startup_error = error
+            logger.exception("Loading the database failed")
+            return
+        if change_feed is not None:
+            tasks.append(asyncio.create_task(publish_expired_grants_periodically()))
+        if ARCHIVE_GRACE >= 0 and logicHandler.archiving:
+            tasks.append(asyncio.create_task(archive_expired_grants_periodically()))
+
+    tasks.append(asyncio.create_task(start()))
+    yield
+    for task in tasks:
+        task.cancel()
+    # Flushes the journal of a journaled database and closes connections to stores
+    if hasattr(databse_adapter, "close"):
+        await asyncio.to_thread(databse_adapter.close)
+
+
+router = APIRouter()
+changes_router = APIRouter()
+
+
+def create_app():
+    """
+    Create the application. The database is loaded by its lifespan, after the
+    application already answers requests.
+    """
+    app = FastAPI(lifespan=lifespan)
+    add_error_handlers(app, not_found_max_age=NOT_FOUND_MAX_AGE)
+    if metrics is not None:
+        app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+        @app.get("/metrics", response_class=PlainTextResponse)
+        async def get_metrics():
+            """
+            Get latency histograms of requests, LogicHandler methods and database adapter
+            calls, counts of their errors and verdict cache counters in the Prometheus
+            text format.
+            """
+            return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+    app.include_router(router)
+    if change_feed is not None:
+        app.include_router(changes_router)
+    return app
+
+
+@router.get("/health")
+async def health():
+    """
+    Liveness check, answered as soon as the worker accepts requests. Returns 500
+    if loading the database failed, so the worker gets restarted.
+    """
+    if startup_error is not None:
+        raise HTTPException(status_code=500, detail="Startup failed")
+    return {"status": "ok"}
+
+
+@router.get("/ready")
+async def ready():
+    """
+    Readiness check, 503 until the database is loaded with its indexes.
+    """
+    if isinstance(logicHandler, Starting):
+        detail = "Startup failed" if startup_error is not None else "Service is starting"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "1"})
+    return {"status": "ready"}
+
+
+@router.get("/users/")
+async def get_users():
     """
     Get a list of all users registered in the database.
     
     Returns:
     - List[str]: A list of usernames.
     """
-    try:
-        return logicHandler.get_all_users()
-    except ValidationError as e:
-        return HTTPException(status_code=400, detail=e.errors())
-    except HTTPException as e:
-        return e
+    return FastJSONResponse(await logicHandler.get_all_users())
 
 
-@app.get("/consents/")
-def get_consents():
+@router.get("/consents/")
+async def get_consents(request: Request):
     """
     Get a list of all registered consents
     together with their validity duration in seconds.
+    The response has an ETag. If the If-None-Match header has the same ETag
+    nothing changed and 304 Not Modified is returned without a body.
     
     Returns:
     - dict: A dictionary of consent names as keys and their validity durations.
     """
-    try:
-        return logicHandler.get_all_consents()
-    except ValidationError as e:
-        return HTTPException(status_code=400, detail=e.errors())
-    except HTTPException as e:
-        return e
+    headers = {}
+    etag = await logicHandler.get_all_consents_etag()
+    if etag is not None:
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        headers["ETag"] = etag
+    return FastJSONResponse(await logicHandler.get_all_consents(), headers=headers)
 
 
-@app.get("/users/{username}/consents/")
-def get_user_consents_endpoint(username: str):
+@router.get("/consents/stats")
+async def get_consent_stats(include_expired: bool = False):
+    """
+    Count currently valid and expired grants of every consent.
+
+    Parameters:
+    - include_expired (bool): If True also list users and consents of all expired grants.
+
+    Returns:
+    - dict: The time of evaluation, numbers of valid and expired grants per consent name and optionally the list of expired grants.
+    """
+    return FastJSONResponse(await logicHandler.get_consent_stats(include_expired))
+
+
+@router.get("/users/{username}/consents/")
+async def get_user_consents_endpoint(username: str, request: Request):
     """
     Get all of user's consents.
+    The response has an ETag. If the If-None-Match header has the same ETag
+    nothing changed and 304 Not Modified is returned without a body.
 
     Parameters:
     - username (str): The username of the user.
@@ -54,35 +320,268 @@ def get_user_consents_endpoint(username: str):
     Returns:
     - dict: A dictionary of consent names as keys and the timestamps of their granting for the given user.
     """
-    try:
-        return logicHandler.get_user_consents(username)
-    except ValidationError as e:
-        return HTTPException(status_code=400, detail=e.errors())
-    except HTTPException as e:
-        return e
+    headers = {}
+    # The ETag is read before the consents, so a change in between gives a stale
+    # ETag with fresh consents and the next request gets them again
+    etag = await logicHandler.get_user_consents_etag(username)
+    if etag is not None:
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        headers["ETag"] = etag
+    return FastJSONResponse(await logicHandler.get_user_consents(username), headers=headers)
+
 
-@app.get("/users/{username}/consents/{consent_name}")
-def check_user_consent_valid(username: str, consent_name: str):
+@router.get("/users/{username}/archived-consents/")
+async def get_archived_user_consents(username: str):
+    """
+    Get user's grants that were archived after they expired, in order of archiving.
+
+    Parameters:
+    - username (str): The username of the user.
+
+    Returns:
+    - dict: The username and a list of archived grants with their consent name, time of granting and time of expiry.
+    """
+    return FastJSONResponse(await logicHandler.get_archived_user_consents(username))
+
+
+@router.get("/users/{username}/consents/{consent_name}")
+async def check_user_consent_valid(username: str, consent_name: str, at: Optional[datetime] = None):
     """
     Check if user has a specific consent
 
     Parameters:
     - username (str): The username of the user.
     - consent_name (str): The name of the consent for which to check.
+    - at (datetime): If given, check if the consent was valid at this past time instead of now.
     
     Returns:
     - dict: A dictionary with information about the consent's validity status and reason for such result for the user.
     """
+    if at is not None:
+        return FastJSONResponse(await logicHandler.check_user_consent_valid_at(username, consent_name, at))
+    return FastJSONResponse(await logicHandler.check_user_consent_valid(username, consent_name))
+
+
+@router.get("/users/{username}/policy")
+async def check_user_policy(username: str, expr: str):
+    """
+    Check if user's consents satisfy a policy, such as "telemarketing AND NOT EXPIRED promotions"
+    or "ANY(catalogues, promotions)".
+
+    Parameters:
+    - username (str): The username of the user.
+    - expr (str): The policy expression.
+
+    Returns:
+    - dict: A dictionary with the policy, whether the user satisfies it and the reason for such result.
+    """
+    return FastJSONResponse(await logicHandler.check_user_policy(username, expr))
+
+
+@router.get("/consents/{consent_name}/expiring")
+async def get_expiring_user_consents(
+    consent_name: str, before: datetime, after: Optional[datetime] = None
+):
+    """
+    Get users whose consent expires before the given time, ordered by expiry.
+
+    Parameters:
+    - consent_name (str): The name of the consent.
+    - before (datetime): Only grants expiring before this time are returned.
+    - after (datetime): If given, only grants that are still valid at this time are returned.
+
+    Returns:
+    - dict: The consent name and a list of usernames with the expiry time of their consent.
+    """
+    return FastJSONResponse(
+        await logicHandler.get_expiring_user_consents(consent_name, before, after)
+    )
+
+
+@router.get("/consents/{consent_name}/users")
+async def get_consent_users(
+    consent_name: str,
+    valid_only: bool = False,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """
+    Get a page of users that hold a consent, ordered by the time of granting.
+
+    Parameters:
+    - consent_name (str): The name of the consent.
+    - valid_only (bool): If True only users whose consent is still valid are returned.
+    - cursor (str): The next_cursor of the previous page. Omit for the first page.
+    - limit (int): Maximal number of users on the page.
+
+    Returns:
+    - dict: The consent name, a list of usernames with the time of granting and the cursor of the next page, which is null on the last page.
+    """
+    return FastJSONResponse(
+        await logicHandler.get_consent_users(consent_name, valid_only, cursor, limit)
+    )
+
+
+@router.get("/export")
+async def export_user_consents(since: Optional[datetime] = None):
+    """
+    Export all users with their consents as newline delimited JSON, one line per user.
+    The response is streamed while users are read from the database.
+
+    Parameters:
+    - since (datetime): If given, only users whose consents were granted, revoked or archived at or after this time are exported.
+
+    Returns:
+    - Lines of {"username": ..., "consents": {consent name: {"granted_at": ..., "expires_on": ..., "valid": ...}}}.
+    """
+    return StreamingResponse(
+        logicHandler.export_user_consents(since), media_type="application/x-ndjson"
+    )
+
+
+@changes_router.get("/changes")
+async def get_changes(
+    after: int = 0,
+    limit: int = Query(100, ge=1, le=1000),
+    timeout: float = Query(0, ge=0, le=60),
+):
+    """
+    Get changes of consents in order, waiting for the next change if there is none yet.
+
+    Parameters:
+    - after (int): The last_seq of the previous response. Omit to get all kept changes.
+    - limit (int): Maximal number of returned changes.
+    - timeout (float): Maximal number of seconds to wait for a change, 0 returns at once.
+
+    Returns:
+    - dict: Events with their sequence number (seq), type (granted, revoked, expired or consent_created), time, username and consent_name, the sequence number to continue after (last_seq) and reset, which is true if changes after the given sequence number were already dropped and the data has to be resynchronized.
+    """
+    return FastJSONResponse(await logicHandler.get_changes(after, limit, timeout))
+
+
+@changes_router.get("/changes/stream")
+async def stream_changes(request: Request, after: Optional[int] = None):
+    """
+    Stream changes of consents as Server-Sent Events. Every event has the sequence
+    number as its id, so a reconnecting client resumes after the Last-Event-ID.
+    A reset event tells that changes were missed and the data has to be resynchronized.
+
+    Parameters:
+    - after (int): Sequence number of the last seen change. Defaults to the Last-Event-ID header or 0 for all kept changes.
+    """
+    if after is None:
+        last_event_id = request.headers.get("last-event-id", "0")
+        after = int(last_event_id) if last_event_id.isdigit() else 0
+    return StreamingResponse(
+        logicHandler.stream_changes(after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@router.post("/import")
+async def import_records(
+    request: Request,
+    format: str = "ndjson",
+    chunk_size: int = Query(1000, ge=1, le=100000),
+):
+    """
+    Import consents, users and grants from the request body, keeping the original
+    times of granting. The body is parsed while it is being received.
+
+    Every line is one record with a type and the fields of that type:
+    - consent: consent_name, validity_seconds
+    - user: username
+    - grant: username, consent_name, granted_at (ISO 8601 time)
+
+    Parameters:
+    - format (str): ndjson for one JSON object per line or csv for lines of values after a header line.
+    - chunk_size (int): Number of records written to the database at once.
+
+    Returns:
+    - dict: Number of records, numbers of imported consents, users and grants and errors of invalid records by line number.
+    """
+    return await logicHandler.import_records(iter_lines(request.stream()), format, chunk_size)
+
+
+@router.post("/audit")
+async def audit_user_consents(
+    request: Request,
+    format: str = "ndjson",
+    chunk_size: int = Query(10000, ge=1, le=100000),
+):
+    """
+    Check if users had given consents at past times, for example for every call of a
+    call log. Rows are checked while the body is being received. The results are kept
+    in a temporary file until the whole body is read and then streamed back as newline
+    delimited JSON in the order of the rows.
+
+    Every line of the body is one row with username, consent_name and at (ISO 8601 time).
+
+    Parameters:
+    - format (str): ndjson for one JSON object per line or csv for lines of values after a header line.
+    - chunk_size (int): Number of rows looked up at once.
+
+    Returns:
+    - Lines of {"row": ..., "username": ..., "consent_name": ..., "at": ..., "valid": ..., "reason": ...} or {"row": ..., "error": ...} for invalid rows.
+    """
+    # Starlette reads from the client while it streams a response, so the body has to be
+    # read before the results are sent
+    results = tempfile.SpooledTemporaryFile(max_size=AUDIT_SPOOL_SIZE)
     try:
-        return logicHandler.check_user_consent_valid(username, consent_name)
-    except ValidationError as e:
-        return HTTPException(status_code=400, detail=e.errors())
-    except HTTPException as e:
-        return e
+        async for chunk in await logicHandler.audit_user_consents(iter_lines(request.stream()), format, chunk_size):
+            results.write(chunk)
+    except BaseException:
+        results.close()
+        raise
+    results.seek(0)
+    return StreamingResponse(read_results(results), media_type="application/x-ndjson")
 
 
-@app.post("/consents/")
-def create_consent_endpoint(consent_name: str, seconds: int = 0, days: int = 0):
+def read_results(results, block_size=65536):
+    """Yield blocks of a results file and close it"""
+    try:
+        while block := results.read(block_size):
+            yield block
+    finally:
+        results.close()
+
+
+@router.post("/consents/check")
+async def check_user_consents_valid_bulk(check: BulkConsentCheck):
+    """
+    Check validity of many consents for many users in one request.
+
+    Parameters:
+    - check (BulkConsentCheck): Lists of usernames and consent names to check.
+
+    Returns:
+    - dict: A matrix of validity statuses and reasons, keyed by username and then by consent name.
+    """
+    return FastJSONResponse(
+        await logicHandler.check_user_consents_valid_bulk(check.usernames, check.consent_names)
+    )
+
+
+@router.post("/policy/check")
+async def check_users_policy_bulk(check: BulkPolicyCheck):
+    """
+    Check one policy for many users in one request.
+
+    Parameters:
+    - check (BulkPolicyCheck): List of usernames and the policy expression.
+
+    Returns:
+    - dict: The policy and whether each user satisfies it with the reason, keyed by username.
+    """
+    return FastJSONResponse(
+        await logicHandler.check_users_policy_bulk(check.usernames, check.policy)
+    )
+
+
+@router.post("/consents/")
+async def create_consent_endpoint(consent_name: str, seconds: int = 0, days: int = 0):
     """
     Register a new consent, so it will be possible to attach it to a user.
 
@@ -94,20 +593,15 @@ def create_consent_endpoint(consent_name: str, seconds: int = 0, days: int = 0):
     Returns:
     - A confirmation message.
     """
-    try:
-        consent = Consent(
-            consent_name=consent_name, validity=timedelta(seconds=seconds, days=days)
-        )
-        logicHandler.create_consent(consent)
-        return {"message": "Consent registered successfully"}
-    except ValidationError as e:
-        return HTTPException(status_code=400, detail=e.errors())
-    except HTTPException as e:
-        return e
+    consent = Consent(
+        consent_name=consent_name, validity=timedelta(seconds=seconds, days=days)
+    )
+    await logicHandler.create_consent(consent)
+    return {"message": "Consent registered successfully"}
 
 
-@app.post("/users/{username}/consents/{consent_name}")
-def add_user_consent_endpoint(username: str, consent_name: str):
+@router.post("/users/{username}/consents/{consent_name}")
+async def add_user_consent_endpoint(username: str, consent_name: str):
     """
     Add a consent to a user.
 
@@ -118,16 +612,12 @@ def add_user_consent_endpoint(username: str, consent_name: str):
     Returns:
     - dict: A confirmation message.
     """
-    try:
-        logicHandler.add_user_consent(username, consent_name)
-        return {"message": "Consent added successfully"}
-    except ValidationError as e:
-        return HTTPException(status_code=400, detail=e.errors())
-    except HTTPException as e:
-        return e
+    await logicHandler.add_user_consent(username, consent_name)
+    return {"message": "Consent added successfully"}
+
 
-@app.delete("/users/{username}/consents/{consent_name}")
-def revoke_user_consent_endpoint(username: str, consent_name: str):
+@router.delete("/users/{username}/consents/{consent_name}")
+async def revoke_user_consent_endpoint(username: str, consent_name: str):
     """
     Revoke a consent from a user.
 
@@ -138,10 +628,8 @@ def revoke_user_consent_endpoint(username: str, consent_name: str):
     Returns:
     - dict: A confirmation message.
     """
-    try:
-        logicHandler.revoke_user_consent(username, consent_name)
-        return {"message": "Consent revoked successfully"}
-    except ValidationError as e:
-        return HTTPException(status_code=400, detail=e.errors())
-    except HTTPException as e:
-        return e
+    await logicHandler.revoke_user_consent(username, consent_name)
+    return {"message": "Consent revoked successfully"}
+
+
+app = create_app()
@@ -0,0 +1,297 @@
+"""
+metrics.py - Request and Call Metrics
+
+This module records latency histograms and error counts of HTTP requests,
+LogicHandler methods and database adapter calls, and renders them together with
+the counters of the verdict cache in the Prometheus text format for the /metrics
+endpoint.
+
+Recording a call costs two clock reads, a bisect and a few dict lookups, so
+metrics can stay on in production.
+
+Classes:
+- Histogram: Latency histogram with fixed buckets.
+- Metrics: All histograms and error counters of the service.
+- TimedAdapter: Asynchronous database adapter wrapper that times every call.
+- MetricsMiddleware: ASGI middleware that times every HTTP request.
+
+"""
+import inspect
+import time
+from bisect import bisect_left
+from functools import wraps
+from fastapi import HTTPException
+
+# Upper bounds of the latency buckets in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Errors are counted by a fixed reason, as details can contain user input and
+# every distinct label value would be a new series kept forever
+REASONS = {"User not found": "user_not_found", "Consent not found": "consent_not_found"}
+STATUS_REASONS = {400: "invalid_input", 404: "not_found", 422: "invalid_input", 501: "not_implemented", 503: "unavailable"}
+
+
+def error_reason(error: HTTPException):
+    """Fixed reason of an HTTP error for its metric label"""
+    reason = REASONS.get(error.detail) if isinstance(error.detail, str) else None
+    if reason is None:
+        reason = STATUS_REASONS.get(error.status_code, "client_error" if error.status_code < 500 else "server_error")
+    return reason
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    return ",".join(f'{name}="{escape(value)}"' for name, value in labels)
+
+
+class Histogram:
+    """
+    Counts of observed durations per bucket, their sum and count.
+    Buckets are stored non-cumulative and summed up when rendered.
+    """
+
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    def render(self, name, labels):
+        lines = []
+        prefix = format_labels(labels)
+        separator = "," if prefix else ""
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{prefix}}} {self.sum}")
+        lines.append(f"{name}_count{{{prefix}}} {cumulative}")
+        return lines
+
+
+class Metrics:
+    """
+    Latency histograms and error counters of HTTP requests, LogicHandler methods
+    and database adapter calls, keyed by their labels. The counters of verdict_cache
+    are rendered with them if a cache is given.
+    """
+
+    def __init__(self, verdict_cache=None):
+        self.verdict_cache = verdict_cache
+        # (method, route, status) -> Histogram
+        self.requests = {}
+        # method name -> Histogram
+        self.logic_calls = {}
+        self.adapter_calls = {}
+        # (method name, status code, reason) -> count, see error_reason
+        self.logic_errors = {}
+        # (method name, exception type) -> count
+        self.adapter_errors = {}
+
+    def observe(self, histograms, key, seconds):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, counters, key):
+        counters[key] = counters.get(key, 0) + 1
+
+    def time_logic_handler(self, logic_handler):
+        """
+        Replace the public coroutine and asynchronous generator methods of the
+        logic handler instance with timed versions.
+        """
+        for name in vars(type(logic_handler)):
+            if name.startswith("_"):
+                continue
+            method = getattr(logic_handler, name)
+            if inspect.iscoroutinefunction(method):
+                setattr(logic_handler, name, self._timed_logic_call(name, method))
+            elif inspect.isasyncgenfunction(method):
+                setattr(logic_handler, name, self._timed_logic_generator(name, method))
+
+    def _record_logic_error(self, name, error):
+        if isinstance(error, HTTPException):
+            self.count(self.logic_errors, (name, error.status_code, error_reason(error)))
+        else:
+            self.count(self.logic_errors, (name, 500, type(error).__name__))
+
+    def _timed_logic_call(self, name, method):
+        @wraps(method)
+        async def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except Exception as e:
+                self._record_logic_error(name, e)
+                raise
+            finally:
+                self.observe(self.logic_calls, name, time.perf_counter() - start)
+
+        return call
+
+    def _timed_logic_generator(self, name, method):
+        # Streams are timed from the first call until they are exhausted
+        @wraps(method)
+        async def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                async for item in method(*args, **kwargs):
+                    yield item
+            except Exception as e:
+                self._record_logic_error(name, e)
+                raise
+            finally:
+                self.observe(self.logic_calls, name, time.perf_counter() - start)
+
+        return call
+
+    def render(self):
+        """Return all metrics in the Prometheus text format"""
+        lines = []
+        histograms = [
+            (
+                "consent_api_http_request_duration_seconds",
+                "Latency of HTTP requests.",
+                self.requests,
+                ("method", "route", "status"),
+            ),
+            (
+                "consent_api_logic_call_duration_seconds",
+                "Latency of LogicHandler methods.",
+                self.logic_calls,
+                ("method",),
+            ),
+            (
+                "consent_api_adapter_call_duration_seconds",
+                "Latency of database adapter calls.",
+                self.adapter_calls,
+                ("method",),
+            ),
+        ]
+        for name, help, histograms_by_key, label_names in histograms:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            # Copied, as requests may add histograms while this one renders
+            for key, histogram in sorted(histograms_by_key.copy().items()):
+                key = key if isinstance(key, tuple) else (key,)
+                lines.extend(histogram.render(name, zip(label_names, key)))
+        counters = [
+            (
+                "consent_api_logic_errors_total",
+                "Errors raised by LogicHandler methods.",
+                self.logic_errors,
+                ("method", "status", "reason"),
+            ),
+            (
+                "consent_api_adapter_errors_total",
+                "Exceptions raised by database adapter calls.",
+                self.adapter_errors,
+                ("method", "exception"),
+            ),
+        ]
+        for name, help, counts, label_names in counters:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} counter")
+            for key, count in sorted(counts.copy().items(), key=lambda item: str(item[0])):
+                lines.append(f"{name}{{{format_labels(zip(label_names, key))}}} {count}")
+        if self.verdict_cache is not None:
+            stats = self.verdict_cache.stats()
+            for counter in ("hits", "misses", "evictions"):
+                name = f"consent_api_verdict_cache_{counter}_total"
+                lines.append(f"# HELP {name} Verdict cache {counter}.")
+                lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name} {stats[counter]}")
+            lines.append("# HELP consent_api_verdict_cache_size Verdicts in the cache.")
+            lines.append("# TYPE consent_api_verdict_cache_size gauge")
+            lines.append(f"consent_api_verdict_cache_size {stats['size']}")
+        return "\n".join(lines) + "\n"
+
+
+class TimedAdapter:
+    """
+    Wraps an asynchronous database adapter and records the latency and exceptions
+    of every call in metrics.
+    """
+
+    def __init__(self, adapter, metrics: Metrics):
+        self.adapter = adapter
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        method = getattr(self.adapter, name)
+        metrics = self.metrics
+        if inspect.isasyncgenfunction(method):
+
+            async def call(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    async for item in method(*args, **kwargs):
+                        yield item
+                except Exception as e:
+                    metrics.count(metrics.adapter_errors, (name, type(e).__name__))
+                    raise
+                finally:
+                    metrics.observe(metrics.adapter_calls, name, time.perf_counter() - start)
+
+        elif inspect.iscoroutinefunction(method):
+
+            async def call(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                except Exception as e:
+                    metrics.count(metrics.adapter_errors, (name, type(e).__name__))
+                    raise
+                finally:
+                    metrics.observe(metrics.adapter_calls, name, time.perf_counter() - start)
+
+        else:
+            return method
+
+        # Cache the wrapper so __getattr__ is called only once per method
+        setattr(self, name, call)
+        return call
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that records the latency of every HTTP request by method, route
+    template and status code. Requests that match no route share one label, so
+    unknown paths do not create new histograms.
+    """
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            self.metrics.observe(
+                self.metrics.requests,
+                (scope["method"], getattr(route, "path", "unmatched"), status),
+                time.perf_counter() - start,
+            )
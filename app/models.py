@@ -1,6 +1,9 @@
 from pydantic import BaseModel, Field
 from datetime import datetime, timedelta
 
+# Models validate data at the request edge. Database adapters build them with
+# model_construct from data they already hold, which skips validation.
+
 class Consent(BaseModel):
     consent_name: str
     validity: timedelta
@@ -9,3 +12,13 @@ class Consent(BaseModel):
 class User(BaseModel):
     username: str
     consents: dict[str, datetime] = {}
+
+
+class BulkConsentCheck(BaseModel):
+    usernames: list[str]
+    consent_names: list[str]
+
+
+class BulkPolicyCheck(BaseModel):
+    usernames: list[str]
+    policy: str
@@ -0,0 +1,237 @@
+"""
+policy.py - Consent Policies
+
+This module parses and compiles consent policies, boolean expressions over the
+consents of a user, so a caller can check several consents with one request.
+
+A consent name holds if the user has a valid grant of that consent. EXPIRED name
+holds if the user has a grant of it that has expired. ANY(...) and ALL(...) hold if
+any or all of the comma separated expressions in them hold. Expressions combine
+with NOT, AND and OR, binding in that order, and parentheses. Keywords are case
+insensitive, a consent named like a keyword is written in double quotes. Examples:
+
+    telemarketing AND NOT EXPIRED promotions
+    ANY(catalogues, promotions)
+    ALL(newsletter, sms) OR "any"
+
+An expression is compiled once into nested functions and the compiled policy is
+cached by its expression string.
+
+Classes:
+- Policy: A compiled consent policy.
+
+Functions:
+- compile_policy(expression): Parse and compile an expression, cached.
+
+"""
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+MAX_EXPRESSION_LENGTH = 1000
+MAX_DEPTH = 32
+KEYWORDS = frozenset(["AND", "OR", "NOT", "ANY", "ALL", "EXPIRED"])
+TOKEN = re.compile(r'\s*(?:([(),])|"(\w+)"|(\w+))')
+
+
+class Policy:
+    """
+    A compiled consent policy. Grants are compared with cutoffs, the oldest time of
+    granting that is still valid for every consent, which are computed once for a
+    point in time and shared by all users checked at that time.
+    """
+
+    def __init__(self, expression: str, consent_names: frozenset, evaluate):
+        self.expression = expression
+        # Names of all consents the policy refers to
+        self.consent_names = consent_names
+        self._evaluate = evaluate
+
+    def cutoffs(self, validities: dict[str, timedelta], now: datetime):
+        """Oldest valid time of granting of every consent of the policy at the given time"""
+        cutoffs = {}
+        for consent_name in self.consent_names:
+            try:
+                cutoffs[consent_name] = now - validities[consent_name]
+            except OverflowError:
+                cutoffs[consent_name] = datetime.min
+        return cutoffs
+
+    def evaluate(self, consents: dict[str, datetime], cutoffs: dict[str, datetime]):
+        """Returns True if a user with the given consents satisfies the policy"""
+        return self._evaluate(consents, cutoffs)
+
+
+def tokenize(expression: str):
+    """Split an expression into punctuation, quoted names and words"""
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None:
+            raise ValueError(f"Unexpected character at position {position}")
+        punctuation, quoted, word = match.groups()
+        if quoted is not None:
+            tokens.append(("name", quoted))
+        elif word is not None and word.upper() in KEYWORDS:
+            tokens.append((word.upper(), word))
+        elif word is not None:
+            tokens.append(("name", word))
+        else:
+            tokens.append((punctuation, punctuation))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser that returns nodes as nested tuples:
+    ("valid", name), ("expired", name), ("not", node), ("and", nodes), ("or", nodes).
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+        self.depth = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def take(self, kind):
+        if self.peek() != kind:
+            found = "end of expression" if self.peek() is None else repr(self.tokens[self.position][1])
+            raise ValueError(f"Expected {kind} but found {found}")
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected {self.tokens[self.position][1]!r}")
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == "OR":
+            self.take("OR")
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.peek() == "AND":
+            self.take("AND")
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_not(self):
+        if self.peek() == "NOT":
+            self.take("NOT")
+            return ("not", self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        kind = self.peek()
+        if kind == "name":
+            return ("valid", self.take("name"))
+        if kind == "EXPIRED":
+            self.take("EXPIRED")
+            return ("expired", self.take("name"))
+        self.depth += 1
+        if self.depth > MAX_DEPTH:
+            raise ValueError(f"Expression is nested deeper than {MAX_DEPTH} levels")
+        if kind in ("ANY", "ALL"):
+            self.take(kind)
+            self.take("(")
+            nodes = [self.parse_or()]
+            while self.peek() == ",":
+                self.take(",")
+                nodes.append(self.parse_or())
+            self.take(")")
+            node = nodes[0] if len(nodes) == 1 else ("or" if kind == "ANY" else "and", nodes)
+        else:
+            self.take("(")
+            node = self.parse_or()
+            self.take(")")
+        self.depth -= 1
+        return node
+
+
+def consent_names_of(node):
+    """Names of all consents a parsed expression refers to"""
+    if node[0] in ("valid", "expired"):
+        return {node[1]}
+    if node[0] == "not":
+        return consent_names_of(node[1])
+    return set().union(*(consent_names_of(child) for child in node[1]))
+
+
+def compile_node(node):
+    """Compile a parsed expression into a function of (consents, cutoffs)"""
+    kind = node[0]
+    if kind == "valid":
+        consent_name = node[1]
+
+        def valid(consents, cutoffs):
+            granted_at = consents.get(consent_name)
+            return granted_at is not None and granted_at >= cutoffs[consent_name]
+
+        return valid
+    if kind == "expired":
+        consent_name = node[1]
+
+        def expired(consents, cutoffs):
+            granted_at = consents.get(consent_name)
+            return granted_at is not None and granted_at < cutoffs[consent_name]
+
+        return expired
+    if kind == "not":
+        operand = compile_node(node[1])
+        return lambda consents, cutoffs: not operand(consents, cutoffs)
+
+    children = node[1]
+    if all(child[0] == "valid" for child in children):
+        # ANY and ALL of plain consents, the common case, check names in one loop
+        consent_names = tuple(child[1] for child in children)
+        if kind == "or":
+
+            def any_valid(consents, cutoffs):
+                for consent_name in consent_names:
+                    granted_at = consents.get(consent_name)
+                    if granted_at is not None and granted_at >= cutoffs[consent_name]:
+                        return True
+                return False
+
+            return any_valid
+
+        def all_valid(consents, cutoffs):
+            for consent_name in consent_names:
+                granted_at = consents.get(consent_name)
+                if granted_at is None or granted_at < cutoffs[consent_name]:
+                    return False
+            return True
+
+        return all_valid
+
+    operands = tuple(compile_node(child) for child in children)
+    if kind == "or":
+        return lambda consents, cutoffs: any(operand(consents, cutoffs) for operand in operands)
+    return lambda consents, cutoffs: all(operand(consents, cutoffs) for operand in operands)
+
+
+@lru_cache(maxsize=1024)
+def compile_policy(expression: str) -> Policy:
+    """
+    Parse and compile a policy expression. Raises ValueError with a description of
+    the problem for invalid expressions.
+    """
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"Expression is longer than {MAX_EXPRESSION_LENGTH} characters")
+    tokens = tokenize(expression)
+    if not tokens:
+        raise ValueError("Expression is empty")
+    node = _Parser(tokens).parse()
+    return Policy(expression, frozenset(consent_names_of(node)), compile_node(node))
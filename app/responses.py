@@ -0,0 +1,32 @@
+"""
+responses.py - Fast JSON Responses
+
+Read endpoints return FastJSONResponse instead of letting FastAPI walk their results
+with jsonable_encoder. The results are encoded with orjson in one pass, models and
+other values orjson does not know are handed to pydantic's serializer. The encoded
+JSON is the same as FastAPI would return.
+
+Classes:
+- FastJSONResponse: JSON response encoded with orjson.
+
+"""
+import json
+from typing import Any
+from fastapi.responses import JSONResponse
+from pydantic_core import to_jsonable_python
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, without it responses are encoded with json
+    orjson = None
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with orjson, or with json if orjson is not installed"""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, default=to_jsonable_python)
+        return json.dumps(
+            content, default=to_jsonable_python, ensure_ascii=False, separators=(",", ":")
+        ).encode()
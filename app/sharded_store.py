@@ -0,0 +1,412 @@
+"""
+sharded_store.py - Sharded Consent Store
+
+This module spreads users over several database adapters, so the data set is not
+bound by the memory and GIL of one process. Shards are usually StoreClients of
+store servers in separate processes, but any synchronous adapter can be a shard.
+
+Every user lives on the shard picked by a stable hash of the username, and calls
+about one user go only to that shard. The small catalogue of consents is written
+to every shard, so each shard checks consents of its users on its own. Calls about
+all users go to every shard, in parallel when shards do blocking I/O, and their
+results are merged in the same order a single adapter returns them.
+
+Archived grants and the history stay on the shard of their user. rebalance()
+copies users with their consents, history and archived grants to a new set of
+shards.
+
+Classes:
+- ShardedDB: Database adapter that routes calls to shards by username.
+
+Functions:
+- shard_of(username, n_shards): Index of the shard of a user.
+- rebalance(source, target, batch_size): Copy all users from one set of shards to another.
+- main(): Rebalance store servers from the command line.
+
+"""
+import argparse
+import heapq
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from .adapters import ConsentLookup
+from .models import Consent, User
+from .store_server import StoreClient, parse_address
+
+# Methods that ShardedDB only has if all of its shards have them
+OPTIONAL_METHODS = frozenset(
+    [
+        "get_user_version",
+        "get_consents_version",
+        "get_archived_user_consents",
+        "get_archived_user_consents_bulk",
+        "archive_expired_grants",
+        "lookup_user_consents_at",
+        "get_user_history_bulk",
+        "restore_user_history",
+    ]
+)
+
+
+def shard_of(username: str, n_shards: int):
+    """Index of the shard of a user, the same in every process unlike hash()"""
+    return zlib.crc32(username.encode()) % n_shards
+
+
+class ShardedDB:
+    """
+    Database adapter over shards, each holding the users whose username hashes to it.
+    """
+
+    def __init__(self, shards):
+        self.shards = list(shards)
+        # Shards that wait for I/O are called in parallel, in-memory shards one after another
+        self.blocking_io = any(getattr(shard, "blocking_io", False) for shard in self.shards)
+        self.blocking_methods = frozenset().union(
+            *(getattr(shard, "blocking_methods", ()) for shard in self.shards)
+        )
+        self.thread_safe = all(
+            getattr(shard, "thread_safe", False) or getattr(shard, "blocking_io", False)
+            for shard in self.shards
+        )
+        self.executor = None
+        if (self.blocking_io or self.blocking_methods) and len(self.shards) > 1:
+            self.executor = ThreadPoolExecutor(len(self.shards), thread_name_prefix="shard")
+
+    def __getattr__(self, name):
+        if name in OPTIONAL_METHODS and all(hasattr(shard, name) for shard in self.shards):
+            return getattr(self, f"_{name}")
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    def close(self):
+        """Close the shards that can be closed"""
+        if self.executor is not None:
+            self.executor.shutdown()
+        for shard in self.shards:
+            if hasattr(shard, "close"):
+                shard.close()
+
+    def _shard(self, username):
+        return self.shards[shard_of(username, len(self.shards))]
+
+    def _run(self, calls):
+        """Results of the calls in their order, made in parallel if shards do I/O"""
+        if (
+            self.executor is None
+            or len(calls) < 2
+            or not (self.blocking_io or calls[0].func.__name__ in self.blocking_methods)
+        ):
+            return [call() for call in calls]
+        return list(self.executor.map(lambda call: call(), calls))
+
+    def _all(self, name, *args):
+        """Results of calling the method on every shard in order of the shards"""
+        return self._run([partial(getattr(shard, name), *args) for shard in self.shards])
+
+    def _by_shard(self, usernames):
+        """Usernames grouped by the index of their shard"""
+        groups = {}
+        for username in usernames:
+            groups.setdefault(shard_of(username, len(self.shards)), []).append(username)
+        return groups
+
+    def get_users(self):
+        "Get all users in the data source"
+        return [username for users in self._all("get_users") for username in users]
+
+    def get_consents(self):
+        """Get all consents in the datasource"""
+        return self.shards[0].get_consents()
+
+    def user_exists(self, username):
+        """Check if user is present in the datasource"""
+        return self._shard(username).user_exists(username)
+
+    def consent_exists(self, consent_name):
+        """Check if consent is present in the datasource"""
+        return self.shards[0].consent_exists(consent_name)
+
+    def get_user_consents(self, username):
+        """Returns all consents of the user"""
+        return self._shard(username).get_user_consents(username)
+
+    def get_user_consents_bulk(self, usernames):
+        """Returns consents of all given users that are present in the datasource"""
+        users = {}
+        for shard_users in self._run(
+            [
+                partial(self.shards[index].get_user_consents_bulk, shard_usernames)
+                for index, shard_usernames in self._by_shard(usernames).items()
+            ]
+        ):
+            users.update(shard_users)
+        return users
+
+    def user_has_consent(self, username, consent_name):
+        """Returns True if user has consent, False otherwise"""
+        return self._shard(username).user_has_consent(username, consent_name)
+
+    def user_has_valid_consent(self, username, consent_name):
+        """Returns True if user has valid consent, False otherwise"""
+        return self._shard(username).user_has_valid_consent(username, consent_name)
+
+    def lookup_user_consent(self, username, consent_name) -> ConsentLookup:
+        """Returns everything needed to check a consent of the user in one call"""
+        return self._shard(username).lookup_user_consent(username, consent_name)
+
+    def _get_user_version(self, username):
+        """
+        Returns a token that changes whenever the consents of the user change,
+        None if the user does not exist.
+        """
+        return self._shard(username).get_user_version(username)
+
+    def _get_consents_version(self):
+        """Returns a token that changes whenever a consent is added or changed"""
+        return self.shards[0].get_consents_version()
+
+    def get_expiring_user_consents(self, consent_name, before, after=None):
+        """
+        Returns (username, expires_on) of all grants of the consent that expire before
+        the given time, ordered by expiry. If after is given only grants that are still
+        valid at that time are returned.
+        """
+        expiring = self._all("get_expiring_user_consents", consent_name, before, after)
+        return list(heapq.merge(*expiring, key=lambda grant: (grant[1], grant[0])))
+
+    def get_consent_stats(self, now, include_expired=False):
+        """
+        Returns the number of valid and expired grants of every consent at the given
+        time and, if include_expired is True, a list of (username, consent_name) of
+        all expired grants.
+        """
+        counts = {}
+        expired = [] if include_expired else None
+        for shard_counts, shard_expired in self._all("get_consent_stats", now, include_expired):
+            for consent_name, shard_count in shard_counts.items():
+                count = counts.setdefault(consent_name, {"valid": 0, "expired": 0})
+                count["valid"] += shard_count["valid"]
+                count["expired"] += shard_count["expired"]
+            if include_expired:
+                expired.extend(shard_expired)
+        return counts, expired
+
+    def get_consent_users(self, consent_name, valid_only=False, after=None, limit=100):
+        """
+        Returns up to limit (username, granted_at) of users that hold the consent,
+        ordered by granting time. If valid_only is True only valid grants are returned.
+        after is the (granted_at, username) of the last grant of the previous page.
+        """
+        pages = self._all("get_consent_users", consent_name, valid_only, after, limit)
+        merged = heapq.merge(*pages, key=lambda grant: (grant[1], grant[0]))
+        return [grant for grant, _ in zip(merged, range(limit))]
+
+    def iter_users(self, since=None, batch_size=1000):
+        """
+        Yields all users in batches of batch_size, shard after shard. If since is
+        given only users whose consents changed at or after that time are yielded.
+        """
+        batch = []
+        for shard in self.shards:
+            for users in shard.iter_users(since, batch_size):
+                batch.extend(users)
+                while len(batch) >= batch_size:
+                    yield batch[:batch_size]
+                    batch = batch[batch_size:]
+        if batch:
+            yield batch
+
+    def _get_archived_user_consents(self, username):
+        """Returns (consent_name, granted_at) of all archived grants of the user in order of archiving"""
+        return self._shard(username).get_archived_user_consents(username)
+
+    def _get_archived_user_consents_bulk(self, usernames):
+        """
+        Returns {consent_name: granted_at} of the latest archived grant of every
+        consent of the given users, for users that have archived grants.
+        """
+        archived = {}
+        for shard_archived in self._run(
+            [
+                partial(self.shards[index].get_archived_user_consents_bulk, shard_usernames)
+                for index, shard_usernames in self._by_shard(usernames).items()
+            ]
+        ):
+            archived.update(shard_archived)
+        return archived
+
+    def _lookup_user_consents_at(self, queries):
+        """
+        Returns a ConsentLookup for every (username, consent_name, at) query, with
+        the grant the user held at that time.
+        """
+        queries = list(queries)
+        positions = {}
+        shard_queries = {}
+        for position, query in enumerate(queries):
+            index = shard_of(query[0], len(self.shards))
+            positions.setdefault(index, []).append(position)
+            shard_queries.setdefault(index, []).append(query)
+        indexes = list(shard_queries)
+        lookups = [None] * len(queries)
+        for index, shard_lookups in zip(
+            indexes,
+            self._run(
+                [partial(self.shards[index].lookup_user_consents_at, shard_queries[index]) for index in indexes]
+            ),
+        ):
+            for position, lookup in zip(positions[index], shard_lookups):
+                lookups[position] = lookup
+        return lookups
+
+    def _get_user_history_bulk(self, usernames):
+        """
+        Returns (events, archived) of the given users that have a history or archived
+        grants, to copy them to another adapter with restore_user_history.
+        """
+        histories = {}
+        for shard_histories in self._run(
+            [
+                partial(self.shards[index].get_user_history_bulk, shard_usernames)
+                for index, shard_usernames in self._by_shard(usernames).items()
+            ]
+        ):
+            histories.update(shard_histories)
+        return histories
+
+    def _restore_user_history(self, histories):
+        """
+        Replace the history and archived grants of users with those returned by
+        get_user_history_bulk. Current consents are not changed.
+        """
+        shard_histories = {}
+        for username, history in histories.items():
+            shard_histories.setdefault(shard_of(username, len(self.shards)), {})[username] = history
+        self._run(
+            [
+                partial(self.shards[index].restore_user_history, shard_history)
+                for index, shard_history in shard_histories.items()
+            ]
+        )
+
+    def _archive_expired_grants(self, before, limit=1000):
+        """
+        Move up to limit grants that expired before the given time to the archive and
+        return how many were moved. Shards are swept one after another until limit
+        grants were moved, so a call takes as long as it would on one adapter.
+        """
+        moved = 0
+        for shard in self.shards:
+            if moved >= limit:
+                break
+            moved += shard.archive_expired_grants(before, limit - moved)
+        return moved
+
+    def add_consent(self, consent: Consent):
+        """
+        Add a new consent to every shard.
+        """
+        self._all("add_consent", consent)
+
+    def add_user(self, user: User):
+        """
+        Add a user together with consents they already granted.
+        """
+        self._shard(user.username).add_user(user)
+
+    def bulk_write(self, consents=(), usernames=(), grants=()):
+        """
+        Write many consents, users and grants at once, in that order.
+        Users that already exist keep their consents. grants are
+        (username, consent_name, granted_at) tuples.
+        Consents are written to every shard, users and grants to their shards.
+        """
+        consents = list(consents)
+        shard_usernames = self._by_shard(usernames)
+        shard_grants = {}
+        for grant in grants:
+            shard_grants.setdefault(shard_of(grant[0], len(self.shards)), []).append(grant)
+        self._run(
+            [
+                partial(
+                    shard.bulk_write,
+                    consents=consents,
+                    usernames=shard_usernames.get(index, ()),
+                    grants=shard_grants.get(index, ()),
+                )
+                for index, shard in enumerate(self.shards)
+                if consents or index in shard_usernames or index in shard_grants
+            ]
+        )
+
+    def add_user_consent(self, username, consent_name):
+        """
+        Add a consent to user.
+        """
+        self._shard(username).add_user_consent(username, consent_name)
+
+    def revoke_user_consent(self, username, consent_name):
+        """
+        Revoke a consent from user.
+        """
+        self._shard(username).revoke_user_consent(username, consent_name)
+
+
+def rebalance(source, target, batch_size=10000):
+    """
+    Copy the consents and all users with their consents, history and archived grants
+    from the shards of source to the shards of target, which may have a different
+    number of shards. Writes to source have to be stopped while it runs. Returns the
+    number of copied users. Raises ValueError if source keeps a history that target
+    cannot keep, before anything is copied.
+    """
+    copy_history = hasattr(source, "get_user_history_bulk")
+    if copy_history and not hasattr(target, "restore_user_history"):
+        raise ValueError("Target shards cannot keep the history and archived grants of source")
+    target.bulk_write(consents=list(source.get_consents().values()))
+    n_users = 0
+    for users in source.iter_users(batch_size=batch_size):
+        usernames = [user.username for user in users]
+        target.bulk_write(
+            usernames=usernames,
+            grants=[
+                (user.username, consent_name, granted_at)
+                for user in users
+                for consent_name, granted_at in user.consents.items()
+            ],
+        )
+        # Replaces the history bulk_write started from the current grants
+        if copy_history:
+            target.restore_user_history(source.get_user_history_bulk(usernames))
+        n_users += len(users)
+    return n_users
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy all users from one set of store servers to another set with a "
+        "different number of shards. The connection key is read from CONSENT_API_STORE_AUTHKEY."
+    )
+    parser.add_argument(
+        "--source", nargs="+", required=True, help="Addresses of the current store servers"
+    )
+    parser.add_argument(
+        "--target", nargs="+", required=True, help="Addresses of the new, empty store servers"
+    )
+    parser.add_argument("--batch-size", type=int, default=10000, help="Users copied at once")
+    args = parser.parse_args()
+
+    authkey = os.environ.get("CONSENT_API_STORE_AUTHKEY")
+    if not authkey:
+        parser.error("CONSENT_API_STORE_AUTHKEY has to be set")
+    source = ShardedDB(StoreClient(parse_address(address), authkey.encode()) for address in args.source)
+    target = ShardedDB(StoreClient(parse_address(address), authkey.encode()) for address in args.target)
+    n_users = rebalance(source, target, args.batch_size)
+    print(f"Copied {n_users} users from {len(source.shards)} to {len(target.shards)} shards")
+    source.close()
+    target.close()
+
+
+if __name__ == "__main__":
+    main()
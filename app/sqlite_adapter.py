@@ -0,0 +1,374 @@
+"""
+sqlite_adapter.py - SQLite Data Persistence
+
+This module handles data persistence using an SQLite database file.
+
+Classes:
+- SQLiteAdapter: SQLite database adapter with the same methods as DBMockup.
+
+"""
+import sqlite3
+import threading
+from datetime import datetime
+from .adapters import ConsentLookup
+from .database_mockup import MICROSECOND, DBMockup, from_micros, to_micros, valid_since_micros
+from .models import Consent, User
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS consents (
+    consent_name TEXT PRIMARY KEY,
+    validity INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    changed_at INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_consents (
+    username TEXT NOT NULL,
+    consent_name TEXT NOT NULL,
+    granted_at INTEGER NOT NULL,
+    PRIMARY KEY (username, consent_name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS user_consents_by_granted_at
+    ON user_consents (consent_name, granted_at, username);
+"""
+
+
+class SQLiteAdapter:
+    """
+    SQLite database for storing consents and user data.
+
+    The database is opened in WAL mode so readers in other processes are not blocked
+    by writes. Grants are indexed by (username, consent_name) and by
+    (consent_name, granted_at), which is also their expiry order within a consent.
+    """
+
+    # Calls block on disk I/O, so LogicHandler runs them in the threadpool
+    blocking_io = True
+
+    def __init__(self, path="consents.db", create_sample_data=False):
+        self.path = path
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, cached_statements=256
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self._migrate()
+        self.lock = threading.Lock()
+        if create_sample_data and not self.get_consents():
+            self.initialize_data()
+
+    def initialize_data(self):
+        """Fill the database with the same sample data as DBMockup"""
+        DBMockup.initialize_data(self)
+
+    def close(self):
+        self.connection.close()
+
+    def _migrate(self):
+        """Add columns missing in databases created by older versions"""
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(users)")]
+        if "changed_at" not in columns:
+            # Changes before the upgrade are unknown, so all users count as changed now
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.execute("ALTER TABLE users ADD COLUMN changed_at INTEGER NOT NULL DEFAULT 0")
+                self.connection.execute("UPDATE users SET changed_at = ?", (to_micros(datetime.now()),))
+
+    def _fetchone(self, query, parameters=()):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchone()
+
+    def _fetchall(self, query, parameters=()):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def get_users(self):
+        "Get all users in the data source"
+        return [username for username, in self._fetchall("SELECT username FROM users")]
+
+    def get_consents(self):
+        """Get all consents in the datasource"""
+        return {
+            consent_name: Consent.model_construct(
+                consent_name=consent_name, validity=validity * MICROSECOND
+            )
+            for consent_name, validity in self._fetchall(
+                "SELECT consent_name, validity FROM consents"
+            )
+        }
+
+    def user_exists(self, username):
+        """Check if user is present in the datasource"""
+        return self._fetchone("SELECT 1 FROM users WHERE username = ?", (username,)) is not None
+
+    def consent_exists(self, consent_name):
+        """Check if consent is present in the datasource"""
+        row = self._fetchone("SELECT 1 FROM consents WHERE consent_name = ?", (consent_name,))
+        return row is not None
+
+    def get_user_consents(self, username):
+        """Returns all consents of the user"""
+        users = self.get_user_consents_bulk([username])
+        if username not in users:
+            raise KeyError(username)
+        return users[username]
+
+    def get_user_consents_bulk(self, usernames):
+        """Returns consents of all given users that are present in the datasource"""
+        usernames = list(dict.fromkeys(usernames))
+        users = {}
+        with self.lock:
+            # Stay well below the SQLite limit on the number of query parameters
+            for start in range(0, len(usernames), 500):
+                chunk = usernames[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for (username,) in self.connection.execute(
+                    f"SELECT username FROM users WHERE username IN ({placeholders})", chunk
+                ):
+                    users[username] = {}
+                for username, consent_name, granted_at in self.connection.execute(
+                    "SELECT username, consent_name, granted_at FROM user_consents"
+                    f" WHERE username IN ({placeholders})",
+                    chunk,
+                ):
+                    users[username][consent_name] = from_micros(granted_at)
+        return {
+            username: User.model_construct(username=username, consents=consents)
+            for username, consents in users.items()
+        }
+
+    def user_has_consent(self, username, consent_name):
+        """Returns True if user has consent, False otherwise"""
+        row = self._fetchone(
+            "SELECT EXISTS (SELECT 1 FROM users WHERE username = ?),"
+            " EXISTS (SELECT 1 FROM user_consents WHERE username = ? AND consent_name = ?)",
+            (username, username, consent_name),
+        )
+        if not row[0]:
+            raise KeyError(username)
+        return bool(row[1])
+
+    def user_has_valid_consent(self, username, consent_name):
+        """Returns True if user has valid consent, False otherwise"""
+        row = self._fetchone(
+            "SELECT user_consents.granted_at + consents.validity"
+            " FROM user_consents JOIN consents USING (consent_name)"
+            " WHERE user_consents.username = ? AND user_consents.consent_name = ?",
+            (username, consent_name),
+        )
+        if row is None:
+            raise KeyError((username, consent_name))
+        return to_micros(datetime.now()) <= row[0]
+
+    def lookup_user_consent(self, username, consent_name):
+        """Returns everything needed to check a consent of the user in one query"""
+        user_exists, validity, granted_at = self._fetchone(
+            "SELECT EXISTS (SELECT 1 FROM users WHERE username = ?),"
+            " (SELECT validity FROM consents WHERE consent_name = ?),"
+            " (SELECT granted_at FROM user_consents WHERE username = ? AND consent_name = ?)",
+            (username, consent_name, username, consent_name),
+        )
+        return ConsentLookup(
+            user_exists=bool(user_exists),
+            consent_exists=validity is not None,
+            granted_at=None if granted_at is None else from_micros(granted_at),
+            validity=None if validity is None else validity * MICROSECOND,
+        )
+
+    def get_expiring_user_consents(self, consent_name, before, after=None):
+        """
+        Returns (username, expires_on) of all grants of the consent that expire before
+        the given time, ordered by expiry. If after is given only grants that are still
+        valid at that time are returned.
+        """
+        validity = self._get_validity(consent_name)
+        start = -(2**63) if after is None else valid_since_micros(to_micros(after), validity)
+        rows = self._fetchall(
+            "SELECT username, granted_at FROM user_consents"
+            " WHERE consent_name = ? AND granted_at >= ? AND granted_at < ?"
+            " ORDER BY granted_at, username",
+            (consent_name, start, valid_since_micros(to_micros(before), validity)),
+        )
+        return [(username, from_micros(granted_at + validity)) for username, granted_at in rows]
+
+    def get_consent_stats(self, now, include_expired=False):
+        """
+        Returns the number of valid and expired grants of every consent at the given
+        time and, if include_expired is True, a list of (username, consent_name) of
+        all expired grants.
+        """
+        now = to_micros(now)
+        rows = self._fetchall(
+            "SELECT consents.consent_name,"
+            " COUNT(user_consents.granted_at),"
+            " COALESCE(SUM(user_consents.granted_at + consents.validity < ?), 0)"
+            " FROM consents LEFT JOIN user_consents USING (consent_name)"
+            " GROUP BY consents.consent_name",
+            (now,),
+        )
+        counts = {
+            consent_name: {"valid": n_grants - n_expired, "expired": n_expired}
+            for consent_name, n_grants, n_expired in rows
+        }
+        expired = None
+        if include_expired:
+            expired = self._fetchall(
+                "SELECT user_consents.username, user_consents.consent_name"
+                " FROM user_consents JOIN consents USING (consent_name)"
+                " WHERE user_consents.granted_at + consents.validity < ?",
+                (now,),
+            )
+        return counts, expired
+
+    def get_consent_users(self, consent_name, valid_only=False, after=None, limit=100):
+        """
+        Returns up to limit (username, granted_at) of users that hold the consent,
+        ordered by granting time. If valid_only is True only valid grants are returned.
+        after is the (granted_at, username) of the last grant of the previous page.
+        """
+        validity = self._get_validity(consent_name)
+        start = valid_since_micros(to_micros(datetime.now()), validity) if valid_only else -(2**63)
+        after_granted_at, after_username = (-(2**63), "") if after is None else (
+            to_micros(after[0]),
+            after[1],
+        )
+        rows = self._fetchall(
+            "SELECT username, granted_at FROM user_consents"
+            " WHERE consent_name = ? AND granted_at >= ? AND (granted_at, username) > (?, ?)"
+            " ORDER BY granted_at, username LIMIT ?",
+            (consent_name, start, after_granted_at, after_username, limit),
+        )
+        return [(username, from_micros(granted_at)) for username, granted_at in rows]
+
+    def iter_users(self, since=None, batch_size=1000):
+        """
+        Yields all users in batches of batch_size. If since is given only users
+        whose consents were granted or revoked at or after that time are yielded.
+        Batches are read by username ranges, so no read transaction stays open
+        between batches.
+        """
+        last_username = ""
+        while True:
+            if since is None:
+                rows = self._fetchall(
+                    "SELECT username FROM users WHERE username > ? ORDER BY username LIMIT ?",
+                    (last_username, batch_size),
+                )
+            else:
+                rows = self._fetchall(
+                    "SELECT username FROM users"
+                    " WHERE username > ? AND changed_at >= ? ORDER BY username LIMIT ?",
+                    (last_username, to_micros(since), batch_size),
+                )
+            if not rows:
+                return
+            usernames = [username for username, in rows]
+            users = self.get_user_consents_bulk(usernames)
+            yield [users[username] for username in usernames if username in users]
+            last_username = usernames[-1]
+
+    def _get_validity(self, consent_name):
+        row = self._fetchone("SELECT validity FROM consents WHERE consent_name = ?", (consent_name,))
+        if row is None:
+            raise KeyError(consent_name)
+        return row[0]
+
+    def add_consent(self, consent: Consent):
+        """
+        Add a new consent to the database.
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO consents (consent_name, validity) VALUES (?, ?)"
+                " ON CONFLICT (consent_name) DO UPDATE SET validity = excluded.validity",
+                (consent.consent_name, consent.validity // MICROSECOND),
+            )
+
+    def add_user(self, user: User):
+        """
+        Add a user together with consents they already granted.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute(
+                "INSERT INTO users (username, changed_at) VALUES (?, ?)"
+                " ON CONFLICT (username) DO UPDATE SET changed_at = excluded.changed_at",
+                (user.username, to_micros(datetime.now())),
+            )
+            self.connection.execute(
+                "DELETE FROM user_consents WHERE username = ?", (user.username,)
+            )
+            self.connection.executemany(
+                "INSERT INTO user_consents (username, consent_name, granted_at) VALUES (?, ?, ?)",
+                [
+                    (user.username, consent_name, to_micros(granted_at))
+                    for consent_name, granted_at in user.consents.items()
+                ],
+            )
+
+    def bulk_write(self, consents=(), usernames=(), grants=()):
+        """
+        Write many consents, users and grants at once, in that order, in one transaction.
+        Users that already exist keep their consents. grants are
+        (username, consent_name, granted_at) tuples.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT INTO consents (consent_name, validity) VALUES (?, ?)"
+                " ON CONFLICT (consent_name) DO UPDATE SET validity = excluded.validity",
+                [(consent.consent_name, consent.validity // MICROSECOND) for consent in consents],
+            )
+            now = to_micros(datetime.now())
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO users (username, changed_at) VALUES (?, ?)",
+                [(username, now) for username in usernames],
+            )
+            self.connection.executemany(
+                "INSERT INTO user_consents (username, consent_name, granted_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (username, consent_name) DO UPDATE SET granted_at = excluded.granted_at",
+                [
+                    (username, consent_name, to_micros(granted_at))
+                    for username, consent_name, granted_at in grants
+                ],
+            )
+            self.connection.executemany(
+                "UPDATE users SET changed_at = ? WHERE username = ?",
+                [(now, username) for username in {username for username, _, _ in grants}],
+            )
+
+    def add_user_consent(self, username, consent_name):
+        """
+        Add a consent to user.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            now = to_micros(datetime.now())
+            if self.connection.execute(
+                "UPDATE users SET changed_at = ? WHERE username = ?", (now, username)
+            ).rowcount == 0:
+                raise KeyError(username)
+            self.connection.execute(
+                "INSERT INTO user_consents (username, consent_name, granted_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (username, consent_name) DO UPDATE SET granted_at = excluded.granted_at",
+                (username, consent_name, now),
+            )
+
+    def revoke_user_consent(self, username, consent_name):
+        """
+        Revoke a consent from user.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            cursor = self.connection.execute(
+                "DELETE FROM user_consents WHERE username = ? AND consent_name = ?",
+                (username, consent_name),
+            )
+            if cursor.rowcount == 0:
+                raise KeyError((username, consent_name))
+            self.connection.execute(
+                "UPDATE users SET changed_at = ? WHERE username = ?",
+                (to_micros(datetime.now()), username),
+            )
@@ -0,0 +1,413 @@
+"""
+store_server.py - Shared Store for Multiple Workers
+
+Every uvicorn worker is a separate process, so with an in-memory database each
+worker would have its own copy of the data. This module keeps a single database in
+a store server process and gives every worker a client adapter that forwards calls
+to it over local connections, so all workers see the same consents and grants.
+
+Calls and results are pickled over multiprocessing connections. Connections are
+authenticated with a shared key, so only processes that know it can connect.
+
+Classes:
+- StoreServer: Serves a database adapter to store clients.
+- StoreClient: Database adapter that forwards calls to a StoreServer over pooled connections.
+
+Functions:
+- parse_address(address): Parse "host:port" or a Unix socket path.
+- main(): Run a store server from the command line.
+
+"""
+import argparse
+import os
+import pickle
+import queue
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from .database_mockup import DBMockup
+from .journal import JournaledDBMockup
+from .models import Consent, User
+
+# Raised by Connection.send for objects that can not be pickled, before anything is sent
+PICKLING_ERRORS = (pickle.PicklingError, TypeError, AttributeError)
+
+# Methods of the served adapter that clients may call
+METHODS = frozenset(
+    [
+        "get_users",
+        "get_consents",
+        "user_exists",
+        "consent_exists",
+        "get_user_consents",
+        "get_user_consents_bulk",
+        "user_has_consent",
+        "user_has_valid_consent",
+        "lookup_user_consent",
+        "get_user_version",
+        "get_consents_version",
+        "get_expiring_user_consents",
+        "get_consent_stats",
+        "get_consent_users",
+        "get_archived_user_consents",
+        "get_archived_user_consents_bulk",
+        "lookup_user_consents_at",
+        "get_user_history_bulk",
+        "iter_users",
+        "add_consent",
+        "add_user",
+        "bulk_write",
+        "add_user_consent",
+        "revoke_user_consent",
+        "archive_expired_grants",
+        "restore_user_history",
+    ]
+)
+
+
+def parse_address(address: str):
+    """Parse "host:port" into a TCP address, anything else is a Unix socket path"""
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return host, int(port)
+    return address
+
+
+class StoreServer:
+    """
+    Serves a database adapter to StoreClients, one thread per connection.
+
+    Calls to adapters that are not thread safe, such as ColumnarDB, are serialized
+    with a lock, as they would be on a single event loop. Adapters with
+    thread_safe = True or blocking_io = True already handle concurrent calls and are
+    called without it, so reads of a DBMockup run concurrently with writes and
+    writers to a JournaledDBMockup still share group commits.
+    """
+
+    def __init__(self, database_adapter, address, authkey: bytes):
+        self.database_adapter = database_adapter
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.lock = None
+        if not (
+            getattr(database_adapter, "thread_safe", False)
+            or getattr(database_adapter, "blocking_io", False)
+        ):
+            self.lock = threading.Lock()
+        self.closing = False
+
+    def serve_forever(self):
+        """Accept connections until close() is called"""
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (AuthenticationError, OSError):
+                # Failed authentication or the listener was closed
+                if self.closing:
+                    return
+                continue
+            if self.closing:
+                connection.close()
+                return
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def close(self):
+        """Stop accepting connections"""
+        self.closing = True
+        # Wake up accept() with a connection of our own
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+        self.listener.close()
+
+    def _run(self, function, *args, **kwargs):
+        if self.lock is None:
+            return function(*args, **kwargs)
+        with self.lock:
+            return function(*args, **kwargs)
+
+    def _serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    name, args, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if name not in METHODS:
+                        raise AttributeError(f"Store has no method {name!r}")
+                    method = getattr(self.database_adapter, name)
+                    if name == "iter_users":
+                        # Batches are sent one message each, followed by the end of iteration
+                        iterator = self._run(method, *args, **kwargs)
+                        for batch in iter(lambda: self._run(next, iterator, None), None):
+                            if not self._send(connection, ("item", batch)):
+                                return
+                        result = None
+                    else:
+                        result = self._run(method, *args, **kwargs)
+                except Exception as e:
+                    if not self._send_error(connection, e):
+                        return
+                    continue
+                try:
+                    sent = self._send(connection, ("ok", result))
+                except PICKLING_ERRORS as e:
+                    sent = self._send_error(connection, e)
+                if not sent:
+                    return
+
+    def _send(self, connection, message):
+        """Send a message, return False if the client has disconnected"""
+        try:
+            connection.send(message)
+        except (EOFError, OSError):
+            return False
+        return True
+
+    def _send_error(self, connection, error):
+        try:
+            return self._send(connection, ("error", error))
+        except PICKLING_ERRORS:
+            # The exception itself can not be pickled
+            return self._send(connection, ("error", RuntimeError(repr(error))))
+
+
+class StoreClient:
+    """
+    Database adapter with the same methods as DBMockup that forwards every call to
+    a StoreServer. Connections are reused from a pool, so concurrent calls from the
+    threadpool each get their own connection without connecting for every call.
+    """
+
+    # Calls wait for the store server, so LogicHandler runs them in the threadpool
+    blocking_io = True
+
+    def __init__(self, address, authkey: bytes, pool_size=16):
+        self.address = address
+        self.authkey = authkey
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+
+    def close(self):
+        """Close all pooled connections"""
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _acquire(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return Client(self.address, authkey=self.authkey)
+
+    def _release(self, connection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _call(self, name, *args, **kwargs):
+        connection = self._acquire()
+        try:
+            connection.send((name, args, kwargs))
+            status, value = connection.recv()
+        except BaseException:
+            # The connection may be left in the middle of a call
+            connection.close()
+            raise
+        self._release(connection)
+        if status == "error":
+            raise value
+        return value
+
+    def get_users(self):
+        "Get all users in the data source"
+        return self._call("get_users")
+
+    def get_consents(self):
+        """Get all consents in the datasource"""
+        return self._call("get_consents")
+
+    def user_exists(self, username):
+        """Check if user is present in the datasource"""
+        return self._call("user_exists", username)
+
+    def consent_exists(self, consent_name):
+        """Check if consent is present in the datasource"""
+        return self._call("consent_exists", consent_name)
+
+    def get_user_consents(self, username):
+        """Returns all consents of the user"""
+        return self._call("get_user_consents", username)
+
+    def get_user_consents_bulk(self, usernames):
+        """Returns consents of all given users that are present in the datasource"""
+        return self._call("get_user_consents_bulk", usernames)
+
+    def user_has_consent(self, username, consent_name):
+        """Returns True if user has consent, False otherwise"""
+        return self._call("user_has_consent", username, consent_name)
+
+    def user_has_valid_consent(self, username, consent_name):
+        """Returns True if user has valid consent, False otherwise"""
+        return self._call("user_has_valid_consent", username, consent_name)
+
+    def lookup_user_consent(self, username, consent_name):
+        """Returns everything needed to check a consent of the user in one call"""
+        return self._call("lookup_user_consent", username, consent_name)
+
+    def get_user_version(self, username):
+        """
+        Returns a token that changes whenever the consents of the user change,
+        None if the user does not exist.
+        """
+        return self._call("get_user_version", username)
+
+    def get_consents_version(self):
+        """Returns a token that changes whenever a consent is added or changed"""
+        return self._call("get_consents_version")
+
+    def get_expiring_user_consents(self, consent_name, before, after=None):
+        """
+        Returns (username, expires_on) of all grants of the consent that expire before
+        the given time, ordered by expiry.
+        """
+        return self._call("get_expiring_user_consents", consent_name, before, after)
+
+    def get_consent_stats(self, now, include_expired=False):
+        """
+        Returns the number of valid and expired grants of every consent at the given
+        time and optionally a list of (username, consent_name) of all expired grants.
+        """
+        return self._call("get_consent_stats", now, include_expired)
+
+    def get_consent_users(self, consent_name, valid_only=False, after=None, limit=100):
+        """
+        Returns up to limit (username, granted_at) of users that hold the consent,
+        ordered by granting time.
+        """
+        return self._call("get_consent_users", consent_name, valid_only, after, limit)
+
+    def get_archived_user_consents(self, username):
+        """Returns (consent_name, granted_at) of all archived grants of the user in order of archiving"""
+        return self._call("get_archived_user_consents", username)
+
+    def get_archived_user_consents_bulk(self, usernames):
+        """
+        Returns {consent_name: granted_at} of the latest archived grant of every
+        consent of the given users, for users that have archived grants.
+        """
+        return self._call("get_archived_user_consents_bulk", list(usernames))
+
+    def lookup_user_consents_at(self, queries):
+        """
+        Returns a ConsentLookup for every (username, consent_name, at) query, with
+        the grant the user held at that time.
+        """
+        return self._call("lookup_user_consents_at", queries)
+
+    def get_user_history_bulk(self, usernames):
+        """
+        Returns (events, archived) of the given users that have a history or archived
+        grants, to copy them to another adapter with restore_user_history.
+        """
+        return self._call("get_user_history_bulk", list(usernames))
+
+    def iter_users(self, since=None, batch_size=1000):
+        """
+        Yields all users in batches of batch_size. If since is given only users
+        whose consents changed at or after that time are yielded.
+        """
+        connection = self._acquire()
+        try:
+            connection.send(("iter_users", (since, batch_size), {}))
+            while True:
+                status, value = connection.recv()
+                if status != "item":
+                    break
+                yield value
+        except BaseException:
+            # Also when the caller stops early, the rest of the batches is still on the way
+            connection.close()
+            raise
+        self._release(connection)
+        if status == "error":
+            raise value
+
+    def add_consent(self, consent: Consent):
+        """
+        Add a new consent to the database.
+        """
+        self._call("add_consent", consent)
+
+    def add_user(self, user: User):
+        """
+        Add a user together with consents they already granted.
+        """
+        self._call("add_user", user)
+
+    def bulk_write(self, consents=(), usernames=(), grants=()):
+        """
+        Write many consents, users and grants at once, in that order.
+        Users that already exist keep their consents. grants are
+        (username, consent_name, granted_at) tuples.
+        """
+        self._call("bulk_write", list(consents), list(usernames), list(grants))
+
+    def add_user_consent(self, username, consent_name):
+        """
+        Add a consent to user.
+        """
+        self._call("add_user_consent", username, consent_name)
+
+    def revoke_user_consent(self, username, consent_name):
+        """
+        Revoke a consent from user.
+        """
+        self._call("revoke_user_consent", username, consent_name)
+
+    def archive_expired_grants(self, before, limit=1000):
+        """
+        Move up to limit grants that expired before the given time to the archive and
+        return how many were moved.
+        """
+        return self._call("archive_expired_grants", before, limit)
+
+    def restore_user_history(self, histories):
+        """
+        Replace the history and archived grants of users with those returned by
+        get_user_history_bulk. Current consents are not changed.
+        """
+        self._call("restore_user_history", histories)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve one consent database to all workers of the consent API. "
+        "The connection key is read from CONSENT_API_STORE_AUTHKEY."
+    )
+    parser.add_argument(
+        "--address", default="127.0.0.1:8765", help="host:port or path of a Unix socket"
+    )
+    parser.add_argument("--journal", help="Journal directory to keep the data across restarts")
+    parser.add_argument("--sample-data", action="store_true", help="Start with the sample data")
+    args = parser.parse_args()
+
+    authkey = os.environ.get("CONSENT_API_STORE_AUTHKEY")
+    if not authkey:
+        parser.error("CONSENT_API_STORE_AUTHKEY has to be set")
+    if args.journal:
+        database_adapter = JournaledDBMockup(args.journal, create_sample_data=args.sample_data)
+    else:
+        database_adapter = DBMockup(create_sample_data=args.sample_data)
+    server = StoreServer(database_adapter, parse_address(args.address), authkey.encode())
+    print(f"Serving consent store on {args.address}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
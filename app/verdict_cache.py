@@ -0,0 +1,99 @@
+"""
+verdict_cache.py - Consent Verdict Cache
+
+This module contains a bounded cache for results of consent validity checks.
+
+Classes:
+- VerdictCache: LRU cache of consent check verdicts with a time to live.
+
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+
+class VerdictCache:
+    """
+    LRU cache of consent check verdicts keyed by (username, consent_name).
+
+    Entries live for at most ttl and never longer than the checked grant stays valid,
+    so a cached positive verdict cannot outlive the grant's expiry. Verdicts change
+    otherwise only when data changes, so LogicHandler invalidates the key of every
+    grant it adds or revokes and all keys of a consent it (re)creates.
+    """
+
+    def __init__(self, maxsize: int = 100000, ttl: timedelta = timedelta(seconds=30)):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # (username, consent_name) -> (verdict, expires_on, consent generation)
+        self.entries = OrderedDict()
+        # Recreating a consent bumps its generation, which invalidates all its entries at once
+        self.consent_generations = {}
+        # Bumped on every invalidation, so a verdict computed before it is not stored
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, username: str, consent_name: str, now: datetime) -> Optional[dict]:
+        """Return the cached verdict or None if there is no fresh one"""
+        key = (username, consent_name)
+        entry = self.entries.get(key)
+        if entry is not None:
+            verdict, expires_on, generation = entry
+            if now <= expires_on and generation == self.consent_generations.get(consent_name, 0):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(verdict)
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(
+        self,
+        username: str,
+        consent_name: str,
+        verdict: dict,
+        now: datetime,
+        valid_until: Optional[datetime] = None,
+        version: Optional[int] = None,
+    ):
+        """
+        Store a verdict computed at now. valid_until is the expiry of the checked grant
+        if it is valid. version is the cache version read before the verdict was
+        computed, if an invalidation happened since then the verdict is not stored.
+        """
+        if version is not None and version != self.version:
+            return
+        expires_on = now + self.ttl
+        if valid_until is not None and valid_until < expires_on:
+            expires_on = valid_until
+        key = (username, consent_name)
+        self.entries[key] = (dict(verdict), expires_on, self.consent_generations.get(consent_name, 0))
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, username: str, consent_name: str):
+        """Drop the verdict of one user's consent"""
+        self.version += 1
+        self.invalidations += 1
+        self.entries.pop((username, consent_name), None)
+
+    def invalidate_consent(self, consent_name: str):
+        """Drop verdicts of all users for a consent"""
+        self.version += 1
+        self.invalidations += 1
+        self.consent_generations[consent_name] = self.consent_generations.get(consent_name, 0) + 1
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
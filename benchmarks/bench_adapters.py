@@ -0,0 +1,70 @@
+"""
+bench_adapters.py - Database Adapter Throughput Benchmark
+
+Measures throughput of the most common operations on every database adapter.
+
+Usage:
+    python -m benchmarks.bench_adapters [n_users]
+
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from app.columnar_store import ColumnarDB
+from app.database_mockup import DBMockup
+from app.logic_handler import LogicHandler
+from app.sqlite_adapter import SQLiteAdapter
+from benchmarks.common import CONSENT_NAMES, measure, populate_database
+
+
+def run_operations(name, database_adapter, n_users, n_operations=20000):
+    start = time.perf_counter()
+    populate_database(database_adapter, n_users)
+    elapsed = time.perf_counter() - start
+    print(f"{name}")
+    print(f"  {'add_user':28s} {n_users / elapsed:12.0f} ops/s")
+
+    rng = random.Random(1)
+    pairs = [
+        (f"user{rng.randrange(n_users)}", rng.choice(CONSENT_NAMES)) for _ in range(n_operations)
+    ]
+    logic_handler = LogicHandler(database_adapter)
+
+    def run_sync(operation):
+        for username, consent_name in pairs:
+            try:
+                operation(username, consent_name)
+            except KeyError:
+                pass
+
+    async def run_async(operation):
+        for username, consent_name in pairs:
+            await operation(username, consent_name)
+
+    operations = [
+        ("user_has_consent", lambda: run_sync(database_adapter.user_has_consent)),
+        (
+            "check_user_consent_valid",
+            lambda: asyncio.run(run_async(logic_handler.check_user_consent_valid)),
+        ),
+        ("add_user_consent", lambda: run_sync(database_adapter.add_user_consent)),
+        ("revoke_user_consent", lambda: run_sync(database_adapter.revoke_user_consent)),
+    ]
+    for operation_name, operation in operations:
+        elapsed = measure(operation)
+        print(f"  {operation_name:28s} {n_operations / elapsed:12.0f} ops/s")
+
+def main_benchmark(n_users=100000):
+    run_operations("DBMockup", DBMockup(), n_users)
+    run_operations("ColumnarDB", ColumnarDB(), n_users)
+    with tempfile.TemporaryDirectory() as directory:
+        database_adapter = SQLiteAdapter(os.path.join(directory, "consents.db"))
+        run_operations("SQLiteAdapter", database_adapter, n_users)
+        database_adapter.close()
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,66 @@
+"""
+bench_bulk_check.py - Bulk Consent Check Benchmark
+
+Compares checking a users x consents matrix one pair at a time with the bulk check,
+both directly on the LogicHandler and through the HTTP endpoints.
+
+Usage:
+    python -m benchmarks.bench_bulk_check [n_users]
+
+"""
+import asyncio
+import sys
+from fastapi.testclient import TestClient
+from app import main
+from app.database_mockup import DBMockup
+from app.logic_handler import LogicHandler
+from benchmarks.common import CONSENT_NAMES, measure, populate_database
+
+
+def main_benchmark(n_users=10000, http_users=500):
+    database_adapter = DBMockup()
+    populate_database(database_adapter, n_users)
+    logic_handler = LogicHandler(database_adapter)
+    usernames = database_adapter.get_users()
+    checks = n_users * len(CONSENT_NAMES)
+
+    async def check_per_pair():
+        for username in usernames:
+            for consent_name in CONSENT_NAMES:
+                await logic_handler.check_user_consent_valid(username, consent_name)
+
+    def per_pair():
+        asyncio.run(check_per_pair())
+
+    def bulk():
+        asyncio.run(logic_handler.check_user_consents_valid_bulk(usernames, CONSENT_NAMES))
+
+    print(f"LogicHandler, {n_users} users x {len(CONSENT_NAMES)} consents")
+    for name, function in [("per pair", per_pair), ("bulk", bulk)]:
+        elapsed = measure(function, repeat=3)
+        print(f"  {name:10s} {elapsed * 1000:9.1f} ms  {checks / elapsed:12.0f} checks/s")
+
+    main.logicHandler = logic_handler
+    client = TestClient(main.app)
+    http_usernames = usernames[:http_users]
+    checks = http_users * len(CONSENT_NAMES)
+
+    def http_per_pair():
+        for username in http_usernames:
+            for consent_name in CONSENT_NAMES:
+                client.get(f"/users/{username}/consents/{consent_name}")
+
+    def http_bulk():
+        client.post(
+            "/consents/check",
+            json={"usernames": http_usernames, "consent_names": CONSENT_NAMES},
+        )
+
+    print(f"HTTP, {http_users} users x {len(CONSENT_NAMES)} consents")
+    for name, function in [("per pair", http_per_pair), ("bulk", http_bulk)]:
+        elapsed = measure(function, repeat=3)
+        print(f"  {name:10s} {elapsed * 1000:9.1f} ms  {checks / elapsed:12.0f} checks/s")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,81 @@
+"""
+bench_change_feed.py - Change Feed Fan-Out Benchmark
+
+Publishes grants and revocations through LogicHandler while hundreds of subscribers
+follow the change feed as Server-Sent Event streams, and reports how fast events are
+delivered to all of them and how long the last subscriber waits for an event. One
+extra subscriber reads slowly to show it does not hold up the others.
+
+Usage:
+    python -m benchmarks.bench_change_feed [n_events]
+
+"""
+import asyncio
+import sys
+import time
+from app.change_feed import ChangeFeed
+from app.database_mockup import DBMockup
+from app.logic_handler import LogicHandler
+from benchmarks.common import CONSENT_NAMES, populate_database
+
+
+async def subscribe(logic_handler, n_events, delays, published_at, delay=0):
+    received = 0
+    async for chunk in logic_handler.stream_changes(after=0):
+        if not chunk.startswith(b"id: "):
+            continue
+        received += 1
+        delays.append(time.perf_counter() - published_at[received])
+        if delay:
+            await asyncio.sleep(delay)
+        if received == n_events:
+            return
+
+
+async def run_fan_out(n_subscribers, n_events):
+    database_adapter = DBMockup()
+    populate_database(database_adapter, 1000)
+    logic_handler = LogicHandler(database_adapter, change_feed=ChangeFeed())
+    delays = []
+    published_at = {}
+    subscribers = [
+        asyncio.create_task(subscribe(logic_handler, n_events, delays, published_at))
+        for _ in range(n_subscribers)
+    ]
+    slow = asyncio.create_task(
+        subscribe(logic_handler, n_events, [], published_at, delay=0.001)
+    )
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    for i in range(n_events):
+        # Every grant is revoked by the next write, so every write publishes an event
+        pair = i // 2
+        username, consent_name = f"user{pair % 1000}", CONSENT_NAMES[pair % len(CONSENT_NAMES)]
+        published_at[i + 1] = time.perf_counter()
+        if i % 2:
+            await logic_handler.revoke_user_consent(username, consent_name)
+        else:
+            await logic_handler.add_user_consent(username, consent_name)
+        # Let subscribers run between writes, as requests would
+        if i % 10 == 0:
+            await asyncio.sleep(0)
+    publishing = time.perf_counter() - start
+    await asyncio.gather(*subscribers)
+    elapsed = time.perf_counter() - start
+    slow.cancel()
+    delays.sort()
+    return publishing, elapsed, delays
+
+
+def main_benchmark(n_events=2000):
+    for n_subscribers in (1, 100, 300, 1000):
+        publishing, elapsed, delays = asyncio.run(run_fan_out(n_subscribers, n_events))
+        print(f"{n_subscribers} subscribers, {n_events} events")
+        print(f"  publishing  {n_events / publishing:10.0f} events/s")
+        print(f"  delivery    {n_subscribers * n_events / elapsed:10.0f} events/s to all subscribers")
+        print(f"  p50 delay   {delays[len(delays) // 2] * 1000:10.2f} ms")
+        print(f"  p99 delay   {delays[int(len(delays) * 0.99)] * 1000:10.2f} ms")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,80 @@
+"""
+bench_concurrency.py - Concurrent Access Benchmark
+
+Measures throughput of mixed consent checks, grants and revocations from many
+threads on DBMockup, whose readers take no locks, compared with the same database
+behind one lock for every call, as StoreServer serialized calls before.
+
+Usage:
+    python -m benchmarks.bench_concurrency [n_users] [operations_per_thread]
+
+"""
+import random
+import sys
+import threading
+import time
+from app.database_mockup import DBMockup
+from benchmarks.common import CONSENT_NAMES, populate_grants
+
+
+class SingleLock:
+    """Calls the methods of a database adapter under one lock"""
+
+    def __init__(self, database_adapter):
+        self.database_adapter = database_adapter
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self.database_adapter, name)
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return method(*args, **kwargs)
+
+        return locked
+
+
+def run_threads(database_adapter, n_users, n_threads, n_operations, write_share):
+    def run(seed):
+        rng = random.Random(seed)
+        for _ in range(n_operations):
+            username, consent_name = f"user{rng.randrange(n_users)}", rng.choice(CONSENT_NAMES)
+            operation = rng.random()
+            if operation >= write_share:
+                database_adapter.lookup_user_consent(username, consent_name)
+            elif operation < write_share / 2:
+                database_adapter.add_user_consent(username, consent_name)
+            else:
+                try:
+                    database_adapter.revoke_user_consent(username, consent_name)
+                except KeyError:
+                    pass
+
+    threads = [threading.Thread(target=run, args=(seed,)) for seed in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return n_threads * n_operations / (time.perf_counter() - start)
+
+
+def main_benchmark(n_users=100000, n_operations=20000):
+    database_adapter = DBMockup()
+    n_users = populate_grants(database_adapter, n_users * 3)
+    print(f"{n_users} users, operations/s")
+    for write_share in (0.1, 0.5):
+        print(f"  {write_share:.0%} writes")
+        for n_threads in (1, 4, 16):
+            lock_free = run_threads(database_adapter, n_users, n_threads, n_operations, write_share)
+            single = run_threads(
+                SingleLock(database_adapter), n_users, n_threads, n_operations, write_share
+            )
+            print(
+                f"    {n_threads:2d} threads  lock-free reads {lock_free:9.0f}  single lock {single:9.0f}"
+                f"  {lock_free / single:5.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:3]))
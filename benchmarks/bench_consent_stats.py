@@ -0,0 +1,94 @@
+"""
+bench_consent_stats.py - Consent Statistics Benchmark
+
+Compares counting valid and expired grants of every consent one grant at a time
+with the bulk evaluation of the adapters.
+
+Usage:
+    python -m benchmarks.bench_consent_stats [n_grants]
+
+"""
+import random
+import sys
+from array import array
+from datetime import datetime
+from app import columnar_store
+from app.columnar_store import NOT_GRANTED, ColumnarDB
+from app.database_mockup import DBMockup
+from app.sqlite_adapter import to_micros
+from benchmarks.common import CONSENT_NAMES, measure, populate_database
+
+
+def fill_columnar(database_adapter, n_users, seed=0):
+    """
+    Fill ColumnarDB with consents and n_users users holding half of the consents
+    each, writing the columns directly as add_user would take minutes at this size.
+    """
+    rng = random.Random(seed)
+    populate_database(database_adapter, 0)
+    database_adapter.usernames = [f"user{i}" for i in range(n_users)]
+    database_adapter.user_ids = {username: i for i, username in enumerate(database_adapter.usernames)}
+    now = to_micros(datetime.now())
+    two_weeks = 14 * 24 * 3600 * 10**6
+    for consent_id in range(len(database_adapter.columns)):
+        database_adapter.columns[consent_id] = array(
+            "q",
+            (
+                now - rng.randrange(two_weeks) if rng.random() < 0.5 else NOT_GRANTED
+                for _ in range(n_users)
+            ),
+        )
+
+
+def count_per_grant(database_adapter):
+    """Count the way it was done before, one user_has_valid_consent call per grant"""
+    counts = {consent_name: {"valid": 0, "expired": 0} for consent_name in CONSENT_NAMES}
+    for username in database_adapter.get_users():
+        for consent_name in CONSENT_NAMES:
+            if database_adapter.user_has_consent(username, consent_name):
+                if database_adapter.user_has_valid_consent(username, consent_name):
+                    counts[consent_name]["valid"] += 1
+                else:
+                    counts[consent_name]["expired"] += 1
+    return counts
+
+
+def report(name, function, n_grants, repeat=3):
+    elapsed = measure(function, repeat)
+    print(f"  {name:32s} {elapsed * 1000:10.1f} ms  {n_grants / elapsed / 1e6:8.2f} M grants/s")
+
+
+def main_benchmark(n_grants=10_000_000):
+    n_users = n_grants * 2 // len(CONSENT_NAMES)
+    database_adapter = ColumnarDB()
+    fill_columnar(database_adapter, n_users)
+    now = datetime.now()
+    print(f"ColumnarDB, {n_grants} grants")
+    report("per grant", lambda: count_per_grant(database_adapter), n_grants, repeat=1)
+    report("get_consent_stats, numpy", lambda: database_adapter.get_consent_stats(now), n_grants)
+    report(
+        "get_consent_stats, expired, numpy",
+        lambda: database_adapter.get_consent_stats(now, include_expired=True),
+        n_grants,
+    )
+    numpy = columnar_store.numpy
+    columnar_store.numpy = None
+    report("get_consent_stats, pure Python", lambda: database_adapter.get_consent_stats(now), n_grants)
+    columnar_store.numpy = numpy
+    del database_adapter
+
+    n_grants = min(n_grants, 1_000_000)
+    database_adapter = DBMockup()
+    populate_database(database_adapter, n_grants // 3)
+    print(f"DBMockup, {n_grants} grants")
+    report("per grant", lambda: count_per_grant(database_adapter), n_grants, repeat=1)
+    report("get_consent_stats", lambda: database_adapter.get_consent_stats(now), n_grants)
+    report(
+        "get_consent_stats, expired",
+        lambda: database_adapter.get_consent_stats(now, include_expired=True),
+        n_grants,
+    )
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
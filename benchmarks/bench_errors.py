@@ -0,0 +1,63 @@
+"""
+bench_errors.py - Error Path Benchmark
+
+Measures throughput of consent checks for unknown users and consents through the
+application, which answers them with 404 responses from the shared error handlers,
+compared with the earlier endpoints that caught the HTTPException and returned it
+as a 200 response body.
+
+Usage:
+    python -m benchmarks.bench_errors [n_requests]
+
+"""
+import asyncio
+import sys
+import time
+import httpx
+from fastapi import FastAPI, HTTPException
+from pydantic import ValidationError
+from app import main
+
+
+def returning_app():
+    """The consent check endpoint as it was before the error handlers"""
+    app = FastAPI()
+
+    @app.get("/users/{username}/consents/{consent_name}")
+    async def check_user_consent_valid(username: str, consent_name: str):
+        try:
+            return await main.logicHandler.check_user_consent_valid(username, consent_name)
+        except ValidationError as e:
+            return HTTPException(status_code=400, detail=e.errors())
+        except HTTPException as e:
+            return e
+
+    return app
+
+
+async def request_many(app, urls):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        start = time.perf_counter()
+        for url in urls:
+            response = await client.get(url)
+        elapsed = time.perf_counter() - start
+    return response, len(urls) / elapsed
+
+
+def main_benchmark(n_requests=5000):
+    main.initialize()
+    cases = [
+        ("user not found", "/users/Nobody/consents/telemarketing"),
+        ("consent not found", "/users/John/consents/unknown"),
+        ("valid consent", "/users/John/consents/telemarketing"),
+    ]
+    for name, url in cases:
+        print(name)
+        for app_name, app in [("raised", main.app), ("returned", returning_app())]:
+            response, rate = asyncio.run(request_many(app, [url] * n_requests))
+            print(f"  {app_name:10s} {response.status_code}  {rate:9.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,44 @@
+"""
+bench_expiry_index.py - Expiry Index Benchmark
+
+Compares finding grants of a consent that expire within the next hour using the
+expiry index with a full scan over all users.
+
+Usage:
+    python -m benchmarks.bench_expiry_index [n_users]
+
+"""
+import sys
+from datetime import datetime, timedelta
+from app.database_mockup import DBMockup
+from benchmarks.common import measure, populate_database
+
+
+def main_benchmark(n_users=300000):
+    database_adapter = DBMockup()
+    populate_database(database_adapter, n_users)
+    now = datetime.now()
+    before = now + timedelta(hours=1)
+    consent_name = "promotions"
+    validity = database_adapter.consents[consent_name].validity
+
+    def full_scan():
+        return [
+            (user.username, user.consents[consent_name] + validity)
+            for user in database_adapter.users.values()
+            if consent_name in user.consents
+            and now <= user.consents[consent_name] + validity < before
+        ]
+
+    def index():
+        return database_adapter.get_expiring_user_consents(consent_name, before, after=now)
+
+    assert sorted(full_scan()) == sorted(index())
+    print(f"{n_users} users, {len(index())} grants of {consent_name} expire within an hour")
+    for name, function in [("full scan", full_scan), ("index", index)]:
+        elapsed = measure(function, repeat=5)
+        print(f"  {name:10s} {elapsed * 1000:9.3f} ms")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
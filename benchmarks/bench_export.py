@@ -0,0 +1,59 @@
+"""
+bench_export.py - Export Benchmark
+
+Measures time and peak memory of exporting all users with their consents, either
+streamed with LogicHandler.export_user_consents or built as one response from
+get_all_users and get_user_consents as clients had to do before.
+
+Usage:
+    python -m benchmarks.bench_export [n_users]
+
+"""
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+from app.columnar_store import ColumnarDB
+from app.logic_handler import LogicHandler
+from benchmarks.common import populate_database
+
+
+async def export_streamed(logic_handler):
+    size = 0
+    async for chunk in logic_handler.export_user_consents():
+        size += len(chunk)
+    return size
+
+
+async def export_in_memory(logic_handler):
+    users = []
+    for username in await logic_handler.get_all_users():
+        users.append((await logic_handler.get_user_consents(username)).model_dump(mode="json"))
+    return len(json.dumps(users))
+
+
+def main_benchmark(n_users=200000):
+    for n in (n_users // 4, n_users):
+        # ColumnarDB keeps the data itself small, so the export's own memory shows
+        database_adapter = ColumnarDB()
+        populate_database(database_adapter, n)
+        logic_handler = LogicHandler(database_adapter)
+        print(f"{n} users")
+        for name, export in [("streamed", export_streamed), ("in memory", export_in_memory)]:
+            start = time.perf_counter()
+            size = asyncio.run(export(logic_handler))
+            elapsed = time.perf_counter() - start
+            # Memory is measured in a separate run, tracing slows Python down considerably
+            tracemalloc.start()
+            asyncio.run(export(logic_handler))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                f"  {name:10s} {elapsed * 1000:9.0f} ms  {size / 2**20:7.1f} MiB output"
+                f"  {peak / 2**20:7.1f} MiB peak"
+            )
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
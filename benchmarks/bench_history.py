@@ -0,0 +1,109 @@
+"""
+bench_history.py - Consent History Benchmark
+
+Measures lookups of consents at past times in the history of DBMockup, a binary
+search in a packed array of events per user and consent, against a linear scan of
+the same arrays, for histories of several lengths. Also measures the memory
+taken per event and the throughput of the audit of many (username, consent_name, at)
+rows through LogicHandler.audit_user_consents.
+
+Usage:
+    python -m benchmarks.bench_history [n_users]
+
+"""
+import asyncio
+import random
+import sys
+from datetime import datetime, timedelta
+from app.database_mockup import DBMockup, from_micros, to_micros
+from app.logic_handler import LogicHandler
+from app.models import Consent
+from benchmarks.common import measure
+
+START = datetime(2024, 1, 1)
+
+
+def build(n_users, events_per_user):
+    """DBMockup whose users granted telemarketing events_per_user times, an hour apart"""
+    database_adapter = DBMockup()
+    database_adapter.add_consent(Consent(consent_name="telemarketing", validity=timedelta(minutes=30)))
+    usernames = [f"user{i}" for i in range(n_users)]
+    database_adapter.bulk_write(usernames=usernames)
+    for hour in range(events_per_user):
+        granted_at = START + timedelta(hours=hour)
+        database_adapter.bulk_write(grants=[(username, "telemarketing", granted_at) for username in usernames])
+    return database_adapter, usernames
+
+
+def scan(database_adapter, queries):
+    """Times of granting of the grants held at the given times, by a linear scan of the history"""
+    consent_ids = database_adapter.history_consent_ids
+    results = []
+    for username, consent_name, at in queries:
+        target = to_micros(at) * 2 + 1
+        granted_at = None
+        for event in database_adapter.history[username][consent_ids[consent_name]]:
+            if event > target:
+                break
+            granted_at = None if event & 1 else from_micros(event >> 1)
+        results.append(granted_at)
+    return results
+
+
+def main_benchmark(n_users=1000, n_queries=20000, audit_rows=100000):
+    rng = random.Random(0)
+    print(f"Lookups at past times, {n_users} users, {n_queries} queries")
+    print(f"  {'events':>8s} {'bisect':>12s} {'scan':>12s}  queries/s")
+    for events_per_user in [1, 10, 100, 1000]:
+        database_adapter, usernames = build(n_users, events_per_user)
+        span = events_per_user * 3600
+        queries = [
+            (rng.choice(usernames), "telemarketing", START + timedelta(seconds=rng.randrange(span)))
+            for _ in range(n_queries)
+        ]
+        def bisect():
+            database_adapter.lookup_user_consents_at(queries)
+
+        def linear():
+            scan(database_adapter, queries)
+
+        elapsed_bisect = measure(bisect, repeat=3)
+        elapsed_scan = measure(linear, repeat=3)
+        print(f"  {events_per_user:8d} {n_queries / elapsed_bisect:12.0f} {n_queries / elapsed_scan:12.0f}")
+
+    events_per_user = 100
+    database_adapter, usernames = build(n_users, events_per_user)
+    history = database_adapter.history
+    size = sum(
+        sys.getsizeof(user_history) + sum(sys.getsizeof(events) for events in user_history.values())
+        for user_history in history.values()
+    )
+    tuples = [(START + timedelta(hours=hour), False) for hour in range(events_per_user)]
+    tuples_size = n_users * (
+        sys.getsizeof({}) + sys.getsizeof(tuples) + events_per_user * (sys.getsizeof(tuples[0]) + sys.getsizeof(START))
+    )
+    n_events = n_users * events_per_user
+    print(f"Memory of {n_events} events: {size / n_events:.1f} bytes per event, {tuples_size / n_events:.1f} as tuples")
+
+    logic_handler = LogicHandler(database_adapter)
+    span = events_per_user * 3600
+    lines = [
+        f"{rng.choice(usernames)},telemarketing,{(START + timedelta(seconds=rng.randrange(span))).isoformat()}"
+        for _ in range(audit_rows)
+    ]
+
+    async def lines_of_log():
+        yield "username,consent_name,at"
+        for line in lines:
+            yield line
+
+    async def run_audit():
+        async for _ in await logic_handler.audit_user_consents(lines_of_log(), "csv"):
+            pass
+
+    elapsed = measure(lambda: asyncio.run(run_audit()))
+    print(f"Audit of {audit_rows} call log rows: {elapsed * 1000:.0f} ms, {audit_rows / elapsed:.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
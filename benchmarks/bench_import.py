@@ -0,0 +1,96 @@
+"""
+bench_import.py - Bulk Import Benchmark
+
+Measures bulk import throughput of NDJSON records into the database adapters,
+compared with writing the same grants one LogicHandler.add_user_consent call at a time.
+
+Usage:
+    python -m benchmarks.bench_import [n_users]
+
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from app.columnar_store import ColumnarDB
+from app.database_mockup import DBMockup
+from app.logic_handler import LogicHandler
+from app.models import Consent, User
+from app.sqlite_adapter import SQLiteAdapter
+from benchmarks.common import CONSENT_NAMES
+
+
+def generate_records(n_users, consents_per_user=3, seed=0):
+    rng = random.Random(seed)
+    now = datetime.now()
+    lines = [
+        json.dumps({"type": "consent", "consent_name": consent_name, "validity_seconds": 86400})
+        for consent_name in CONSENT_NAMES
+    ]
+    for i in range(n_users):
+        lines.append(json.dumps({"type": "user", "username": f"user{i}"}))
+        for consent_name in rng.sample(CONSENT_NAMES, consents_per_user):
+            granted_at = now - timedelta(seconds=rng.randrange(365 * 86400))
+            lines.append(
+                json.dumps(
+                    {
+                        "type": "grant",
+                        "username": f"user{i}",
+                        "consent_name": consent_name,
+                        "granted_at": granted_at.isoformat(),
+                    }
+                )
+            )
+    return lines
+
+
+async def as_lines(lines):
+    for line in lines:
+        yield line
+
+
+async def import_one_by_one(logic_handler, lines):
+    """What an import had to do before: one call per record, losing the times of granting"""
+    for line in lines:
+        record = json.loads(line)
+        if record["type"] == "user":
+            await logic_handler.adapter.add_user(User(username=record["username"], consents={}))
+        elif record["type"] == "grant":
+            await logic_handler.add_user_consent(record["username"], record["consent_name"])
+        else:
+            validity = timedelta(seconds=record["validity_seconds"])
+            await logic_handler.create_consent(
+                Consent(consent_name=record["consent_name"], validity=validity)
+            )
+
+
+def main_benchmark(n_users=100000):
+    lines = generate_records(n_users)
+    print(f"{len(lines)} records")
+    with tempfile.TemporaryDirectory() as directory:
+        adapters = [
+            ("DBMockup", lambda: DBMockup()),
+            ("ColumnarDB", lambda: ColumnarDB()),
+            ("SQLiteAdapter", lambda: SQLiteAdapter(os.path.join(directory, f"{time.time()}.db"))),
+        ]
+        for name, create_adapter in adapters:
+            for method in ("bulk", "one by one"):
+                logic_handler = LogicHandler(create_adapter())
+                start = time.perf_counter()
+                if method == "bulk":
+                    summary = asyncio.run(
+                        logic_handler.import_records(as_lines(lines), "ndjson", 10000)
+                    )
+                    assert summary["error_count"] == 0
+                else:
+                    asyncio.run(import_one_by_one(logic_handler, lines))
+                elapsed = time.perf_counter() - start
+                print(f"  {name:14s} {method:10s} {len(lines) / elapsed:10.0f} records/s")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
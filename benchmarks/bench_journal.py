@@ -0,0 +1,96 @@
+"""
+bench_journal.py - Journal Benchmark
+
+Measures write throughput of JournaledDBMockup with concurrent writers under
+different group commit windows, compared with DBMockup, and the time to recover
+the database from a snapshot and from the journal alone.
+
+Usage:
+    python -m benchmarks.bench_journal [n_grants] [n_writers]
+
+"""
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from app.database_mockup import DBMockup
+from app.journal import JournaledDBMockup
+from app.models import Consent
+from benchmarks.common import CONSENT_NAMES
+
+
+def write_concurrently(database_adapter, n_writers, writes_per_writer):
+    """Grant and revoke consents from n_writers threads, return writes per second"""
+
+    def write(writer):
+        username = f"writer{writer}"
+        for i in range(writes_per_writer):
+            consent_name = CONSENT_NAMES[i // 2 % len(CONSENT_NAMES)]
+            if i % 2:
+                database_adapter.revoke_user_consent(username, consent_name)
+            else:
+                database_adapter.add_user_consent(username, consent_name)
+
+    database_adapter.bulk_write(usernames=[f"writer{writer}" for writer in range(n_writers)])
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(n_writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return n_writers * writes_per_writer / (time.perf_counter() - start)
+
+
+def fill(database_adapter, n_grants, chunk_size=100000):
+    now = datetime.now()
+    database_adapter.bulk_write(
+        consents=[Consent(consent_name=name, validity=timedelta(days=7)) for name in CONSENT_NAMES]
+    )
+    per_user = len(CONSENT_NAMES) // 2
+    n_users = n_grants // per_user
+    for chunk_start in range(0, n_users, chunk_size):
+        usernames = [f"user{i}" for i in range(chunk_start, min(chunk_start + chunk_size, n_users))]
+        grants = [
+            (username, CONSENT_NAMES[(i + j) % len(CONSENT_NAMES)], now - timedelta(seconds=i % 86400))
+            for i, username in enumerate(usernames, chunk_start)
+            for j in range(per_user)
+        ]
+        database_adapter.bulk_write(usernames=usernames, grants=grants)
+
+
+def measure_recovery(directory):
+    start = time.perf_counter()
+    database_adapter = JournaledDBMockup(directory)
+    elapsed = time.perf_counter() - start
+    database_adapter.close()
+    return elapsed
+
+
+def main_benchmark(n_grants=10000000, n_writers=32):
+    print(f"write throughput, {n_writers} writers")
+    rate = write_concurrently(DBMockup(), n_writers, 2000)
+    print(f"  {'DBMockup':28s} {rate:10.0f} writes/s")
+    for commit_interval in (0, 0.001, 0.002, 0.005, 0.01):
+        with tempfile.TemporaryDirectory() as directory:
+            database_adapter = JournaledDBMockup(directory, commit_interval=commit_interval)
+            rate = write_concurrently(database_adapter, n_writers, 200)
+            database_adapter.close()
+        label = f"journaled, {commit_interval * 1000:g} ms window"
+        print(f"  {label:28s} {rate:10.0f} writes/s")
+
+    print(f"recovery of {n_grants} grants")
+    with tempfile.TemporaryDirectory() as directory:
+        database_adapter = JournaledDBMockup(directory)
+        fill(database_adapter, n_grants)
+        database_adapter.close()
+        print(f"  {'journal':10s} {measure_recovery(directory):8.1f} s")
+
+        database_adapter = JournaledDBMockup(directory)
+        database_adapter.snapshot()
+        database_adapter.close()
+        print(f"  {'snapshot':10s} {measure_recovery(directory):8.1f} s")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:3]))
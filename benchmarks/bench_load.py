@@ -0,0 +1,87 @@
+"""
+bench_load.py - Concurrent Load Benchmark
+
+Runs concurrent clients against the application in process and reports throughput
+and latency percentiles of a mix of its routes. The database adapter is selected
+with the same CONSENT_API_DATABASE environment variable as the application.
+
+Usage:
+    python -m benchmarks.bench_load [n_clients] [requests_per_client]
+
+"""
+import asyncio
+import random
+import sys
+import time
+import httpx
+from app import main
+from benchmarks.common import CONSENT_NAMES, populate_database
+
+# Share of requests per route, mostly consent checks like in production
+ROUTES = [
+    ("GET", "/users/{username}/consents/{consent_name}", 80),
+    ("GET", "/users/{username}/consents/", 10),
+    ("GET", "/consents/{consent_name}/users", 5),
+    ("POST", "/users/{username}/consents/{consent_name}", 5),
+]
+
+
+async def run_client(client, usernames, n_requests, latencies, seed):
+    rng = random.Random(seed)
+    routes = rng.choices(ROUTES, weights=[weight for _, _, weight in ROUTES], k=n_requests)
+    for method, route, _ in routes:
+        url = route.format(username=rng.choice(usernames), consent_name=rng.choice(CONSENT_NAMES))
+        start = time.perf_counter()
+        response = await client.request(method, url)
+        latencies[method, route].append(time.perf_counter() - start)
+        assert response.status_code == 200
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        f"p{percentile}": latencies[max(int(len(latencies) * percentile / 100) - 1, 0)]
+        for percentile in (50, 90, 99)
+    }
+
+
+async def run_load(n_clients, n_requests, n_users=1000):
+    """
+    Run n_clients concurrent clients making n_requests each and return the total
+    throughput in requests per second and latency percentiles in seconds per route.
+    """
+    transport = httpx.ASGITransport(app=main.app)
+    usernames = [f"user{i}" for i in range(n_users)]
+    latencies = {(method, route): [] for method, route, _ in ROUTES}
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(run_client(client, usernames, n_requests, latencies, seed) for seed in range(n_clients))
+        )
+        elapsed = time.perf_counter() - start
+    all_latencies = [latency for route_latencies in latencies.values() for latency in route_latencies]
+    return {
+        "throughput": len(all_latencies) / elapsed,
+        "all": percentiles(all_latencies),
+        "routes": {
+            f"{method} {route}": percentiles(route_latencies)
+            for (method, route), route_latencies in latencies.items()
+            if route_latencies
+        },
+    }
+
+
+def main_benchmark(n_clients=100, n_requests=50):
+    main.initialize()
+    populate_database(main.databse_adapter, 1000)
+    results = asyncio.run(run_load(n_clients, n_requests))
+    print(f"{main.DATABASE}, {n_clients} clients x {n_requests} requests")
+    print(f"  throughput {results['throughput']:9.0f} requests/s")
+    for route, route_percentiles in [("all routes", results["all"]), *results["routes"].items()]:
+        print(f"  {route}")
+        for percentile, latency in route_percentiles.items():
+            print(f"    {percentile:<9s} {latency * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,42 @@
+"""
+bench_memory.py - Memory Use Benchmark
+
+Measures memory allocated per grant by the in-memory database adapters.
+
+Usage:
+    python -m benchmarks.bench_memory [n_users]
+
+"""
+import gc
+import sys
+import tracemalloc
+from app.columnar_store import ColumnarDB
+from app.database_mockup import DBMockup
+from benchmarks.common import populate_database
+
+
+def measure_memory(database_class, n_users, consents_per_user):
+    gc.collect()
+    tracemalloc.start()
+    database_adapter = database_class()
+    populate_database(database_adapter, n_users, consents_per_user)
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return allocated
+
+
+def main_benchmark(n_users=100000):
+    for consents_per_user in (1, 3, 6):
+        n_grants = n_users * consents_per_user
+        print(f"{n_users} users, {consents_per_user} of 6 consents per user")
+        for database_class in (DBMockup, ColumnarDB):
+            allocated = measure_memory(database_class, n_users, consents_per_user)
+            print(
+                f"  {database_class.__name__:12s} {allocated / 2**20:8.1f} MiB"
+                f"  {allocated / n_grants:8.1f} bytes/grant"
+            )
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,93 @@
+"""
+bench_policy.py - Consent Policy Benchmark
+
+Compares checking a policy by composing single consent checks on the client with
+the policy check of one user and of many users at once, both directly on the
+LogicHandler and through the HTTP endpoints.
+
+Usage:
+    python -m benchmarks.bench_policy [n_users]
+
+"""
+import asyncio
+import sys
+from fastapi.testclient import TestClient
+from app import main
+from app.database_mockup import DBMockup
+from app.logic_handler import LogicHandler
+from benchmarks.common import measure, populate_database
+
+POLICY = "telemarketing AND NOT EXPIRED promotions AND ANY(catalogues, newsletter)"
+
+
+def compose(telemarketing, promotions, catalogues, newsletter):
+    """The policy combined from single check responses, as a client would"""
+    return (
+        telemarketing["valid"]
+        and promotions["reason"] != "User consent has expired"
+        and (catalogues["valid"] or newsletter["valid"])
+    )
+
+
+def main_benchmark(n_users=10000, http_users=500):
+    database_adapter = DBMockup()
+    populate_database(database_adapter, n_users)
+    logic_handler = LogicHandler(database_adapter)
+    usernames = database_adapter.get_users()
+    consent_names = ["telemarketing", "promotions", "catalogues", "newsletter"]
+
+    async def check_composed():
+        for username in usernames:
+            compose(
+                *[
+                    await logic_handler.check_user_consent_valid(username, consent_name)
+                    for consent_name in consent_names
+                ]
+            )
+
+    async def check_policy():
+        for username in usernames:
+            await logic_handler.check_user_policy(username, POLICY)
+
+    def composed():
+        asyncio.run(check_composed())
+
+    def policy():
+        asyncio.run(check_policy())
+
+    def bulk():
+        asyncio.run(logic_handler.check_users_policy_bulk(usernames, POLICY))
+
+    print(f"LogicHandler, {n_users} users, {POLICY}")
+    for name, function in [("composed", composed), ("policy", policy), ("bulk", bulk)]:
+        elapsed = measure(function, repeat=3)
+        print(f"  {name:10s} {elapsed * 1000:9.1f} ms  {n_users / elapsed:12.0f} users/s")
+
+    main.logicHandler = logic_handler
+    client = TestClient(main.app)
+    http_usernames = usernames[:http_users]
+
+    def http_composed():
+        for username in http_usernames:
+            compose(
+                *[
+                    client.get(f"/users/{username}/consents/{consent_name}").json()
+                    for consent_name in consent_names
+                ]
+            )
+
+    def http_policy():
+        for username in http_usernames:
+            client.get(f"/users/{username}/policy", params={"expr": POLICY})
+
+    def http_bulk():
+        client.post("/policy/check", json={"usernames": http_usernames, "policy": POLICY})
+
+    print(f"HTTP, {http_users} users")
+    for name, function in [("composed", http_composed), ("policy", http_policy), ("bulk", http_bulk)]:
+        elapsed = measure(function, repeat=3)
+        print(f"  {name:10s} {elapsed * 1000:9.1f} ms  {http_users / elapsed:12.0f} users/s")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
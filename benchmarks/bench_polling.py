@@ -0,0 +1,48 @@
+"""
+bench_polling.py - Conditional GET Polling Benchmark
+
+Measures throughput of clients polling the consents of users and the consent
+catalogue through the application, either fetching the full response every time
+or sending the ETag of the previous response in If-None-Match.
+
+Usage:
+    python -m benchmarks.bench_polling [n_requests]
+
+"""
+import asyncio
+import sys
+import time
+import httpx
+from app import main
+from benchmarks.common import populate_database
+
+
+async def poll(urls, conditional):
+    transport = httpx.ASGITransport(app=main.app)
+    etags = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        start = time.perf_counter()
+        for url in urls:
+            headers = {"If-None-Match": etags[url]} if conditional and url in etags else {}
+            response = await client.get(url, headers=headers)
+            etags[url] = response.headers.get("etag")
+        elapsed = time.perf_counter() - start
+    return len(urls) / elapsed
+
+
+def main_benchmark(n_requests=5000):
+    main.initialize()
+    populate_database(main.databse_adapter, 1000, consents_per_user=6)
+    cases = [
+        ("user consents", [f"/users/user{i % 100}/consents/" for i in range(n_requests)]),
+        ("consents", ["/consents/"] * n_requests),
+    ]
+    for name, urls in cases:
+        print(name)
+        for mode, conditional in [("full", False), ("If-None-Match", True)]:
+            rate = asyncio.run(poll(urls, conditional))
+            print(f"  {mode:14s} {rate:9.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
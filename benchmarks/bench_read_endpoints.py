@@ -0,0 +1,91 @@
+"""
+bench_read_endpoints.py - Read Endpoint Throughput Benchmark
+
+Measures request throughput of the read endpoints of the application, which
+encode their responses with orjson, compared with the same endpoints returning
+their results for FastAPI to encode with jsonable_encoder. The database adapter is
+selected with the same CONSENT_API_DATABASE environment variable as the application.
+
+Usage:
+    python -m benchmarks.bench_read_endpoints [n_requests] [n_users]
+
+"""
+import asyncio
+import sys
+import time
+import httpx
+from fastapi import FastAPI
+from app import main
+from benchmarks.common import populate_database
+
+URLS = [
+    "/users/",
+    "/consents/",
+    "/users/user1/consents/",
+    "/users/user1/consents/telemarketing",
+    "/consents/stats",
+    "/consents/telemarketing/users?limit=100",
+]
+
+
+def encoder_app():
+    """The read endpoints as they were before they encoded their responses with orjson"""
+    app = FastAPI()
+    logic_handler = main.logicHandler
+
+    @app.get("/users/")
+    async def get_users():
+        return await logic_handler.get_all_users()
+
+    @app.get("/consents/")
+    async def get_consents():
+        return await logic_handler.get_all_consents()
+
+    @app.get("/consents/stats")
+    async def get_consent_stats(include_expired: bool = False):
+        return await logic_handler.get_consent_stats(include_expired)
+
+    @app.get("/users/{username}/consents/")
+    async def get_user_consents(username: str):
+        return await logic_handler.get_user_consents(username)
+
+    @app.get("/users/{username}/consents/{consent_name}")
+    async def check_user_consent_valid(username: str, consent_name: str):
+        return await logic_handler.check_user_consent_valid(username, consent_name)
+
+    @app.get("/consents/{consent_name}/users")
+    async def get_consent_users(consent_name: str, limit: int = 100):
+        return await logic_handler.get_consent_users(consent_name, limit=limit)
+
+    return app
+
+
+async def request_many(app, url, n_requests):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        start = time.perf_counter()
+        for _ in range(n_requests):
+            response = await client.get(url)
+        elapsed = time.perf_counter() - start
+    assert response.status_code == 200
+    return response, n_requests / elapsed
+
+
+def main_benchmark(n_requests=2000, n_users=1000):
+    main.initialize()
+    populate_database(main.databse_adapter, n_users)
+    apps = [("orjson", main.app), ("encoder", encoder_app())]
+    print(f"{main.DATABASE}, {n_users} users, requests/s")
+    for url in URLS:
+        rates = {}
+        for app_name, app in apps:
+            response, rates[app_name] = asyncio.run(request_many(app, url, n_requests))
+        speedup = rates["orjson"] / rates["encoder"]
+        print(
+            f"  {url:42s} orjson {rates['orjson']:8.0f}  encoder {rates['encoder']:8.0f}"
+            f"  {speedup:5.2f}x  ({len(response.content)} bytes)"
+        )
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:3]))
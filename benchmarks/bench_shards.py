@@ -0,0 +1,121 @@
+"""
+bench_shards.py - Sharded Store Scaling Benchmark
+
+Measures a sharded store of 1 to n store server processes, each holding the users
+that hash to it. Consent check throughput is measured with several worker processes,
+as uvicorn workers would run them, and the latency of queries that fan out to every
+shard with one client. With more shards than CPU cores the shards share cores and
+the throughput does not scale.
+
+Usage:
+    python -m benchmarks.bench_shards [max_shards] [seconds]
+
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from app.database_mockup import DBMockup
+from app.logic_handler import LogicHandler
+from app.sharded_store import ShardedDB
+from app.store_server import StoreClient, StoreServer
+from benchmarks.common import CONSENT_NAMES, measure, populate_database
+
+N_USERS = 50000
+N_WORKERS = 4
+AUTHKEY = b"benchmark"
+
+
+def run_shard_server(address, index, n_shards, ready):
+    # Every shard generates the same data set and keeps its own part of it
+    sharded = ShardedDB([DBMockup() for _ in range(n_shards)])
+    populate_database(sharded, N_USERS)
+    server = StoreServer(sharded.shards[index], address, AUTHKEY)
+    ready.set()
+    server.serve_forever()
+
+
+def connect(addresses):
+    return ShardedDB(StoreClient(address, AUTHKEY) for address in addresses)
+
+
+async def check_for(logic_handler, deadline, seed):
+    rng = random.Random(seed)
+    checks = 0
+    while time.perf_counter() < deadline:
+        username = f"user{rng.randrange(N_USERS)}"
+        await logic_handler.check_user_consent_valid(username, rng.choice(CONSENT_NAMES))
+        checks += 1
+    return checks
+
+
+def run_worker(addresses, seconds, worker, start, results, concurrency=16):
+    logic_handler = LogicHandler(connect(addresses))
+    start.wait()
+
+    async def run():
+        deadline = time.perf_counter() + seconds
+        counts = await asyncio.gather(
+            *(check_for(logic_handler, deadline, worker * concurrency + i) for i in range(concurrency))
+        )
+        return sum(counts)
+
+    results.put(asyncio.run(run()))
+
+
+def measure_checks(addresses, seconds):
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(addresses, seconds, worker, start, results))
+        for worker in range(N_WORKERS)
+    ]
+    for process in workers:
+        process.start()
+    # Give the workers time to connect before the clock starts
+    time.sleep(1)
+    start.set()
+    checks = sum(results.get() for _ in workers)
+    for process in workers:
+        process.join()
+    return checks / seconds
+
+
+def main_benchmark(max_shards=4, seconds=3):
+    shard_counts = [n for n in (1, 2, 4, 8, 16) if n <= max_shards]
+    print(f"{N_USERS} users, {N_WORKERS} workers, {os.cpu_count()} CPUs")
+    single = None
+    for n_shards in shard_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            addresses = [os.path.join(directory, f"shard{i}.sock") for i in range(n_shards)]
+            servers = []
+            for index, address in enumerate(addresses):
+                ready = multiprocessing.Event()
+                server = multiprocessing.Process(
+                    target=run_shard_server, args=(address, index, n_shards, ready), daemon=True
+                )
+                server.start()
+                servers.append((server, ready))
+            for _, ready in servers:
+                ready.wait()
+
+            rate = measure_checks(addresses, seconds)
+            single = single or rate
+            database_adapter = connect(addresses)
+            stats = measure(lambda: database_adapter.get_consent_stats(datetime.now(), True), repeat=5)
+            users = measure(lambda: database_adapter.get_consent_users("promotions", limit=1000), repeat=5)
+            database_adapter.close()
+            print(
+                f"  {n_shards:3d} shards {rate:10.0f} checks/s  {rate / single:5.2f}x"
+                f"  stats {stats * 1000:8.2f} ms  consent users {users * 1000:8.2f} ms"
+            )
+            for server, _ in servers:
+                server.terminate()
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,111 @@
+"""
+bench_startup.py - Startup Benchmark
+
+Measures how long `import app.main` takes and how long a uvicorn worker takes from
+its start to the first answered request, to the first answered liveness check and
+to serving data, with the default in-memory database and with a journaled database
+that recovers n_grants grants from a snapshot.
+
+Usage:
+    python -m benchmarks.bench_startup [n_grants]
+
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from app.journal import JournaledDBMockup
+from benchmarks.common import populate_grants
+
+
+def measure_import(env, repeat=3):
+    """Best time of importing app.main in a new interpreter, in seconds"""
+    code = "import time; start = time.perf_counter(); import app.main; print(time.perf_counter() - start)"
+    return min(
+        float(subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, check=True).stdout)
+        for _ in range(repeat)
+    )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def status_of(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+    except OSError:
+        return None
+
+
+def measure_startup(env, timeout=120):
+    """
+    Seconds from starting uvicorn until it answers any request, until /health
+    returns 200 and until /consents/ returns 200.
+    """
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+    first = live = data = None
+    try:
+        while data is None and time.perf_counter() - start < timeout:
+            health = status_of(f"{base}/health")
+            elapsed = time.perf_counter() - start
+            if health is not None and first is None:
+                first = elapsed
+            if health == 200 and live is None:
+                live = elapsed
+            if health is not None and status_of(f"{base}/consents/") == 200:
+                data = time.perf_counter() - start
+            time.sleep(0.005)
+    finally:
+        server.terminate()
+        server.wait()
+    return first, live, data
+
+
+def format_seconds(seconds):
+    return "       -" if seconds is None else f"{seconds * 1000:8.0f}"
+
+
+def main_benchmark(n_grants=1000000):
+    with tempfile.TemporaryDirectory() as directory:
+        journal_dir = os.path.join(directory, "journal")
+        database_adapter = JournaledDBMockup(journal_dir, commit_interval=0)
+        populate_grants(database_adapter, n_grants)
+        database_adapter.snapshot()
+        database_adapter.close()
+
+        settings = [
+            ("memory", {"CONSENT_API_DATABASE": "memory"}),
+            (
+                f"journaled, {n_grants} grants",
+                {"CONSENT_API_DATABASE": "journaled", "CONSENT_API_JOURNAL_DIR": journal_dir},
+            ),
+        ]
+        print(f"{'':30s} {'import':>8s} {'first':>8s} {'live':>8s} {'data':>8s}  ms")
+        for name, variables in settings:
+            env = dict(os.environ, **variables)
+            imported = measure_import(env)
+            first, live, data = measure_startup(env)
+            print(
+                f"  {name:28s} {imported * 1000:8.0f} {format_seconds(first)}"
+                f" {format_seconds(live)} {format_seconds(data)}"
+            )
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,46 @@
+"""
+bench_sweeper.py - Expiry Sweeper Benchmark
+
+Measures how long one batch of the expiry sweeper holds the event loop and how
+listing expired grants speeds up once they are archived. Grants are
+granted within the last two weeks and valid for 1 to 14 days, so about half of
+them have expired.
+
+Usage:
+    python -m benchmarks.bench_sweeper [n_grants] [batch_size]
+
+"""
+import sys
+import time
+from datetime import datetime
+from app.database_mockup import DBMockup
+from benchmarks.common import measure, populate_grants
+
+
+def main_benchmark(n_grants=1000000, batch_size=1000):
+    database_adapter = DBMockup()
+    populate_grants(database_adapter, n_grants)
+    now = datetime.now()
+    before = measure(lambda: database_adapter.get_consent_stats(now, include_expired=True), 3)
+
+    slices = []
+    while True:
+        start = time.perf_counter()
+        moved = database_adapter.archive_expired_grants(now, batch_size)
+        slices.append(time.perf_counter() - start)
+        if moved < batch_size:
+            break
+    archived = sum(len(archived) // 2 for archived in database_adapter.archive.values())
+    after = measure(lambda: database_adapter.get_consent_stats(now, include_expired=True), 3)
+
+    slices.sort()
+    print(f"{n_grants} grants, {archived} expired grants archived in batches of {batch_size}")
+    print(f"  batches          {len(slices):9d}")
+    print(f"  total            {sum(slices) * 1000:9.1f} ms")
+    print(f"  batch p50        {slices[len(slices) // 2] * 1000:9.3f} ms")
+    print(f"  batch max        {slices[-1] * 1000:9.3f} ms")
+    print(f"  expired grants listed in {before * 1000:.1f} ms before, {after * 1000:.1f} ms after")
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,111 @@
+"""
+bench_workers.py - Multi-Worker Read Scaling Benchmark
+
+Measures consent check throughput of 1 to n worker processes that all read the same
+data, either from one store server or from one SQLite database file. Every worker
+runs concurrent checks through its own LogicHandler, as a uvicorn worker would.
+
+Usage:
+    python -m benchmarks.bench_workers [max_workers] [seconds]
+
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from app.database_mockup import DBMockup
+from app.logic_handler import LogicHandler
+from app.sqlite_adapter import SQLiteAdapter
+from app.store_server import StoreClient, StoreServer
+from benchmarks.common import CONSENT_NAMES, populate_database
+
+N_USERS = 10000
+AUTHKEY = b"benchmark"
+
+
+def run_store_server(address, ready):
+    database_adapter = DBMockup()
+    populate_database(database_adapter, N_USERS)
+    server = StoreServer(database_adapter, address, AUTHKEY)
+    ready.set()
+    server.serve_forever()
+
+
+def create_adapter(kind, location):
+    if kind == "store":
+        return StoreClient(location, AUTHKEY)
+    return SQLiteAdapter(location)
+
+
+async def check_for(logic_handler, deadline, seed):
+    rng = random.Random(seed)
+    checks = 0
+    while time.perf_counter() < deadline:
+        username = f"user{rng.randrange(N_USERS)}"
+        await logic_handler.check_user_consent_valid(username, rng.choice(CONSENT_NAMES))
+        checks += 1
+    return checks
+
+
+def run_worker(kind, location, seconds, worker, start, results, concurrency=16):
+    logic_handler = LogicHandler(create_adapter(kind, location))
+    start.wait()
+
+    async def run():
+        deadline = time.perf_counter() + seconds
+        counts = await asyncio.gather(
+            *(check_for(logic_handler, deadline, worker * concurrency + i) for i in range(concurrency))
+        )
+        return sum(counts)
+
+    results.put(asyncio.run(run()))
+
+
+def measure_workers(kind, location, n_workers, seconds):
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=run_worker, args=(kind, location, seconds, worker, start, results)
+        )
+        for worker in range(n_workers)
+    ]
+    for process in workers:
+        process.start()
+    # Give the workers time to connect before the clock starts
+    time.sleep(1)
+    start.set()
+    checks = sum(results.get() for _ in workers)
+    for process in workers:
+        process.join()
+    return checks / seconds
+
+
+def main_benchmark(max_workers=8, seconds=3):
+    worker_counts = [n for n in (1, 2, 4, 8, 16, 32) if n <= max_workers]
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_path = os.path.join(directory, "consents.db")
+        populate_database(SQLiteAdapter(sqlite_path), N_USERS)
+        store_address = os.path.join(directory, "store.sock")
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(
+            target=run_store_server, args=(store_address, ready), daemon=True
+        )
+        server.start()
+        ready.wait()
+
+        for kind, location in [("store", store_address), ("sqlite", sqlite_path)]:
+            print(f"{kind}, {N_USERS} users")
+            single = None
+            for n_workers in worker_counts:
+                rate = measure_workers(kind, location, n_workers, seconds)
+                single = single or rate
+                print(f"  {n_workers:3d} workers {rate:10.0f} checks/s  {rate / single:5.2f}x")
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main_benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,75 @@
+"""
+common.py - Shared Benchmark Helpers
+
+Helpers for filling a database adapter with synthetic data and timing code.
+
+Functions:
+- populate_database(database_adapter, n_users, consents_per_user): Fill the adapter with synthetic users and consents.
+- populate_grants(database_adapter, n_grants, consents_per_user): Fill the adapter with n_grants synthetic grants in bulk.
+- measure(function, repeat): Time a function call.
+
+"""
+import random
+import time
+from datetime import datetime, timedelta
+from app.models import Consent, User
+
+CONSENT_NAMES = ["telemarketing", "promotions", "catalogues", "newsletter", "sms", "profiling"]
+
+
+def populate_database(database_adapter, n_users, consents_per_user=3, seed=0):
+    """
+    Fill the database adapter with consents and n_users users, each holding
+    consents_per_user randomly chosen consents granted within the last two weeks.
+    """
+    rng = random.Random(seed)
+    for consent_name in CONSENT_NAMES:
+        database_adapter.add_consent(
+            Consent(consent_name=consent_name, validity=timedelta(days=rng.randint(1, 14)))
+        )
+    now = datetime.now()
+    for i in range(n_users):
+        granted = rng.sample(CONSENT_NAMES, consents_per_user)
+        user = User(
+            username=f"user{i}",
+            consents={
+                consent_name: now - timedelta(seconds=rng.randint(0, 14 * 24 * 3600))
+                for consent_name in granted
+            },
+        )
+        database_adapter.add_user(user)
+
+
+def populate_grants(database_adapter, n_grants, consents_per_user=3, seed=0, chunk_size=100000):
+    """
+    Fill the database adapter with the same kind of data as populate_database, but
+    written with bulk_write in chunks, so it scales to millions of grants.
+    Returns the number of users, which are named user0 to user{n_users - 1}.
+    """
+    rng = random.Random(seed)
+    consents = [
+        Consent(consent_name=consent_name, validity=timedelta(days=rng.randint(1, 14)))
+        for consent_name in CONSENT_NAMES
+    ]
+    database_adapter.bulk_write(consents=consents)
+    now = datetime.now()
+    n_users = -(-n_grants // consents_per_user)
+    for chunk_start in range(0, n_users, chunk_size):
+        usernames = [f"user{i}" for i in range(chunk_start, min(chunk_start + chunk_size, n_users))]
+        grants = [
+            (username, consent_name, now - timedelta(seconds=rng.randint(0, 14 * 24 * 3600)))
+            for username in usernames
+            for consent_name in rng.sample(CONSENT_NAMES, consents_per_user)
+        ]
+        database_adapter.bulk_write(usernames=usernames, grants=grants)
+    return n_users
+
+
+def measure(function, repeat=1):
+    """Return the best wall clock time in seconds out of repeat calls of function."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
@@ -0,0 +1,190 @@
+"""
+suite.py - Benchmark Suite with Regression Check
+
+Runs micro-benchmarks of DBMockup operations and LogicHandler.check_user_consent_valid
+on synthetic data sets of several sizes, and an in-process HTTP load test of the
+application routes. Results are saved as JSON and compared with a baseline saved by
+an earlier run. The run fails when a result is worse than the baseline by more
+than the threshold, and before running when there is no baseline to compare with.
+
+Every result has a value, its unit and whether higher is better, for example
+{"micro.10000.lookup_user_consent": {"value": 1250000.0, "unit": "ops/s", "higher_is_better": true}}.
+
+Usage:
+    python -m benchmarks.suite [--sizes 10000 1000000 10000000] [--baseline benchmarks/baseline.json]
+                               [--threshold 0.2] [--save-baseline]
+
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from app.database_mockup import DBMockup
+from app.logic_handler import LogicHandler
+from benchmarks.common import CONSENT_NAMES, measure, populate_database, populate_grants
+
+SIZES = (10000, 1000000, 10000000)
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def result(value, unit, higher_is_better=True):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def run_micro(n_grants, n_operations=20000, repeat=3):
+    """Return operations per second of DBMockup and LogicHandler operations on n_grants grants"""
+    database_adapter = DBMockup()
+    n_users = populate_grants(database_adapter, n_grants)
+    logic_handler = LogicHandler(database_adapter)
+    rng = random.Random(1)
+    pairs = [(f"user{rng.randrange(n_users)}", rng.choice(CONSENT_NAMES)) for _ in range(n_operations)]
+    now = datetime.now()
+
+    def each_pair(operation):
+        def run():
+            for username, consent_name in pairs:
+                operation(username, consent_name)
+
+        return run
+
+    def grant_and_revoke(username, consent_name):
+        database_adapter.add_user_consent(username, consent_name)
+        database_adapter.revoke_user_consent(username, consent_name)
+
+    async def check_pairs():
+        for username, consent_name in pairs:
+            await logic_handler.check_user_consent_valid(username, consent_name)
+
+    def each_consent(operation, times=10):
+        def run():
+            for _ in range(times):
+                for consent_name in CONSENT_NAMES:
+                    operation(consent_name)
+
+        return run, times * len(CONSENT_NAMES)
+
+    operations = [
+        ("user_exists", each_pair(lambda username, _: database_adapter.user_exists(username)), n_operations),
+        (
+            "get_user_consents",
+            each_pair(lambda username, _: database_adapter.get_user_consents(username)),
+            n_operations,
+        ),
+        ("lookup_user_consent", each_pair(database_adapter.lookup_user_consent), n_operations),
+        ("add_and_revoke_user_consent", each_pair(grant_and_revoke), n_operations),
+        ("check_user_consent_valid", lambda: asyncio.run(check_pairs()), n_operations),
+        (
+            "get_expiring_user_consents",
+            *each_consent(
+                lambda consent_name: database_adapter.get_expiring_user_consents(
+                    consent_name, now + timedelta(minutes=10), now
+                )
+            ),
+        ),
+        (
+            "get_consent_users",
+            *each_consent(
+                lambda consent_name: database_adapter.get_consent_users(consent_name, valid_only=True)
+            ),
+        ),
+        (
+            "get_consent_stats",
+            lambda: [database_adapter.get_consent_stats(now) for _ in range(100)],
+            100,
+        ),
+    ]
+    results = {}
+    for name, operation, count in operations:
+        elapsed = measure(operation, repeat)
+        results[f"micro.{n_grants}.{name}"] = result(count / elapsed, "ops/s")
+    return results
+
+
+def run_http(n_clients=100, n_requests=50):
+    """Return throughput and latency percentiles of the application routes"""
+    from app import main
+    from benchmarks.bench_load import run_load
+
+    main.initialize()
+    populate_database(main.databse_adapter, 1000)
+    load = asyncio.run(run_load(n_clients, n_requests))
+    results = {"http.throughput": result(load["throughput"], "requests/s")}
+    for percentile in ("p50", "p99"):
+        results[f"http.all.{percentile}"] = result(load["all"][percentile], "s", higher_is_better=False)
+    # Rare routes have too few requests for a stable p99
+    for route, route_percentiles in load["routes"].items():
+        results[f"http.{route}.p50"] = result(route_percentiles["p50"], "s", higher_is_better=False)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every result from the baseline and return names of regressions"""
+    regressions = []
+    for name, current in results.items():
+        value = current["value"]
+        if name not in baseline:
+            print(f"  {name:70s} {value:14.6g} {current['unit']:10s}  (new)")
+            continue
+        previous = baseline[name]["value"]
+        change = value / previous - 1 if previous else 0.0
+        worse = -change if current["higher_is_better"] else change
+        regressed = worse > threshold
+        if regressed:
+            regressions.append(name)
+        marker = "REGRESSION" if regressed else ""
+        print(f"  {name:70s} {value:14.6g} {current['unit']:10s} {change:+8.1%}  {marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmark suite and compare it with a baseline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="Numbers of grants")
+    parser.add_argument("--clients", type=int, default=100, help="Concurrent HTTP clients")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per HTTP client")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to save the results")
+    parser.add_argument("--baseline", default=BASELINE, help="Results of an earlier run to compare with")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Allowed relative slowdown, 0.2 is 20%%"
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Save the results as the new baseline"
+    )
+    args = parser.parse_args()
+    # Without a baseline nothing could regress, so a check run would always pass
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        parser.exit(
+            2,
+            f"No baseline at {args.baseline}. Save one on the main branch with --save-baseline first.\n",
+        )
+
+    results = {}
+    for n_grants in args.sizes:
+        print(f"micro-benchmarks, {n_grants} grants", file=sys.stderr)
+        results.update(run_micro(n_grants))
+        # Free the previous data set before building a larger one
+        gc.collect()
+    print("HTTP load", file=sys.stderr)
+    results.update(run_http(args.clients, args.requests))
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+
+    baseline = {}
+    if not args.save_baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} results regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
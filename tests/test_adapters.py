@@ -0,0 +1,92 @@
+import pytest
+import threading
+from app.adapters import AsyncAdapterShim, as_async_adapter
+from app.logic_handler import LogicHandler
+from tests.test_data import anyio_backend, database_adapter, database_mockup_with_data
+
+
+class LegacyAdapter:
+    """Adapter that only has the methods adapters had before lookup_user_consent"""
+
+    def __init__(self, database_adapter):
+        self.database_adapter = database_adapter
+
+    def __getattr__(self, name):
+        if name == "lookup_user_consent":
+            raise AttributeError(name)
+        return getattr(self.database_adapter, name)
+
+
+class AsyncAdapter:
+    """Natively asynchronous adapter"""
+
+    def __init__(self, database_adapter):
+        self.database_adapter = database_adapter
+
+    def __getattr__(self, name):
+        method = getattr(self.database_adapter, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+@pytest.mark.anyio
+async def test_as_async_adapter(database_mockup_with_data):
+    adapter = as_async_adapter(database_mockup_with_data)
+    assert isinstance(adapter, AsyncAdapterShim)
+    assert adapter.offload is getattr(database_mockup_with_data, "blocking_io", False)
+    assert adapter.blocking_methods == getattr(database_mockup_with_data, "blocking_methods", frozenset())
+    assert await adapter.user_exists("John") is True
+    assert await adapter.user_has_consent("John", "promotions") is False
+
+    async_adapter = AsyncAdapter(database_mockup_with_data)
+    assert as_async_adapter(async_adapter) is async_adapter
+
+
+@pytest.mark.anyio
+async def test_lookup_user_consent_fallback(database_mockup_with_data):
+    logic_handler = LogicHandler(LegacyAdapter(database_mockup_with_data))
+    for username, consent_name in [
+        ("John", "telemarketing"),
+        ("John", "promotions"),
+        ("John", "nonexistent_consent"),
+        ("NonexistentUser", "telemarketing"),
+    ]:
+        lookup = await logic_handler.lookup_user_consent(username, consent_name)
+        assert lookup == database_mockup_with_data.lookup_user_consent(username, consent_name)
+
+    response = await logic_handler.check_user_consent_valid("John", "catalogues")
+    assert response["reason"] == "User consent has expired"
+    await logic_handler.revoke_user_consent("John", "telemarketing")
+    assert database_mockup_with_data.user_has_consent("John", "telemarketing") is False
+
+
+class PartlyBlockingAdapter:
+    """Adapter whose writes block, recording the thread of every call"""
+
+    blocking_methods = frozenset({"add_user_consent"})
+
+    def __init__(self, database_adapter):
+        self.database_adapter = database_adapter
+        self.threads = {}
+
+    def user_exists(self, username):
+        self.threads["user_exists"] = threading.get_ident()
+        return self.database_adapter.user_exists(username)
+
+    def add_user_consent(self, username, consent_name):
+        self.threads["add_user_consent"] = threading.get_ident()
+        self.database_adapter.add_user_consent(username, consent_name)
+
+
+@pytest.mark.anyio
+async def test_only_blocking_methods_are_offloaded(database_mockup_with_data):
+    database_adapter = PartlyBlockingAdapter(database_mockup_with_data)
+    adapter = as_async_adapter(database_adapter)
+    assert not adapter.offload
+    assert await adapter.user_exists("John")
+    await adapter.add_user_consent("John", "promotions")
+    assert database_adapter.threads["user_exists"] == threading.get_ident()
+    assert database_adapter.threads["add_user_consent"] != threading.get_ident()
@@ -0,0 +1,94 @@
+import pytest
+from datetime import datetime, timedelta
+from app.bulk_import import iter_lines, parse_record
+from app.logic_handler import LogicHandler
+from tests.test_data import anyio_backend, database_adapter, database_mockup_with_data
+
+NDJSON = """{"type": "consent", "consent_name": "newsletter", "validity_seconds": 3600}
+{"type": "user", "username": "Anna"}
+{"type": "grant", "username": "Anna", "consent_name": "newsletter", "granted_at": "2024-03-03T10:00:00"}
+{"type": "grant", "username": "John", "consent_name": "promotions", "granted_at": "2024-03-03T10:00:00+00:00"}
+
+{"type": "grant", "username": "Nobody", "consent_name": "newsletter", "granted_at": "2024-03-03T10:00:00"}
+{"type": "grant", "username": "Anna", "consent_name": "nonexistent_consent", "granted_at": "2024-03-03T10:00:00"}
+{"type": "consent", "consent_name": "bad name!", "validity_seconds": 10}
+not json
+"""
+
+CSV = """type,username,consent_name,validity_seconds,granted_at
+consent,,newsletter,3600,
+user,Anna,,,
+grant,Anna,newsletter,,2024-03-03T10:00:00
+grant,Anna,newsletter,,yesterday
+"""
+
+
+async def as_lines(text):
+    for line in text.splitlines(keepends=True):
+        yield line
+
+
+def test_parse_record():
+    assert parse_record({"type": "user", "username": "Anna"}) == ("user", "Anna")
+    record_type, consent = parse_record({"type": "consent", "consent_name": "sms", "validity_seconds": "60"})
+    assert record_type == "consent"
+    assert consent.validity == timedelta(seconds=60)
+    with pytest.raises(ValueError):
+        parse_record({"type": "grant", "username": "Anna", "consent_name": "sms"})
+    with pytest.raises(ValueError):
+        parse_record({"type": "something"})
+
+
+@pytest.mark.anyio
+async def test_iter_lines():
+    async def chunks():
+        for chunk in [b'{"a":', b' 1}\n{"b"', b": 2}\n", b'{"c": 3}']:
+            yield chunk
+
+    assert [line async for line in iter_lines(chunks())] == ['{"a": 1}', '{"b": 2}', '{"c": 3}']
+
+
+@pytest.mark.anyio
+async def test_import_ndjson(database_mockup_with_data):
+    logic_handler = LogicHandler(database_mockup_with_data)
+    summary = await logic_handler.import_records(as_lines(NDJSON), "ndjson", chunk_size=2)
+    assert summary["records"] == 8
+    assert summary["imported"] == {"consents": 1, "users": 1, "grants": 2}
+    assert summary["error_count"] == 4
+    assert [error["row"] for error in summary["errors"]] == [6, 7, 8, 9]
+    assert summary["errors"][0]["error"] == "User not found"
+    assert summary["errors"][1]["error"] == "Consent not found"
+
+    database_adapter = database_mockup_with_data
+    assert database_adapter.consent_exists("newsletter") is True
+    assert database_adapter.get_user_consents("Anna").consents["newsletter"] == datetime(2024, 3, 3, 10)
+    assert database_adapter.user_has_valid_consent("Anna", "newsletter") is False
+    # Other consents of existing users are kept
+    assert set(database_adapter.get_user_consents("John").consents) == {"telemarketing", "catalogues", "promotions"}
+    expired = await logic_handler.get_consent_users("newsletter")
+    assert [user["username"] for user in expired["users"]] == ["Anna"]
+
+
+@pytest.mark.anyio
+async def test_import_csv(database_mockup_with_data):
+    logic_handler = LogicHandler(database_mockup_with_data)
+    summary = await logic_handler.import_records(as_lines(CSV), "csv")
+    assert summary["imported"] == {"consents": 1, "users": 1, "grants": 1}
+    assert summary["errors"] == [{"row": 5, "error": "granted_at should be an ISO 8601 time"}]
+    assert database_mockup_with_data.user_has_consent("Anna", "newsletter") is True
+
+
+@pytest.mark.anyio
+async def test_import_repeated_grants_in_one_chunk(database_mockup_with_data):
+    logic_handler = LogicHandler(database_mockup_with_data)
+    now = datetime.now()
+    lines = "\n".join(
+        f'{{"type": "grant", "username": "Linda", "consent_name": "promotions", "granted_at": "{granted_at.isoformat()}"}}'
+        for granted_at in [now - timedelta(days=2), now - timedelta(days=1)]
+    )
+    summary = await logic_handler.import_records(as_lines(lines), "ndjson")
+    assert summary["imported"]["grants"] == 2
+    stats = await logic_handler.get_consent_stats()
+    assert stats["consents"]["promotions"] == {"valid": 2, "expired": 0}
+    users = await logic_handler.get_consent_users("promotions")
+    assert [user["username"] for user in users["users"]] == ["Linda", "Wayne"]
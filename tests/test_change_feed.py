@@ -0,0 +1,154 @@
+import asyncio
+import httpx
+import pytest
+import threading
+import time
+from datetime import datetime, timedelta
+from app import main
+from app.change_feed import ChangeFeed
+from app.database_mockup import DBMockup
+from app.logic_handler import LogicHandler
+from app.models import Consent, User
+from tests.test_data import anyio_backend, database_adapter, database_mockup_with_data, started_app
+
+
+def test_read_and_reset():
+    feed = ChangeFeed(capacity=3)
+    for i in range(7):
+        feed.publish("granted", username=f"user{i}", consent_name="telemarketing")
+    events, reset = feed.read(5)
+    assert [event["seq"] for event in events] == [6, 7]
+    assert not reset
+    # Events 1 to 3 were dropped
+    events, reset = feed.read(1)
+    assert reset
+    assert events[0]["seq"] == feed.first_seq == 4
+    # Sequence numbers from before a restart are unknown
+    assert feed.read(100) == (events, True)
+    chunks, _, last_seq = feed.read_encoded(6)
+    assert chunks[0].startswith(b"id: 7\nevent: granted\ndata: ")
+    assert last_seq == 7
+    # After a reset the subscriber resumes after the last event it was sent
+    assert feed.read_encoded(1, limit=2)[1:] == (True, 5)
+    assert feed.read_encoded(100)[1:] == (True, 7)
+    assert feed.read_encoded(7) == ([], False, 7)
+
+
+@pytest.mark.anyio
+async def test_wait():
+    feed = ChangeFeed()
+    assert not await feed.wait(0, timeout=0.01)
+
+    async def publish_later():
+        await asyncio.sleep(0.01)
+        feed.publish("revoked", username="John", consent_name="telemarketing")
+
+    task = asyncio.create_task(publish_later())
+    assert await feed.wait(0, timeout=1)
+    await task
+    assert await feed.wait(0, timeout=0)
+
+
+@pytest.mark.anyio
+async def test_logic_handler_events(database_mockup_with_data):
+    feed = ChangeFeed()
+    logic_handler = LogicHandler(database_mockup_with_data, change_feed=feed)
+    await logic_handler.create_consent(Consent(consent_name="sms", validity=timedelta(hours=1)))
+    await logic_handler.add_user_consent("Linda", "sms")
+    await logic_handler.revoke_user_consent("Linda", "sms")
+    # Revoking a consent that is not granted changes nothing
+    await logic_handler.revoke_user_consent("Linda", "sms")
+    await logic_handler.add_user_consent("Mike", "sms")
+    changes = await logic_handler.get_changes(after=0)
+    assert [(event["type"], event.get("username")) for event in changes["events"]] == [
+        ("consent_created", None),
+        ("granted", "Linda"),
+        ("revoked", "Linda"),
+        ("granted", "Mike"),
+    ]
+    assert changes["events"][0]["validity_seconds"] == 3600
+    assert changes["last_seq"] == 4
+
+    await logic_handler.publish_expired_grants(datetime.now() + timedelta(hours=2))
+    expired = (await logic_handler.get_changes(after=4))["events"]
+    assert ("expired", "Mike", "sms") in [
+        (event["type"], event["username"], event["consent_name"]) for event in expired
+    ]
+    times = [event["time"] for event in expired]
+    assert times == sorted(times)
+    # Every expiry is published once
+    await logic_handler.publish_expired_grants(datetime.now() + timedelta(hours=3))
+    assert (await logic_handler.get_changes(after=4 + len(expired)))["events"] == []
+
+
+@pytest.mark.anyio
+async def test_publish_expired_grants_of_long_validities(database_mockup_with_data):
+    feed = ChangeFeed()
+    logic_handler = LogicHandler(database_mockup_with_data, change_feed=feed)
+    await logic_handler.create_consent(Consent(consent_name="forever", validity=timedelta(days=1000000)))
+    await logic_handler.add_user_consent("Linda", "forever")
+    # Cutoffs reaching back before datetime.min are clamped
+    feed.expired_until = datetime.min
+    await logic_handler.publish_expired_grants(datetime.now() + timedelta(hours=3))
+    expired = [(event["username"], event["consent_name"]) for event in feed.read(1)[0] if event["type"] == "expired"]
+    assert ("Mike", "telemarketing") in expired
+    assert ("Linda", "forever") not in expired
+    await logic_handler.publish_expired_grants(datetime.max)
+    assert feed.read(feed.last_seq - 1)[0][-1]["consent_name"] == "forever"
+
+
+class SlowRevocations(DBMockup):
+    """DBMockup called in the threadpool whose revocations return late"""
+
+    blocking_io = True
+
+    def __init__(self):
+        super().__init__()
+        self.revoked = threading.Event()
+
+    def revoke_user_consent(self, username, consent_name):
+        super().revoke_user_consent(username, consent_name)
+        self.revoked.set()
+        time.sleep(0.2)
+
+
+@pytest.mark.anyio
+async def test_events_in_order_of_changes():
+    database_adapter = SlowRevocations()
+    database_adapter.add_user(User(username="Linda", consents=dict()))
+    database_adapter.add_consent(Consent(consent_name="sms", validity=timedelta(hours=1)))
+    database_adapter.add_user_consent("Linda", "sms")
+    feed = ChangeFeed()
+    logic_handler = LogicHandler(database_adapter, change_feed=feed)
+    # The grant is applied after the revocation, but returns before it
+    revoking = asyncio.create_task(logic_handler.revoke_user_consent("Linda", "sms"))
+    await asyncio.to_thread(database_adapter.revoked.wait)
+    await logic_handler.add_user_consent("Linda", "sms")
+    await revoking
+    assert "sms" in database_adapter.get_user_consents("Linda").consents
+    assert [event["type"] for event in feed.read(0)[0]] == ["revoked", "granted"]
+
+
+@pytest.mark.anyio
+async def test_stream_changes(database_mockup_with_data):
+    feed = ChangeFeed()
+    logic_handler = LogicHandler(database_mockup_with_data, change_feed=feed)
+    await logic_handler.add_user_consent("Linda", "telemarketing")
+    stream = logic_handler.stream_changes(after=0, keepalive=0.01)
+    chunk = await stream.__anext__()
+    assert chunk.startswith(b"id: 1\nevent: granted\n")
+    assert await stream.__anext__() == b": keepalive\n\n"
+    await stream.aclose()
+
+
+@pytest.mark.anyio
+async def test_long_poll_endpoint(started_app):
+    transport = httpx.ASGITransport(app=started_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        last_seq = main.change_feed.last_seq
+        await client.post("/users/Linda/consents/promotions")
+        await client.delete("/users/Linda/consents/promotions")
+        response = await client.get("/changes", params={"after": last_seq, "timeout": 1})
+        events = response.json()["events"]
+        assert [event["type"] for event in events] == ["granted", "revoked"]
+        assert response.json()["reset"] is False
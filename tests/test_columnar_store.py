@@ -0,0 +1,48 @@
+import pytest
+from datetime import datetime, timedelta
+from app import columnar_store
+from app.columnar_store import ColumnarDB
+from app.models import Consent, User
+
+
+def columnar_db_with_data():
+    db = ColumnarDB()
+    db.add_consent(Consent(consent_name="telemarketing", validity=timedelta(hours=2)))
+    db.add_consent(Consent(consent_name="promotions", validity=timedelta(weeks=1)))
+    now = datetime.now()
+    db.add_user(User(username="John", consents={"telemarketing": now, "promotions": now - timedelta(weeks=2)}))
+    db.add_user(User(username="Linda", consents={"telemarketing": now - timedelta(hours=3)}))
+    db.add_user(User(username="Mike", consents={}))
+    return db, now
+
+
+def test_get_consent_stats_without_numpy(monkeypatch):
+    db, now = columnar_db_with_data()
+    monkeypatch.setattr(columnar_store, "numpy", None)
+    counts, expired = db.get_consent_stats(now, include_expired=True)
+    assert counts == {
+        "telemarketing": {"valid": 1, "expired": 1},
+        "promotions": {"valid": 0, "expired": 1},
+    }
+    assert sorted(expired) == [("John", "promotions"), ("Linda", "telemarketing")]
+
+
+def test_get_consent_stats_with_numpy(monkeypatch):
+    numpy = pytest.importorskip("numpy")
+    db, now = columnar_db_with_data()
+    monkeypatch.setattr(columnar_store, "numpy", numpy)
+    with_numpy = db.get_consent_stats(now, include_expired=True)
+    monkeypatch.setattr(columnar_store, "numpy", None)
+    assert with_numpy == db.get_consent_stats(now, include_expired=True)
+
+
+@pytest.mark.parametrize("with_numpy", [False, True])
+def test_validities_reaching_back_before_the_epoch_range(monkeypatch, with_numpy):
+    db, now = columnar_db_with_data()
+    monkeypatch.setattr(columnar_store, "numpy", pytest.importorskip("numpy") if with_numpy else None)
+    db.add_consent(Consent(consent_name="forever", validity=timedelta(days=999999999)))
+    db.add_user_consent("John", "forever")
+    # Users that have not granted the consent are not counted as valid
+    assert db.get_consent_stats(now)[0]["forever"] == {"valid": 1, "expired": 0}
+    assert [username for username, _ in db.get_consent_users("forever", valid_only=True)] == ["John"]
+    assert db.get_expiring_user_consents("forever", before=datetime.max, after=now) == []
@@ -1,13 +1,56 @@
 import pytest
+import threading
+from app import main
+from app.columnar_store import ColumnarDB
 from app.database_mockup import DBMockup
+from app.journal import JournaledDBMockup
 from app.logic_handler import LogicHandler
+from app.sqlite_adapter import SQLiteAdapter
+from app.store_server import StoreClient, StoreServer
 from app.models import Consent, User
+from app.sharded_store import ShardedDB
 from datetime import datetime, timedelta
 
+# LogicHandler tests run on asyncio
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+# The application with its sample data loaded, as after its lifespan started
+@pytest.fixture
+def started_app():
+    main.initialize()
+    return main.app
+
+# Every database adapter has to pass the same tests as DBMockup
+@pytest.fixture(params=["memory", "journaled", "sqlite", "columnar", "store", "sharded"])
+def database_adapter(request, tmp_path):
+    if request.param == "store":
+        server = StoreServer(DBMockup(), str(tmp_path / "store.sock"), authkey=b"test")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        database_adapter = StoreClient(server.address, authkey=b"test")
+        yield database_adapter
+        database_adapter.close()
+        server.close()
+    elif request.param == "journaled":
+        database_adapter = JournaledDBMockup(str(tmp_path / "journal"), commit_interval=0)
+        yield database_adapter
+        database_adapter.close()
+    elif request.param == "sqlite":
+        database_adapter = SQLiteAdapter(str(tmp_path / "consents.db"))
+        yield database_adapter
+        database_adapter.close()
+    elif request.param == "columnar":
+        yield ColumnarDB()
+    elif request.param == "sharded":
+        yield ShardedDB([DBMockup() for _ in range(3)])
+    else:
+        yield DBMockup()
+
 # Define a fixture to initialize DBMockup with test data
 @pytest.fixture
-def database_mockup_with_data():
-    db_mockup = DBMockup()
+def database_mockup_with_data(database_adapter):
+    db_mockup = database_adapter
     users = []
     users.append(User(username="Mike", consents=dict()))
     users.append(User(username="John", consents=dict()))
@@ -15,7 +58,7 @@ def database_mockup_with_data():
     users.append(User(username="Wayne", consents=dict()))
     users.append(User(username="Linda", consents=dict()))
     for user in users:
-        db_mockup.users[user.username] = user
+        db_mockup.add_user(user)
 
     # Add test consents
     db_mockup.add_consent(Consent(consent_name="telemarketing", validity=timedelta(hours=2)))
@@ -1,8 +1,14 @@
 import pytest
+import random
+import sqlite3
+import sys
+import threading
 from datetime import datetime, timedelta
 from app.models import Consent, User
 from app.database_mockup import DBMockup
-from tests.test_data import database_mockup_with_data
+from app.sharded_store import ShardedDB
+from app.sqlite_adapter import SQLiteAdapter
+from tests.test_data import database_adapter, database_mockup_with_data
 
 # Original test cases
 def test_get_users(database_mockup_with_data):
@@ -85,3 +91,328 @@ def test_revoke_user_consent(database_mockup_with_data):
     # Test revoking a non-existent consent
     with pytest.raises(KeyError):
         db_mockup.revoke_user_consent("John", "nonexistent_consent")
+
+def test_get_user_consents_bulk(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    users = db_mockup.get_user_consents_bulk(["John", "Linda", "NonexistentUser"])
+    assert set(users) == {"John", "Linda"}
+    assert "telemarketing" in users["John"].consents
+    assert "catalogues" in users["Linda"].consents
+
+def test_add_user(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    granted_at = datetime.now() - timedelta(hours=1)
+    db_mockup.add_user(User(username="Anna", consents={"promotions": granted_at}))
+    assert db_mockup.user_exists("Anna") is True
+    assert db_mockup.get_user_consents("Anna").consents["promotions"] == granted_at
+    assert db_mockup.user_has_valid_consent("Anna", "promotions") is True
+
+def test_bulk_write_repeated_grant(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    now = datetime.now()
+    first, last = now - timedelta(hours=3), now - timedelta(hours=1)
+    # Historical imports can hold several grants of a user in one chunk, the last one counts
+    db_mockup.bulk_write(
+        usernames=["Anna"],
+        grants=[("Anna", "telemarketing", first), ("Anna", "telemarketing", last), ("John", "telemarketing", first)],
+    )
+    assert db_mockup.get_user_consents("Anna").consents == {"telemarketing": last}
+    counts, _ = db_mockup.get_consent_stats(now)
+    assert counts["telemarketing"] == {"valid": 3, "expired": 1}
+    users = [username for username, _ in db_mockup.get_consent_users("telemarketing")]
+    assert users.count("Anna") == 1 and users.count("John") == 1
+
+    db_mockup.revoke_user_consent("Anna", "telemarketing")
+    assert "Anna" not in [username for username, _ in db_mockup.get_consent_users("telemarketing")]
+    if hasattr(db_mockup, "archive_expired_grants"):
+        db_mockup.add_user_consent("Anna", "telemarketing")
+        db_mockup.archive_expired_grants(now)
+        assert "telemarketing" in db_mockup.get_user_consents("Anna").consents
+
+def test_get_expiring_user_consents(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    now = datetime.now()
+    db_mockup.add_user(User(username="Anna", consents={"telemarketing": now - timedelta(minutes=90)}))
+    db_mockup.add_user(User(username="Bob", consents={"telemarketing": now - timedelta(hours=3)}))
+
+    # Anna expires in 30 minutes, Bob has already expired, the rest expire in two hours
+    expiring = db_mockup.get_expiring_user_consents("telemarketing", now + timedelta(hours=1))
+    assert [username for username, _ in expiring] == ["Bob", "Anna"]
+    assert expiring[1][1] == now - timedelta(minutes=90) + timedelta(hours=2)
+
+    expiring = db_mockup.get_expiring_user_consents("telemarketing", now + timedelta(hours=1), after=now)
+    assert [username for username, _ in expiring] == ["Anna"]
+
+    expiring = db_mockup.get_expiring_user_consents("telemarketing", now + timedelta(hours=3), after=now)
+    assert [username for username, _ in expiring] == ["Anna", "John", "Mike", "Wayne"]
+
+    # Revoked and regranted consents are removed or moved in the index
+    db_mockup.revoke_user_consent("Anna", "telemarketing")
+    db_mockup.add_user_consent("Bob", "telemarketing")
+    expiring = db_mockup.get_expiring_user_consents("telemarketing", now + timedelta(hours=1))
+    assert expiring == []
+
+    # Changing the validity changes the expiry of existing grants
+    db_mockup.add_consent(Consent(consent_name="telemarketing", validity=timedelta(minutes=30)))
+    expiring = db_mockup.get_expiring_user_consents("telemarketing", datetime.now() + timedelta(hours=1))
+    assert [username for username, _ in expiring] == ["John", "Mike", "Wayne", "Bob"]
+
+    with pytest.raises(KeyError):
+        db_mockup.get_expiring_user_consents("nonexistent_consent", now)
+
+    # Validities reaching back before the first representable time expire nothing
+    db_mockup.add_consent(Consent(consent_name="forever", validity=timedelta(days=1000000)))
+    db_mockup.add_user_consent("Bob", "forever")
+    assert db_mockup.get_expiring_user_consents("forever", now, after=datetime.min) == []
+    assert db_mockup.get_expiring_user_consents("telemarketing", datetime.min) == []
+
+def test_get_consent_users(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    db_mockup.add_user(User(username="Anna", consents={"telemarketing": datetime.now() - timedelta(hours=3)}))
+
+    grants = db_mockup.get_consent_users("telemarketing")
+    assert [username for username, _ in grants] == ["Anna", "John", "Mike", "Wayne"]
+
+    grants = db_mockup.get_consent_users("telemarketing", valid_only=True)
+    assert [username for username, _ in grants] == ["John", "Mike", "Wayne"]
+
+    # Pages continue after the last grant of the previous page
+    first_page = db_mockup.get_consent_users("telemarketing", limit=2)
+    assert [username for username, _ in first_page] == ["Anna", "John"]
+    username, granted_at = first_page[-1]
+    second_page = db_mockup.get_consent_users("telemarketing", after=(granted_at, username), limit=2)
+    assert [username for username, _ in second_page] == ["Mike", "Wayne"]
+
+    db_mockup.revoke_user_consent("Mike", "telemarketing")
+    second_page = db_mockup.get_consent_users("telemarketing", after=(granted_at, username), limit=2)
+    assert [username for username, _ in second_page] == ["Wayne"]
+
+    with pytest.raises(KeyError):
+        db_mockup.get_consent_users("nonexistent_consent")
+
+    db_mockup.add_consent(Consent(consent_name="forever", validity=timedelta(days=1000000)))
+    db_mockup.add_user_consent("Anna", "forever")
+    grants = db_mockup.get_consent_users("forever", valid_only=True)
+    assert [username for username, _ in grants] == ["Anna"]
+
+def test_lookup_user_consent(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    lookup = db_mockup.lookup_user_consent("John", "telemarketing")
+    assert lookup.user_exists is True
+    assert lookup.consent_exists is True
+    assert lookup.granted_at == db_mockup.get_user_consents("John").consents["telemarketing"]
+    assert lookup.validity == timedelta(hours=2)
+
+    lookup = db_mockup.lookup_user_consent("John", "promotions")
+    assert lookup.granted_at is None
+    assert lookup.validity == timedelta(weeks=1)
+
+    lookup = db_mockup.lookup_user_consent("NonexistentUser", "nonexistent_consent")
+    assert lookup == (False, False, None, None)
+
+def test_get_consent_stats(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    db_mockup.add_user(User(username="Anna", consents={"telemarketing": datetime.now() - timedelta(hours=3)}))
+    counts, expired = db_mockup.get_consent_stats(datetime.now())
+    assert counts == {
+        "telemarketing": {"valid": 3, "expired": 1},
+        "promotions": {"valid": 1, "expired": 0},
+        "catalogues": {"valid": 0, "expired": 2},
+    }
+    assert expired is None
+
+    _, expired = db_mockup.get_consent_stats(datetime.now(), include_expired=True)
+    assert sorted(expired) == [("Anna", "telemarketing"), ("John", "catalogues"), ("Linda", "catalogues")]
+
+    counts, _ = db_mockup.get_consent_stats(datetime.now() + timedelta(days=1))
+    assert counts["telemarketing"] == {"valid": 0, "expired": 4}
+
+    db_mockup.add_consent(Consent(consent_name="forever", validity=timedelta(days=1000000)))
+    db_mockup.add_user_consent("Anna", "forever")
+    counts, _ = db_mockup.get_consent_stats(datetime.now())
+    assert counts["forever"] == {"valid": 1, "expired": 0}
+
+def test_iter_users(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    batches = list(db_mockup.iter_users(batch_size=3))
+    assert [len(batch) for batch in batches] == [3, 1]
+    users = {user.username: user for batch in batches for user in batch}
+    assert set(users) == {"John", "Linda", "Mike", "Wayne"}
+    assert set(users["John"].consents) == {"telemarketing", "catalogues"}
+
+    since = datetime.now()
+    assert list(db_mockup.iter_users(since=since)) == []
+    # Grants, revocations and imported older grants all change users
+    db_mockup.add_user_consent("Linda", "promotions")
+    db_mockup.revoke_user_consent("Wayne", "promotions")
+    db_mockup.add_user(User(username="Anna", consents={"promotions": since - timedelta(hours=1)}))
+    db_mockup.bulk_write(grants=[("Mike", "promotions", since - timedelta(hours=2))])
+    users = {user.username: user for batch in db_mockup.iter_users(since=since) for user in batch}
+    assert set(users) == {"Linda", "Wayne", "Anna", "Mike"}
+    assert "promotions" not in users["Wayne"].consents
+
+def test_sqlite_users_of_older_databases_count_as_changed(tmp_path):
+    path = str(tmp_path / "consents.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE users (username TEXT PRIMARY KEY) WITHOUT ROWID")
+    connection.execute("INSERT INTO users VALUES ('Anna')")
+    connection.commit()
+    connection.close()
+    before = datetime.now()
+    db = SQLiteAdapter(path)
+    try:
+        assert [user.username for batch in db.iter_users(since=before) for user in batch] == ["Anna"]
+    finally:
+        db.close()
+
+def test_versions(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    if not hasattr(db_mockup, "get_user_version"):
+        pytest.skip("Adapter keeps no versions")
+    assert db_mockup.get_user_version("Nobody") is None
+    john, linda = db_mockup.get_user_version("John"), db_mockup.get_user_version("Linda")
+    consents = db_mockup.get_consents_version()
+
+    db_mockup.add_user_consent("John", "promotions")
+    assert db_mockup.get_user_version("John") != john
+    assert db_mockup.get_user_version("Linda") == linda
+    assert db_mockup.get_consents_version() == consents
+    john = db_mockup.get_user_version("John")
+    db_mockup.revoke_user_consent("John", "promotions")
+    assert db_mockup.get_user_version("John") != john
+
+    db_mockup.bulk_write(grants=[("Linda", "promotions", datetime.now())])
+    assert db_mockup.get_user_version("Linda") != linda
+    db_mockup.add_consent(Consent(consent_name="sms", validity=timedelta(days=1)))
+    assert db_mockup.get_consents_version() != consents
+    # Another instance never has the same versions
+    assert DBMockup().get_consents_version() != DBMockup().get_consents_version()
+
+def test_archive_expired_grants(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    if not hasattr(db_mockup, "archive_expired_grants"):
+        pytest.skip("Adapter has no archive")
+    if isinstance(db_mockup, ShardedDB):
+        pytest.skip("Shards are swept one after another, see test_sharded_store")
+    anna_granted_at = datetime.now() - timedelta(hours=3)
+    db_mockup.add_user(User(username="Anna", consents={"telemarketing": anna_granted_at}))
+    john_granted_at = db_mockup.get_user_consents("John").consents["catalogues"]
+    now = datetime.now()
+    assert db_mockup.archive_expired_grants(now - timedelta(days=1)) == 0
+
+    # Oldest grants go first, consent by consent
+    assert db_mockup.archive_expired_grants(now, limit=2) == 2
+    assert db_mockup.get_user_consents("Anna").consents == {}
+    # Archiving changes users for incremental exports
+    assert {user.username for batch in db_mockup.iter_users(since=now) for user in batch} == {"Anna", "John"}
+    assert set(db_mockup.get_user_consents("John").consents) == {"telemarketing"}
+    assert set(db_mockup.get_user_consents("Linda").consents) == {"catalogues"}
+    assert db_mockup.get_archived_user_consents("John") == [("catalogues", john_granted_at)]
+    assert db_mockup.get_archived_user_consents("Anna") == [("telemarketing", anna_granted_at)]
+    assert db_mockup.get_archived_user_consents("Mike") == []
+    assert db_mockup.get_archived_user_consents_bulk(["John", "Mike", "Nobody"]) == {"John": {"catalogues": john_granted_at}}
+    # Archived grants are still found as expired
+    assert db_mockup.lookup_user_consent("John", "catalogues").granted_at == john_granted_at
+    assert not db_mockup.user_has_consent("John", "catalogues")
+
+    assert db_mockup.archive_expired_grants(now) == 1
+    assert db_mockup.archive_expired_grants(now) == 0
+    counts, _ = db_mockup.get_consent_stats(now)
+    assert counts["catalogues"] == {"valid": 0, "expired": 0}
+
+    # A new grant replaces the archived one
+    db_mockup.add_user_consent("John", "catalogues")
+    assert db_mockup.lookup_user_consent("John", "catalogues").granted_at > john_granted_at
+
+def test_concurrent_access():
+    db_mockup = DBMockup()
+    consent_names = ["telemarketing", "promotions", "catalogues"]
+    for consent_name in consent_names:
+        db_mockup.add_consent(Consent(consent_name=consent_name, validity=timedelta(hours=1)))
+    usernames = [f"user{i}" for i in range(20)]
+    db_mockup.bulk_write(usernames=usernames)
+    errors = []
+
+    def hammer(seed):
+        rng = random.Random(seed)
+        try:
+            for _ in range(2000):
+                username, consent_name = rng.choice(usernames), rng.choice(consent_names)
+                operation = rng.random()
+                if operation < 0.35:
+                    db_mockup.add_user_consent(username, consent_name)
+                elif operation < 0.7:
+                    try:
+                        db_mockup.revoke_user_consent(username, consent_name)
+                    except KeyError:
+                        pass
+                elif operation < 0.72:
+                    db_mockup.bulk_write(grants=[(username, consent_name, datetime.now())])
+                elif operation < 0.73:
+                    db_mockup.archive_expired_grants(datetime.now() - timedelta(minutes=59))
+                elif operation < 0.85:
+                    db_mockup.lookup_user_consent(username, consent_name)
+                    dict(db_mockup.get_user_consents(username).consents)
+                else:
+                    db_mockup.get_consent_stats(datetime.now(), include_expired=True)
+                    db_mockup.get_consent_users(consent_name, valid_only=True)
+                    for batch in db_mockup.iter_users(since=datetime.now() - timedelta(seconds=1), batch_size=7):
+                        for user in batch:
+                            list(user.consents.items())
+        except Exception as e:
+            errors.append(e)
+
+    switch_interval = sys.getswitchinterval()
+    # Switch threads as often as possible to provoke races
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=hammer, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+    # Every grant of a user is in the index of its consent and nothing else is
+    for consent_name in consent_names:
+        assert db_mockup.consent_grants[consent_name] == sorted(
+            (user.consents[consent_name], username)
+            for username, user in db_mockup.users.items()
+            if consent_name in user.consents
+        )
+
+def test_lookup_user_consents_at(database_mockup_with_data):
+    db_mockup = database_mockup_with_data
+    if not hasattr(db_mockup, "lookup_user_consents_at"):
+        pytest.skip("Adapter keeps no history")
+    before = datetime.now()
+    db_mockup.revoke_user_consent("Wayne", "telemarketing")
+    revoked = datetime.now()
+    db_mockup.add_user_consent("Wayne", "telemarketing")
+    granted_at = db_mockup.get_user_consents("Wayne").consents["telemarketing"]
+    # Imported grants can be older than the rest of the history
+    old = before - timedelta(days=30)
+    db_mockup.bulk_write(grants=[("Linda", "promotions", old)])
+
+    lookups = db_mockup.lookup_user_consents_at(
+        [
+            ("Wayne", "telemarketing", before),
+            ("Wayne", "telemarketing", revoked),
+            ("Wayne", "telemarketing", granted_at),
+            ("Wayne", "promotions", before - timedelta(days=1)),
+            ("Linda", "promotions", old),
+            ("Linda", "promotions", old - timedelta(microseconds=1)),
+            ("Nobody", "telemarketing", before),
+            ("Wayne", "unknown", before),
+        ]
+    )
+    assert lookups[0].granted_at is not None and lookups[0].granted_at <= before
+    assert lookups[1].granted_at is None
+    assert lookups[2].granted_at == granted_at
+    assert lookups[2].validity == timedelta(hours=2)
+    assert lookups[3].granted_at is None
+    assert lookups[4].granted_at == old
+    assert lookups[5].granted_at is None
+    assert not lookups[6].user_exists and lookups[6].granted_at is None
+    assert lookups[7].user_exists and not lookups[7].consent_exists
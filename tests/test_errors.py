@@ -0,0 +1,53 @@
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+from app.errors import add_error_handlers
+from app.models import Consent
+from tests.test_data import anyio_backend, started_app
+
+
+async def get(app, url):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.get(url)
+
+
+@pytest.mark.anyio
+async def test_not_found_status_codes(started_app):
+    response = await get(started_app, "/users/Nobody/consents/telemarketing")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "User not found"}
+    response = await get(started_app, "/users/John/consents/unknown")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Consent not found"}
+    assert "cache-control" not in response.headers
+
+
+@pytest.mark.anyio
+async def test_error_handlers():
+    app = FastAPI()
+    add_error_handlers(app, not_found_max_age=60)
+
+    @app.get("/missing")
+    async def missing():
+        raise HTTPException(status_code=404, detail="User not found")
+
+    @app.get("/invalid")
+    async def invalid():
+        Consent(consent_name="telemarketing", validity="forever")
+
+    @app.get("/structured")
+    async def structured():
+        raise HTTPException(status_code=409, detail={"consent_name": "telemarketing"})
+
+    response = await get(app, "/missing")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "User not found"}
+    assert response.headers["cache-control"] == "public, max-age=60"
+    response = await get(app, "/invalid")
+    assert response.status_code == 400
+    assert response.json()["detail"][0]["loc"] == ["validity"]
+    response = await get(app, "/structured")
+    assert response.status_code == 409
+    assert response.json() == {"detail": {"consent_name": "telemarketing"}}
+    assert "cache-control" not in response.headers
@@ -0,0 +1,48 @@
+import httpx
+import pytest
+from app.logic_handler import LogicHandler, etag_matches
+from tests.test_data import anyio_backend, database_adapter, database_mockup_with_data, started_app
+
+
+def test_etag_matches():
+    assert not etag_matches(None, '"u1"')
+    assert etag_matches('"u1"', '"u1"')
+    assert etag_matches('"c2", W/"u1"', '"u1"')
+    assert etag_matches("*", '"u1"')
+    assert not etag_matches('"u12"', '"u1"')
+
+
+@pytest.mark.anyio
+async def test_logic_handler_etags(database_mockup_with_data):
+    logic_handler = LogicHandler(database_mockup_with_data)
+    etag = await logic_handler.get_user_consents_etag("John")
+    if not hasattr(database_mockup_with_data, "get_user_version"):
+        assert etag is None
+        return
+    assert await logic_handler.get_user_consents_etag("Nobody") is None
+    await logic_handler.add_user_consent("John", "promotions")
+    assert await logic_handler.get_user_consents_etag("John") != etag
+
+
+@pytest.mark.anyio
+async def test_conditional_get(started_app):
+    transport = httpx.ASGITransport(app=started_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        for url in ["/users/Linda/consents/", "/consents/"]:
+            response = await client.get(url)
+            assert response.status_code == 200
+            etag = response.headers["etag"]
+            response = await client.get(url, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.headers["etag"] == etag
+            assert response.content == b""
+
+        etag = (await client.get("/users/Linda/consents/")).headers["etag"]
+        await client.post("/users/Linda/consents/promotions")
+        response = await client.get("/users/Linda/consents/", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert "promotions" in response.json()["consents"]
+        await client.delete("/users/Linda/consents/promotions")
+
+        response = await client.get("/users/Nobody/consents/", headers={"If-None-Match": "*"})
+        assert response.status_code == 404
@@ -0,0 +1,131 @@
+import httpx
+import json
+import pytest
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from app.columnar_store import ColumnarDB
+from app.logic_handler import LogicHandler
+from tests.test_data import anyio_backend, logic_handler_with_data, database_adapter, database_mockup_with_data, started_app
+
+
+async def lines_of(text):
+    for line in text.splitlines():
+        yield line
+
+
+async def audit(logic_handler, text, format="ndjson", chunk_size=10000):
+    output = b""
+    async for chunk in await logic_handler.audit_user_consents(lines_of(text), format, chunk_size):
+        output += chunk
+    return [json.loads(line) for line in output.decode().splitlines()]
+
+
+@pytest.mark.anyio
+async def test_check_user_consent_valid_at(logic_handler_with_data):
+    logic_handler = logic_handler_with_data
+    if not logic_handler.history:
+        pytest.skip("Adapter keeps no history")
+    granted_at = (await logic_handler.get_user_consents("Wayne")).consents["promotions"]
+
+    response = await logic_handler.check_user_consent_valid_at("Wayne", "promotions", granted_at + timedelta(days=1))
+    assert response == {
+        "username": "Wayne",
+        "consent_name": "promotions",
+        "at": granted_at + timedelta(days=1),
+        "valid": True,
+        "reason": "User has given consent",
+    }
+    response = await logic_handler.check_user_consent_valid_at("Wayne", "promotions", granted_at + timedelta(weeks=2))
+    assert response["reason"] == "User consent has expired"
+    response = await logic_handler.check_user_consent_valid_at("Wayne", "promotions", granted_at - timedelta(days=1))
+    assert response["reason"] == "User has not given consent"
+
+    await logic_handler.revoke_user_consent("Wayne", "promotions")
+    response = await logic_handler.check_user_consent_valid_at("Wayne", "promotions", granted_at + timedelta(days=1))
+    assert response["reason"] == "User has not given consent"
+    response = await logic_handler.check_user_consent_valid_at("Wayne", "promotions", granted_at)
+    assert response["valid"] is True
+
+    for username, consent_name, detail in [("Nobody", "promotions", "User not found"), ("Wayne", "unknown", "Consent not found")]:
+        with pytest.raises(HTTPException) as excinfo:
+            await logic_handler.check_user_consent_valid_at(username, consent_name, granted_at)
+        assert excinfo.value.status_code == 404
+        assert excinfo.value.detail == detail
+
+
+@pytest.mark.anyio
+async def test_history_not_kept():
+    logic_handler = LogicHandler(ColumnarDB())
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler.check_user_consent_valid_at("John", "telemarketing", datetime.now())
+    assert excinfo.value.status_code == 501
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler.audit_user_consents(lines_of(""))
+    assert excinfo.value.status_code == 501
+
+
+@pytest.mark.anyio
+async def test_audit_user_consents(logic_handler_with_data):
+    logic_handler = logic_handler_with_data
+    if not logic_handler.history:
+        pytest.skip("Adapter keeps no history")
+    now = datetime.now()
+    earlier = now - timedelta(days=1)
+    ndjson = "\n".join(
+        [
+            f'{{"username": "Wayne", "consent_name": "promotions", "at": "{now.isoformat()}"}}',
+            f'{{"username": "Wayne", "consent_name": "promotions", "at": "{earlier.isoformat()}"}}',
+            "",
+            f'{{"username": "Nobody", "consent_name": "promotions", "at": "{now.isoformat()}"}}',
+            f'{{"username": "Wayne", "consent_name": "unknown", "at": "{now.isoformat()}"}}',
+            '{"username": "Wayne", "consent_name": "promotions", "at": "yesterday"}',
+            '{"username": "Wayne"}',
+        ]
+    )
+    results = await audit(logic_handler, ndjson, chunk_size=2)
+    assert [result["row"] for result in results] == [1, 2, 4, 5, 6, 7]
+    assert results[0] == {
+        "row": 1,
+        "username": "Wayne",
+        "consent_name": "promotions",
+        "at": now.isoformat(),
+        "valid": True,
+        "reason": "User has given consent",
+    }
+    assert results[1]["reason"] == "User has not given consent"
+    assert results[2]["reason"] == "User not found"
+    assert results[3]["reason"] == "Consent not found"
+    assert "error" in results[4] and "error" in results[5]
+
+    csv = f"username,consent_name,at\nWayne,promotions,{now.isoformat()}\nLinda,promotions,{now.isoformat()}\n"
+    results = await audit(logic_handler, csv, format="csv")
+    assert [(result["row"], result["valid"]) for result in results] == [(2, True), (3, False)]
+
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler.audit_user_consents(lines_of(csv), format="xml")
+    assert excinfo.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_history_endpoints(started_app):
+    transport = httpx.ASGITransport(app=started_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        now = datetime.now()
+        response = await client.get("/users/Wayne/consents/promotions", params={"at": now.isoformat()})
+        assert response.status_code == 200
+        assert response.json()["valid"] is True
+        past = (now - timedelta(days=365)).isoformat()
+        response = await client.get("/users/Wayne/consents/promotions", params={"at": past})
+        assert response.json() == {
+            "username": "Wayne",
+            "consent_name": "promotions",
+            "at": past,
+            "valid": False,
+            "reason": "User has not given consent",
+        }
+
+        body = f"username,consent_name,at\nWayne,promotions,{now.isoformat()}\nWayne,promotions,{past}\n"
+        response = await client.post("/audit", params={"format": "csv"}, content=body)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert [json.loads(line)["valid"] for line in response.text.splitlines()] == [True, False]
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from app.database_mockup import DBMockup
+from app.journal import JournaledDBMockup
+from app.models import Consent, User
+
+
+def fill(db):
+    now = datetime.now()
+    db.add_consent(Consent(consent_name="telemarketing", validity=timedelta(hours=2)))
+    db.add_consent(Consent(consent_name="promotions", validity=timedelta(weeks=1)))
+    db.add_user(User(username="John", consents={"telemarketing": now - timedelta(hours=3)}))
+    db.add_user(User(username="Linda", consents={}))
+    db.bulk_write(
+        consents=[Consent(consent_name="sms", validity=timedelta(days=1))],
+        usernames=["Mike"],
+        grants=[("Mike", "promotions", now), ("Mike", "sms", now)],
+    )
+    db.add_user_consent("Linda", "telemarketing")
+    db.add_user_consent("John", "promotions")
+    db.add_user_consent("Mike", "promotions")
+    db.revoke_user_consent("John", "telemarketing")
+
+
+def state(db):
+    return (
+        db.get_consents(),
+        db.get_users(),
+        db.users,
+        db.consent_grants,
+        db.archive,
+        db.archived_consent_names,
+        db.history,
+        db.history_consent_names,
+    )
+
+
+def test_recovery_from_journal(tmp_path):
+    db = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    fill(db)
+    db.close()
+
+    recovered = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    assert state(recovered) == state(db)
+    recovered.close()
+
+
+def test_recovery_from_snapshot_and_journal(tmp_path):
+    db = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    fill(db)
+    db.snapshot()
+    db.add_user(User(username="Wayne", consents={"catalogues": datetime.now()}))
+    db.revoke_user_consent("Mike", "promotions")
+    db.close()
+    assert sorted(os.listdir(tmp_path)) == ["journal.2.log", "snapshot.2.bin"]
+
+    recovered = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    assert state(recovered) == state(db)
+    assert not recovered.consent_exists("catalogues")
+    assert recovered.get_user_consents("Wayne").consents == db.get_user_consents("Wayne").consents
+    recovered.close()
+
+
+def test_recovery_of_archive(tmp_path):
+    db = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    fill(db)
+    now = datetime.now()
+    db.add_user(User(username="Anna", consents={"telemarketing": now - timedelta(hours=4)}))
+    assert db.archive_expired_grants(now) == 1
+    db.snapshot()
+    db.add_user_consent("Anna", "sms")
+    db.bulk_write(grants=[("John", "sms", now - timedelta(days=2))])
+    assert db.archive_expired_grants(now) == 1
+    assert db.archive_expired_grants(now) == 0
+    db.close()
+
+    recovered = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    assert state(recovered) == state(db)
+    assert recovered.get_archived_user_consents("Anna") == [("telemarketing", now - timedelta(hours=4))]
+    recovered.close()
+
+
+def test_recovery_of_restored_history(tmp_path):
+    source = DBMockup()
+    fill(source)
+    now = datetime.now()
+    source.add_user(User(username="Anna", consents={"telemarketing": now - timedelta(hours=4)}))
+    assert source.archive_expired_grants(now) == 1
+    usernames = source.get_users()
+    histories = source.get_user_history_bulk(usernames)
+    assert set(histories) == {"John", "Linda", "Mike", "Anna"}
+
+    db = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    db.bulk_write(consents=list(source.get_consents().values()), usernames=usernames)
+    db.restore_user_history(histories)
+    db.close()
+
+    recovered = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    assert state(recovered) == state(db)
+    assert recovered.get_user_history_bulk(usernames) == histories
+    recovered.close()
+
+
+def test_recovery_ignores_torn_write(tmp_path):
+    db = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    fill(db)
+    db.close()
+    path = tmp_path / "journal.1.log"
+    data = path.read_bytes()
+    path.write_bytes(data + data[:10])
+
+    recovered = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    assert state(recovered) == state(db)
+    # Writing continues in a new journal after the torn one
+    recovered.add_user_consent("Mike", "telemarketing")
+    recovered.close()
+    recovered = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    assert recovered.user_has_consent("Mike", "telemarketing")
+    recovered.close()
+
+
+def test_writes_continue_while_snapshot_is_written(tmp_path, monkeypatch):
+    db = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    fill(db)
+    writing = threading.Event()
+    written = threading.Event()
+    write_snapshot = db._write_snapshot
+
+    def slow_write_snapshot(path, state):
+        writing.set()
+        written.wait(10)
+        write_snapshot(path, state)
+
+    monkeypatch.setattr(db, "_write_snapshot", slow_write_snapshot)
+    snapshotter = threading.Thread(target=db.snapshot)
+    snapshotter.start()
+    assert writing.wait(10)
+    writer = threading.Thread(target=db.add_user_consent, args=("Linda", "sms"))
+    writer.start()
+    writer.join(10)
+    assert not writer.is_alive()
+    written.set()
+    snapshotter.join()
+    db.close()
+
+    recovered = JournaledDBMockup(str(tmp_path), commit_interval=0)
+    assert state(recovered) == state(db)
+    # The grant made while the snapshot was written is in the new journal only
+    assert "sms" in recovered.get_user_consents("Linda").consents
+    recovered.close()
+
+
+def test_failed_snapshots_are_retried(tmp_path, monkeypatch, caplog):
+    failures = []
+
+    def snapshot(self):
+        failures.append(None)
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(JournaledDBMockup, "snapshot", snapshot)
+    db = JournaledDBMockup(str(tmp_path), commit_interval=0, snapshot_interval=0.01)
+    for _ in range(100):
+        if len(failures) > 1:
+            break
+        time.sleep(0.01)
+    db.close()
+    assert len(failures) > 1
+    assert "Writing a snapshot failed" in caplog.text
@@ -1,110 +1,265 @@
+import json
 import pytest
 from fastapi import HTTPException
-from tests.test_data import logic_handler_with_data, database_mockup_with_data
+from tests.test_data import anyio_backend, logic_handler_with_data, database_adapter, database_mockup_with_data
+from app.logic_handler import verdict_at
 from app.models import Consent
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 
-def test_get_all_users(logic_handler_with_data):
-    users = logic_handler_with_data.get_all_users()
+@pytest.mark.anyio
+async def test_get_all_users(logic_handler_with_data):
+    users = await logic_handler_with_data.get_all_users()
     assert "John" in users
     assert "Linda" in users
     assert "Mike" in users
 
-def test_get_all_consents(logic_handler_with_data):
+@pytest.mark.anyio
+async def test_get_all_consents(logic_handler_with_data):
     logic_handler = logic_handler_with_data
-    consents = logic_handler_with_data.get_all_consents()
+    consents = await logic_handler_with_data.get_all_consents()
     assert "telemarketing" in consents
     assert "promotions" in consents
     assert "catalogues" in consents
 
-def test_get_user_consents(logic_handler_with_data):
+@pytest.mark.anyio
+async def test_get_user_consents(logic_handler_with_data):
     logic_handler = logic_handler_with_data
-    user_consents = logic_handler_with_data.get_user_consents("John").consents
+    user_consents = (await logic_handler_with_data.get_user_consents("John")).consents
     assert "telemarketing" in user_consents
     assert "promotions" not in user_consents
 
-def test_check_user_consent_valid(logic_handler_with_data):
+@pytest.mark.anyio
+async def test_check_user_consent_valid(logic_handler_with_data):
     logic_handler = logic_handler_with_data
     # Test for a valid consent
-    response = logic_handler_with_data.check_user_consent_valid("John", "telemarketing")
+    response = await logic_handler_with_data.check_user_consent_valid("John", "telemarketing")
     assert response["valid"] is True
     assert response["reason"] == "User has given consent"
 
     # Test for an expired consent
-    response = logic_handler_with_data.check_user_consent_valid("John", "catalogues")
+    response = await logic_handler_with_data.check_user_consent_valid("John", "catalogues")
     assert response["valid"] is False
     assert response["reason"] == "User consent has expired"
 
     # Test for not given consent
-    response = logic_handler_with_data.check_user_consent_valid("John", "promotions")
+    response = await logic_handler_with_data.check_user_consent_valid("John", "promotions")
     assert response["valid"] is False
     assert response["reason"] == "User has not given consent"
 
 
     # Test for a non-existent user
     with pytest.raises(HTTPException) as excinfo:
-        logic_handler_with_data.check_user_consent_valid("NonexistentUser", "telemarketing")
+        await logic_handler_with_data.check_user_consent_valid("NonexistentUser", "telemarketing")
     assert excinfo.value.status_code == 404
     assert "User not found" in excinfo.value.detail
 
     # Test for a non-existent consent
     with pytest.raises(HTTPException) as excinfo:
-        logic_handler_with_data.check_user_consent_valid("John", "nonexistent_consent")
+        await logic_handler_with_data.check_user_consent_valid("John", "nonexistent_consent")
     assert excinfo.value.status_code == 404
     assert "Consent not found" in excinfo.value.detail
 
 # Additional test cases
-def test_create_consent(logic_handler_with_data):
+@pytest.mark.anyio
+async def test_create_consent(logic_handler_with_data):
     logic_handler = logic_handler_with_data
     # Test creating a new valid consent
     new_consent = Consent(consent_name="test_consent1", validity=timedelta(days=30))
-    response = logic_handler_with_data.create_consent(new_consent)
+    response = await logic_handler_with_data.create_consent(new_consent)
     assert response == new_consent
     assert logic_handler_with_data.database_adapter.consent_exists("test_consent1") is True
 
     # Test creating a consent with an invalid name
     with pytest.raises(HTTPException) as excinfo:
         duplicate_consent = Consent(consent_name="*?!dsa", validity=timedelta(days=30))
-        logic_handler_with_data.create_consent(duplicate_consent)
+        await logic_handler_with_data.create_consent(duplicate_consent)
     assert excinfo.value.status_code == 400
     assert "Invalid consent name" in excinfo.value.detail
 
-def test_add_user_consent(logic_handler_with_data):
+@pytest.mark.anyio
+async def test_add_user_consent(logic_handler_with_data):
     logic_handler = logic_handler_with_data
     # Test adding a valid consent to a user
-    logic_handler_with_data.add_user_consent("Linda", "telemarketing")
+    await logic_handler_with_data.add_user_consent("Linda", "telemarketing")
     assert logic_handler_with_data.database_adapter.user_has_consent("Linda", "telemarketing") is True
 
     # Test adding a consent to a non-existent user
     with pytest.raises(HTTPException) as excinfo:
-        logic_handler_with_data.add_user_consent("NonexistentUser", "telemarketing")
+        await logic_handler_with_data.add_user_consent("NonexistentUser", "telemarketing")
     assert excinfo.value.status_code == 404
     assert "User not found" in excinfo.value.detail
 
     # Test adding a non-existent consent
     with pytest.raises(HTTPException) as excinfo:
-        logic_handler_with_data.add_user_consent("Linda", "nonexistent_consent")
+        await logic_handler_with_data.add_user_consent("Linda", "nonexistent_consent")
     assert excinfo.value.status_code == 404
     assert "Consent not found" in excinfo.value.detail
 
-def test_revoke_user_consent(logic_handler_with_data):
+@pytest.mark.anyio
+async def test_revoke_user_consent(logic_handler_with_data):
     logic_handler = logic_handler_with_data
     # Test revoking a valid consent from a user
-    logic_handler_with_data.revoke_user_consent("John", "telemarketing")
+    await logic_handler_with_data.revoke_user_consent("John", "telemarketing")
     assert logic_handler_with_data.database_adapter.user_has_consent("John", "telemarketing") is False
 
     # Test revoking consent user did not give or was already revoked does not return error
-    logic_handler_with_data.revoke_user_consent("John", "telemarketing")
+    await logic_handler_with_data.revoke_user_consent("John", "telemarketing")
     assert logic_handler_with_data.database_adapter.user_has_consent("John", "telemarketing") is False
 
     # Test revoking a consent from a non-existent user
     with pytest.raises(HTTPException) as excinfo:
-        logic_handler_with_data.revoke_user_consent("NonexistentUser", "telemarketing")
+        await logic_handler_with_data.revoke_user_consent("NonexistentUser", "telemarketing")
     assert excinfo.value.status_code == 404
     assert "User not found" in excinfo.value.detail
 
     # Test revoking a non-existent consent
     with pytest.raises(HTTPException) as excinfo:
-        logic_handler_with_data.revoke_user_consent("John", "nonexistent_consent")
+        await logic_handler_with_data.revoke_user_consent("John", "nonexistent_consent")
     assert excinfo.value.status_code == 404
     assert "Consent not found" in excinfo.value.detail
+
+@pytest.mark.anyio
+async def test_check_user_consents_valid_bulk(logic_handler_with_data):
+    usernames = ["John", "Wayne", "NonexistentUser"]
+    consent_names = ["telemarketing", "catalogues", "promotions", "nonexistent_consent"]
+    results = (await logic_handler_with_data.check_user_consents_valid_bulk(usernames, consent_names))["results"]
+    assert list(results) == usernames
+
+    # Verdicts match the single consent check
+    for username in ["John", "Wayne"]:
+        for consent_name in ["telemarketing", "catalogues", "promotions"]:
+            single = await logic_handler_with_data.check_user_consent_valid(username, consent_name)
+            assert results[username][consent_name]["valid"] is single["valid"]
+            assert results[username][consent_name]["reason"] == single["reason"]
+
+    assert results["John"]["nonexistent_consent"] == {"valid": False, "reason": "Consent not found"}
+    for consent_name in consent_names:
+        assert results["NonexistentUser"][consent_name] == {"valid": False, "reason": "User not found"}
+
+@pytest.mark.anyio
+async def test_validities_expiring_past_datetime_max(logic_handler_with_data):
+    logic_handler = logic_handler_with_data
+    await logic_handler.create_consent(Consent(consent_name="forever", validity=timedelta(days=3000000)))
+    await logic_handler.add_user_consent("John", "forever")
+    assert (await logic_handler.check_user_consent_valid("John", "forever"))["valid"] is True
+    results = (await logic_handler.check_user_consents_valid_bulk(["John"], ["forever"]))["results"]
+    assert results["John"]["forever"] == {"valid": True, "reason": "User has given consent"}
+    lookup = await logic_handler.lookup_user_consent("John", "forever")
+    assert verdict_at(lookup, datetime.now()) == (True, "User has given consent")
+    lines = b"".join([chunk async for chunk in logic_handler.export_user_consents()]).splitlines()
+    john = next(json.loads(line) for line in lines if json.loads(line)["username"] == "John")
+    assert john["consents"]["forever"]["valid"] is True
+    assert john["consents"]["forever"]["expires_on"] == datetime.max.isoformat()
+
+@pytest.mark.anyio
+async def test_get_expiring_user_consents(logic_handler_with_data):
+    now = datetime.now(timezone.utc)
+    response = await logic_handler_with_data.get_expiring_user_consents("telemarketing", now + timedelta(hours=3), after=now)
+    assert response["consent_name"] == "telemarketing"
+    assert [user["username"] for user in response["users"]] == ["John", "Mike", "Wayne"]
+
+    response = await logic_handler_with_data.get_expiring_user_consents("telemarketing", now + timedelta(hours=1))
+    assert response["users"] == []
+
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler_with_data.get_expiring_user_consents("nonexistent_consent", now)
+    assert excinfo.value.status_code == 404
+    assert "Consent not found" in excinfo.value.detail
+
+@pytest.mark.anyio
+async def test_get_consent_users(logic_handler_with_data):
+    response = await logic_handler_with_data.get_consent_users("telemarketing", limit=2)
+    assert [user["username"] for user in response["users"]] == ["John", "Mike"]
+    assert response["next_cursor"] is not None
+
+    response = await logic_handler_with_data.get_consent_users("telemarketing", cursor=response["next_cursor"], limit=2)
+    assert [user["username"] for user in response["users"]] == ["Wayne"]
+    assert response["next_cursor"] is None
+
+    response = await logic_handler_with_data.get_consent_users("catalogues", valid_only=True)
+    assert response["users"] == []
+
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler_with_data.get_consent_users("telemarketing", cursor="not a cursor")
+    assert excinfo.value.status_code == 400
+
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler_with_data.get_consent_users("nonexistent_consent")
+    assert excinfo.value.status_code == 404
+    assert "Consent not found" in excinfo.value.detail
+
+@pytest.mark.anyio
+async def test_get_consent_stats(logic_handler_with_data):
+    response = await logic_handler_with_data.get_consent_stats()
+    assert response["consents"]["telemarketing"] == {"valid": 3, "expired": 0}
+    assert response["consents"]["catalogues"] == {"valid": 0, "expired": 2}
+    assert "expired" not in response
+
+    response = await logic_handler_with_data.get_consent_stats(include_expired=True)
+    assert sorted(grant["username"] for grant in response["expired"]) == ["John", "Linda"]
+
+@pytest.mark.anyio
+async def test_export_user_consents(logic_handler_with_data):
+    chunks = [chunk async for chunk in logic_handler_with_data.export_user_consents()]
+    lines = [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+    users = {line["username"]: line["consents"] for line in lines}
+    assert set(users) == {"John", "Linda", "Mike", "Wayne"}
+    assert users["John"]["telemarketing"]["valid"] is True
+    assert users["John"]["catalogues"]["valid"] is False
+    assert "promotions" not in users["John"]
+
+    since = datetime.now(timezone.utc)
+    await logic_handler_with_data.add_user_consent("Mike", "promotions")
+    chunks = [chunk async for chunk in logic_handler_with_data.export_user_consents(since)]
+    lines = [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+    assert [line["username"] for line in lines] == ["Mike"]
+    assert set(lines[0]["consents"]) == {"telemarketing", "promotions"}
+
+@pytest.mark.anyio
+async def test_archive_expired_grants(logic_handler_with_data):
+    await logic_handler_with_data.create_consent(Consent(consent_name="forever", validity=timedelta(days=1000000)))
+    await logic_handler_with_data.add_user_consent("Linda", "forever")
+    moved = await logic_handler_with_data.archive_expired_grants(timedelta(hours=1))
+    assert moved == 0
+    # A grace reaching back before datetime.min archives nothing
+    assert await logic_handler_with_data.archive_expired_grants(timedelta(days=999999999)) == 0
+    moved = await logic_handler_with_data.archive_expired_grants(timedelta(0))
+    # The bulk check agrees with the single check after the sweep
+    usernames, consent_names = ["John", "Linda", "Mike"], ["catalogues", "telemarketing", "forever"]
+    bulk = await logic_handler_with_data.check_user_consents_valid_bulk(usernames, consent_names)
+    for username in usernames:
+        for consent_name in consent_names:
+            single = await logic_handler_with_data.check_user_consent_valid(username, consent_name)
+            assert bulk["results"][username][consent_name] == {"valid": single["valid"], "reason": single["reason"]}
+    response = await logic_handler_with_data.get_archived_user_consents("John")
+    assert response["username"] == "John"
+    if not logic_handler_with_data.archiving:
+        assert moved == 0
+        assert response["consents"] == []
+        return
+    assert moved == 2
+    [grant] = response["consents"]
+    assert grant["consent_name"] == "catalogues"
+    assert grant["expired_on"] == grant["granted_at"]
+    response = await logic_handler_with_data.check_user_consent_valid("John", "catalogues")
+    assert response["reason"] == "User consent has expired"
+
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler_with_data.get_archived_user_consents("Nobody")
+    assert excinfo.value.status_code == 404
+
+@pytest.mark.anyio
+async def test_concurrent_revoke(logic_handler_with_data):
+    # Another request revokes the consent between the lookup and the revoke
+    lookup = await logic_handler_with_data.lookup_user_consent("John", "telemarketing")
+    await logic_handler_with_data.revoke_user_consent("John", "telemarketing")
+
+    async def stale_lookup(username, consent_name):
+        return lookup
+
+    current_lookup = logic_handler_with_data.lookup_user_consent
+    logic_handler_with_data.lookup_user_consent = stale_lookup
+    await logic_handler_with_data.revoke_user_consent("John", "telemarketing")
+    logic_handler_with_data.lookup_user_consent = current_lookup
+    response = await logic_handler_with_data.check_user_consent_valid("John", "telemarketing")
+    assert response["valid"] is False
@@ -0,0 +1,89 @@
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+from app import main
+from app.logic_handler import LogicHandler
+from app.metrics import Histogram, Metrics, MetricsMiddleware
+from app.verdict_cache import VerdictCache
+from tests.test_data import anyio_backend, database_adapter, database_mockup_with_data, started_app
+
+
+def test_histogram_render():
+    histogram = Histogram()
+    histogram.observe(0.0002)
+    histogram.observe(0.003)
+    histogram.observe(10)
+    lines = histogram.render("latency", [("method", "get")])
+    assert 'latency_bucket{method="get",le="0.0001"} 0' in lines
+    assert 'latency_bucket{method="get",le="0.00025"} 1' in lines
+    assert 'latency_bucket{method="get",le="0.005"} 2' in lines
+    assert 'latency_bucket{method="get",le="+Inf"} 3' in lines
+    assert 'latency_count{method="get"} 3' in lines
+
+
+@pytest.mark.anyio
+async def test_logic_handler_calls_and_errors(database_mockup_with_data):
+    metrics = Metrics()
+    logic_handler = LogicHandler(database_mockup_with_data, metrics=metrics)
+    await logic_handler.check_user_consent_valid("John", "telemarketing")
+    with pytest.raises(HTTPException):
+        await logic_handler.check_user_consent_valid("Nobody", "telemarketing")
+    with pytest.raises(HTTPException):
+        await logic_handler.check_user_consent_valid("John", "unknown")
+    # Details with user input share one reason
+    for expression in ["telemarketing AND", "xyz)", "(abc"]:
+        with pytest.raises(HTTPException):
+            await logic_handler.check_user_policy("John", expression)
+    async for _ in logic_handler.export_user_consents():
+        pass
+
+    assert sum(metrics.logic_calls["check_user_consent_valid"].counts) == 3
+    assert sum(metrics.logic_calls["export_user_consents"].counts) == 1
+    assert sum(metrics.adapter_calls["lookup_user_consent"].counts) == 3
+    assert metrics.logic_errors == {
+        ("check_user_consent_valid", 404, "user_not_found"): 1,
+        ("check_user_consent_valid", 404, "consent_not_found"): 1,
+        ("check_user_policy", 400, "invalid_input"): 3,
+    }
+    text = metrics.render()
+    assert (
+        'consent_api_logic_errors_total{method="check_user_consent_valid",status="404",reason="user_not_found"} 1'
+        in text
+    )
+    assert 'consent_api_adapter_call_duration_seconds_count{method="lookup_user_consent"} 3' in text
+
+
+@pytest.mark.anyio
+async def test_middleware_labels_route_template():
+    metrics = Metrics()
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+    @app.get("/users/{username}")
+    async def get_user(username: str):
+        return {"username": username}
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        await client.get("/users/John")
+        await client.get("/users/Linda")
+        await client.get("/unknown")
+
+    assert sum(metrics.requests["GET", "/users/{username}", 200].counts) == 2
+    assert sum(metrics.requests["GET", "unmatched", 404].counts) == 1
+
+
+@pytest.mark.anyio
+async def test_verdict_cache_counters(started_app, monkeypatch):
+    cache = VerdictCache()
+    monkeypatch.setattr(main, "metrics", Metrics(verdict_cache=cache))
+    monkeypatch.setattr(main, "logicHandler", LogicHandler(main.databse_adapter, verdict_cache=cache))
+    transport = httpx.ASGITransport(app=started_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        await client.get("/users/John/consents/telemarketing")
+        await client.get("/users/John/consents/telemarketing")
+        text = (await client.get("/metrics")).text
+    assert "consent_api_verdict_cache_hits_total 1" in text
+    assert "consent_api_verdict_cache_misses_total 1" in text
+    assert "consent_api_verdict_cache_evictions_total 0" in text
+    assert "consent_api_verdict_cache_size 1" in text
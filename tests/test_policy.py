@@ -0,0 +1,134 @@
+import httpx
+import pytest
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from app.policy import compile_policy
+from tests.test_data import anyio_backend, logic_handler_with_data, database_adapter, database_mockup_with_data, started_app
+
+NOW = datetime(2024, 5, 1, 12, 0)
+VALIDITIES = {name: timedelta(hours=1) for name in ["telemarketing", "promotions", "catalogues", "any"]}
+
+
+def evaluate(expression, consents):
+    policy = compile_policy(expression)
+    return policy.evaluate(consents, policy.cutoffs(VALIDITIES, NOW))
+
+
+def test_policy_expressions():
+    valid = NOW - timedelta(minutes=30)
+    expired = NOW - timedelta(hours=2)
+    consents = {"telemarketing": valid, "promotions": expired}
+    assert evaluate("telemarketing", consents)
+    assert not evaluate("promotions", consents)
+    assert evaluate("EXPIRED promotions", consents)
+    assert not evaluate("expired catalogues", consents)
+    assert not evaluate("telemarketing AND NOT expired promotions", consents)
+    assert evaluate("telemarketing and not expired catalogues", consents)
+    assert evaluate("ANY(catalogues, promotions, telemarketing)", consents)
+    assert not evaluate("ALL(telemarketing, promotions)", consents)
+    assert evaluate("ALL(telemarketing, ANY(catalogues, EXPIRED promotions))", consents)
+    # NOT binds before AND, AND before OR
+    assert evaluate("catalogues AND promotions OR telemarketing", consents)
+    assert not evaluate("catalogues AND (promotions OR telemarketing)", consents)
+    assert not evaluate("NOT telemarketing OR catalogues", consents)
+    # A consent named like a keyword is quoted
+    assert evaluate('NOT "any"', consents)
+    # Grants are valid up to and including the end of their validity
+    assert evaluate("catalogues", {"catalogues": NOW - timedelta(hours=1)})
+
+
+def test_policy_is_compiled_once():
+    policy = compile_policy("ANY(catalogues, promotions)")
+    assert compile_policy("ANY(catalogues, promotions)") is policy
+    assert policy.consent_names == {"catalogues", "promotions"}
+
+
+@pytest.mark.parametrize(
+    "expression",
+    ["", "   ", "telemarketing AND", "(telemarketing", "telemarketing)", "ANY()", "tele-marketing",
+     "NOT", "EXPIRED ANY(promotions)", "telemarketing promotions", "(" * 40 + "sms" + ")" * 40],
+)
+def test_invalid_policies(expression):
+    with pytest.raises(ValueError):
+        compile_policy(expression)
+
+
+@pytest.mark.anyio
+async def test_check_user_policy(logic_handler_with_data):
+    response = await logic_handler_with_data.check_user_policy("John", "telemarketing AND EXPIRED catalogues")
+    assert response == {
+        "username": "John",
+        "policy": "telemarketing AND EXPIRED catalogues",
+        "valid": True,
+        "reason": "Policy is satisfied",
+    }
+    response = await logic_handler_with_data.check_user_policy("Wayne", "ALL(telemarketing, catalogues)")
+    assert response["valid"] is False
+    assert response["reason"] == "Policy is not satisfied"
+
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler_with_data.check_user_policy("Nobody", "telemarketing")
+    assert excinfo.value.status_code == 404
+    assert excinfo.value.detail == "User not found"
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler_with_data.check_user_policy("John", "telemarketing OR nonexistent_consent")
+    assert excinfo.value.status_code == 404
+    assert excinfo.value.detail == "Consent not found"
+    with pytest.raises(HTTPException) as excinfo:
+        await logic_handler_with_data.check_user_policy("John", "telemarketing AND")
+    assert excinfo.value.status_code == 400
+    assert excinfo.value.detail.startswith("Invalid policy")
+
+
+@pytest.mark.anyio
+async def test_policies_count_archived_grants_as_expired(logic_handler_with_data):
+    usernames = ["John", "Linda", "Wayne"]
+    expressions = ["telemarketing AND EXPIRED catalogues", "telemarketing AND NOT EXPIRED catalogues", "catalogues"]
+    before = {}
+    for expression in expressions:
+        before[expression] = (await logic_handler_with_data.check_users_policy_bulk(usernames, expression))["results"]
+    # Archiving the expired catalogues grants does not change any verdict
+    await logic_handler_with_data.archive_expired_grants(timedelta(0))
+    for expression in expressions:
+        response = await logic_handler_with_data.check_users_policy_bulk(usernames, expression)
+        assert response["results"] == before[expression]
+        for username in usernames:
+            single = await logic_handler_with_data.check_user_policy(username, expression)
+            assert single["valid"] == before[expression][username]["valid"]
+    assert before["telemarketing AND EXPIRED catalogues"]["John"]["valid"] is True
+    assert before["telemarketing AND NOT EXPIRED catalogues"]["John"]["valid"] is False
+
+
+@pytest.mark.anyio
+async def test_check_users_policy_bulk(logic_handler_with_data):
+    usernames = ["John", "Wayne", "Linda", "NonexistentUser"]
+    expression = "ANY(promotions, catalogues)"
+    response = await logic_handler_with_data.check_users_policy_bulk(usernames, expression)
+    assert response["policy"] == expression
+    assert list(response["results"]) == usernames
+    # Verdicts match the single user check
+    for username in ["John", "Wayne", "Linda"]:
+        single = await logic_handler_with_data.check_user_policy(username, expression)
+        assert response["results"][username] == {"valid": single["valid"], "reason": single["reason"]}
+    assert response["results"]["Wayne"]["valid"] is True
+    assert response["results"]["NonexistentUser"] == {"valid": False, "reason": "User not found"}
+
+
+@pytest.mark.anyio
+async def test_policy_endpoints(started_app):
+    transport = httpx.ASGITransport(app=started_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/users/Wayne/policy", params={"expr": "ANY(promotions, telemarketing)"})
+        assert response.status_code == 200
+        assert response.json()["valid"] is True
+        response = await client.get("/users/Linda/policy", params={"expr": "promotions"})
+        assert response.json()["valid"] is False
+        response = await client.get("/users/Linda/policy", params={"expr": "promotions AND"})
+        assert response.status_code == 400
+
+        response = await client.post(
+            "/policy/check", json={"usernames": ["Wayne", "Linda", "Nobody"], "policy": "promotions"}
+        )
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [results[username]["valid"] for username in ["Wayne", "Linda", "Nobody"]] == [True, False, False]
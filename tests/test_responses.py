@@ -0,0 +1,30 @@
+import json
+from datetime import datetime, timedelta
+from fastapi.encoders import jsonable_encoder
+from app import responses
+from app.models import Consent, User
+from app.responses import FastJSONResponse
+
+CONTENT = {
+    "users": [User(username="John", consents={"telemarketing": datetime(2024, 5, 1, 12, 30, 0, 250)})],
+    "consents": {"promotions": Consent(consent_name="promotions", validity=timedelta(weeks=1))},
+    "at": datetime(2024, 5, 1),
+    "valid": True,
+    "reason": "Čaj",
+}
+
+
+def expected():
+    return json.dumps(jsonable_encoder(CONTENT), ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def test_fast_json_response():
+    response = FastJSONResponse(CONTENT, headers={"ETag": '"u1"'})
+    assert response.body == expected()
+    assert response.headers["ETag"] == '"u1"'
+    assert response.media_type == "application/json"
+
+
+def test_fast_json_response_without_orjson(monkeypatch):
+    monkeypatch.setattr(responses, "orjson", None)
+    assert FastJSONResponse(CONTENT).body == expected()
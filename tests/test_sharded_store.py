@@ -0,0 +1,145 @@
+import pytest
+import threading
+from datetime import datetime, timedelta
+from app.columnar_store import ColumnarDB
+from app.database_mockup import DBMockup
+from app.models import Consent, User
+from app.sharded_store import ShardedDB, rebalance, shard_of
+from app.store_server import StoreClient, StoreServer
+
+
+def sample_users(n):
+    return [f"user{i}" for i in range(n)]
+
+
+@pytest.fixture
+def servers(tmp_path):
+    servers = [
+        StoreServer(DBMockup(), str(tmp_path / f"store{i}.sock"), authkey=b"test")
+        for i in range(2)
+    ]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield servers
+    for server in servers:
+        server.close()
+
+
+def test_shard_of_is_stable():
+    # The same in every process, so all workers route a user to the same shard
+    assert shard_of("John", 4) == 0
+    assert {shard_of(username, 3) for username in sample_users(100)} == {0, 1, 2}
+
+
+def test_users_live_on_their_shard():
+    shards = [DBMockup() for _ in range(3)]
+    db = ShardedDB(shards)
+    db.add_consent(Consent(consent_name="telemarketing", validity=timedelta(hours=1)))
+    db.bulk_write(usernames=sample_users(30), grants=[("user1", "telemarketing", datetime.now())])
+    for index, shard in enumerate(shards):
+        # The catalogue is on every shard, users only on theirs
+        assert shard.consent_exists("telemarketing")
+        assert all(shard_of(username, 3) == index for username in shard.get_users())
+    assert sorted(db.get_users()) == sorted(sample_users(30))
+    assert db.user_has_valid_consent("user1", "telemarketing")
+    assert shards[shard_of("user1", 3)].user_has_valid_consent("user1", "telemarketing")
+
+
+def test_optional_methods_need_every_shard():
+    assert hasattr(ShardedDB([DBMockup(), DBMockup()]), "get_user_version")
+    assert not hasattr(ShardedDB([DBMockup(), ColumnarDB()]), "get_user_version")
+    assert not hasattr(ShardedDB([DBMockup()]), "missing_method")
+
+
+def test_list_queries_are_merged():
+    db = ShardedDB([DBMockup() for _ in range(3)])
+    db.add_consent(Consent(consent_name="promotions", validity=timedelta(days=1)))
+    start = datetime.now() - timedelta(hours=1)
+    usernames = sample_users(20)
+    db.bulk_write(
+        usernames=usernames,
+        grants=[
+            (username, "promotions", start + timedelta(seconds=i))
+            for i, username in enumerate(usernames)
+        ],
+    )
+    # Ordered by granting time across shards
+    page = db.get_consent_users("promotions", limit=5)
+    assert [username for username, _ in page] == usernames[:5]
+    page = db.get_consent_users("promotions", after=(page[-1][1], page[-1][0]), limit=100)
+    assert [username for username, _ in page] == usernames[5:]
+    expiring = db.get_expiring_user_consents("promotions", datetime.now() + timedelta(days=2))
+    assert [username for username, _ in expiring] == usernames
+    counts, _ = db.get_consent_stats(datetime.now())
+    assert counts["promotions"] == {"valid": 20, "expired": 0}
+
+
+def test_archive_sweeps_shards_up_to_limit():
+    db = ShardedDB([DBMockup() for _ in range(3)])
+    db.add_consent(Consent(consent_name="catalogues", validity=timedelta(seconds=0)))
+    granted_at = datetime.now() - timedelta(hours=1)
+    db.bulk_write(
+        usernames=sample_users(10),
+        grants=[(username, "catalogues", granted_at) for username in sample_users(10)],
+    )
+    assert db.archive_expired_grants(datetime.now(), limit=4) == 4
+    assert db.archive_expired_grants(datetime.now()) == 6
+    assert db.archive_expired_grants(datetime.now()) == 0
+    assert db.get_archived_user_consents("user3") == [("catalogues", granted_at)]
+
+
+def test_rebalance_to_more_shards():
+    source = ShardedDB([DBMockup() for _ in range(2)])
+    source.add_consent(Consent(consent_name="telemarketing", validity=timedelta(hours=1)))
+    source.add_consent(Consent(consent_name="catalogues", validity=timedelta(0)))
+    start = datetime.now() - timedelta(days=1)
+    source.bulk_write(
+        usernames=sample_users(50),
+        grants=[(username, "telemarketing", start) for username in sample_users(25)]
+        + [(username, "catalogues", start) for username in sample_users(10)],
+    )
+    for username in sample_users(5):
+        source.revoke_user_consent(username, "telemarketing")
+        source.add_user_consent(username, "telemarketing")
+    assert source.archive_expired_grants(datetime.now()) == 30
+    target = ShardedDB([DBMockup() for _ in range(3)])
+    assert rebalance(source, target, batch_size=7) == 50
+    assert target.get_consents() == source.get_consents()
+    assert sorted(target.get_users()) == sorted(source.get_users())
+    queries = [
+        (username, consent_name, at)
+        for username in sample_users(50)
+        for consent_name in ["telemarketing", "catalogues"]
+        for at in [start - timedelta(hours=1), start, datetime.now() - timedelta(hours=1), datetime.now()]
+    ]
+    assert target.lookup_user_consents_at(queries) == source.lookup_user_consents_at(queries)
+    for username in sample_users(50):
+        assert target.get_user_consents(username) == source.get_user_consents(username)
+        assert target.get_archived_user_consents(username) == source.get_archived_user_consents(username)
+        assert target.shards[shard_of(username, 3)].user_exists(username)
+    assert target.get_archived_user_consents("user7") == [("telemarketing", start), ("catalogues", start)]
+
+
+def test_rebalance_refuses_to_drop_history():
+    source = ShardedDB([DBMockup() for _ in range(2)])
+    source.bulk_write(usernames=sample_users(5))
+    target = ShardedDB([ColumnarDB() for _ in range(3)])
+    with pytest.raises(ValueError):
+        rebalance(source, target)
+    assert target.get_users() == []
+
+
+def test_store_server_shards(servers):
+    db = ShardedDB(StoreClient(server.address, authkey=b"test") for server in servers)
+    assert db.blocking_io and db.executor is not None
+    db.add_consent(Consent(consent_name="telemarketing", validity=timedelta(hours=1)))
+    db.add_user(User(username="John", consents={}))
+    db.add_user_consent("John", "telemarketing")
+    db.bulk_write(usernames=sample_users(10))
+    assert db.user_has_valid_consent("John", "telemarketing")
+    assert len(db.get_users()) == 11
+    assert set(db.get_user_consents_bulk(["John", "user1", "Nobody"])) == {"John", "user1"}
+    assert set(db.get_user_history_bulk(["John", "user1", "Nobody"])) == {"John"}
+    with pytest.raises(KeyError):
+        db.get_user_consents("Nobody")
+    db.close()
@@ -0,0 +1,136 @@
+import asyncio
+import subprocess
+import sys
+import threading
+import httpx
+import pytest
+from app import main
+from app.database_mockup import DBMockup
+from tests.test_data import anyio_backend
+
+
+@pytest.fixture
+def unstarted_app(monkeypatch):
+    # The application as right after import, before its lifespan loaded the database
+    monkeypatch.setattr(main, "databse_adapter", None)
+    monkeypatch.setattr(main, "logicHandler", main.Starting())
+    monkeypatch.setattr(main, "startup_error", None)
+    return main.create_app()
+
+
+def test_import_loads_no_adapter():
+    code = "import sys, app.main; print(sorted(name for name in sys.modules if name.startswith('app.')))"
+    modules = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    for adapter_module in ["database_mockup", "journal", "sqlite_adapter", "store_server", "sharded_store"]:
+        assert f"app.{adapter_module}" not in modules
+
+
+@pytest.mark.anyio
+async def test_live_before_ready(unstarted_app, monkeypatch):
+    loading = threading.Event()
+    loaded = threading.Event()
+
+    def create_database_adapter():
+        loading.set()
+        loaded.wait(10)
+        return DBMockup(create_sample_data=True)
+
+    monkeypatch.setattr(main, "create_database_adapter", create_database_adapter)
+    transport = httpx.ASGITransport(app=unstarted_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        async with unstarted_app.router.lifespan_context(unstarted_app):
+            await asyncio.to_thread(loading.wait, 10)
+            assert (await client.get("/health")).status_code == 200
+            response = await client.get("/ready")
+            assert response.status_code == 503
+            assert response.headers["retry-after"] == "1"
+            response = await client.get("/users/John/consents/")
+            assert response.status_code == 503
+            assert response.json() == {"detail": "Service is starting"}
+
+            loaded.set()
+            for _ in range(100):
+                if (await client.get("/ready")).status_code == 200:
+                    break
+                await asyncio.sleep(0.01)
+            assert (await client.get("/ready")).status_code == 200
+            assert "telemarketing" in (await client.get("/users/John/consents/")).json()["consents"]
+
+
+@pytest.mark.anyio
+async def test_failed_startup(unstarted_app, monkeypatch):
+    def create_database_adapter():
+        raise OSError("Journal is not readable")
+
+    monkeypatch.setattr(main, "create_database_adapter", create_database_adapter)
+    transport = httpx.ASGITransport(app=unstarted_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        async with unstarted_app.router.lifespan_context(unstarted_app):
+            for _ in range(100):
+                if main.startup_error is not None:
+                    break
+                await asyncio.sleep(0.01)
+            assert (await client.get("/health")).status_code == 500
+            response = await client.get("/ready")
+            assert response.status_code == 503
+            assert response.json() == {"detail": "Startup failed"}
+
+
+class ClosableDB(DBMockup):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.anyio
+async def test_adapter_is_closed_on_shutdown(unstarted_app, monkeypatch):
+    database_adapter = ClosableDB(create_sample_data=True)
+    monkeypatch.setattr(main, "create_database_adapter", lambda: database_adapter)
+    async with unstarted_app.router.lifespan_context(unstarted_app):
+        for _ in range(100):
+            if main.databse_adapter is not None:
+                break
+            await asyncio.sleep(0.01)
+        assert not database_adapter.closed
+    assert database_adapter.closed
+
+
+class FailingOnce:
+    """Logic handler whose first scan for expired grants and first sweep fail"""
+
+    def __init__(self):
+        self.scans = 0
+        self.sweeps = 0
+
+    async def publish_expired_grants(self):
+        self.scans += 1
+        if self.scans == 1:
+            raise OverflowError("date value out of range")
+
+    async def archive_expired_grants(self, grace, limit):
+        self.sweeps += 1
+        if self.sweeps == 1:
+            raise EOFError("Store connection closed")
+        return 0
+
+
+@pytest.mark.anyio
+async def test_background_tasks_survive_errors(monkeypatch, caplog):
+    logic_handler = FailingOnce()
+    monkeypatch.setattr(main, "logicHandler", logic_handler)
+    monkeypatch.setattr(main, "EXPIRY_SCAN_INTERVAL", 0)
+    monkeypatch.setattr(main, "SWEEP_INTERVAL", 0)
+    tasks = [
+        asyncio.create_task(main.publish_expired_grants_periodically()),
+        asyncio.create_task(main.archive_expired_grants_periodically()),
+    ]
+    for _ in range(100):
+        if logic_handler.scans > 1 and logic_handler.sweeps > 1:
+            break
+        await asyncio.sleep(0.01)
+    for task in tasks:
+        task.cancel()
+    assert logic_handler.scans > 1 and logic_handler.sweeps > 1
+    assert "Publishing expired grants failed" in caplog.text
+    assert "Archiving expired grants failed" in caplog.text
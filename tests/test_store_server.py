@@ -0,0 +1,81 @@
+import pytest
+import threading
+from datetime import timedelta
+from app.database_mockup import DBMockup
+from app.models import Consent, User
+from app.store_server import StoreClient, StoreServer, parse_address
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = StoreServer(DBMockup(), str(tmp_path / "store.sock"), authkey=b"test")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.close()
+
+
+def test_parse_address():
+    assert parse_address("127.0.0.1:8765") == ("127.0.0.1", 8765)
+    assert parse_address("/run/consent_api/store.sock") == "/run/consent_api/store.sock"
+
+
+def test_clients_share_data(server):
+    # Clients of different workers see each other's writes
+    first = StoreClient(server.address, authkey=b"test")
+    second = StoreClient(server.address, authkey=b"test")
+    first.add_consent(Consent(consent_name="telemarketing", validity=timedelta(hours=1)))
+    first.add_user(User(username="John", consents={}))
+    second.add_user_consent("John", "telemarketing")
+    assert first.user_has_valid_consent("John", "telemarketing")
+    second.revoke_user_consent("John", "telemarketing")
+    assert not first.user_has_consent("John", "telemarketing")
+    first.close()
+    second.close()
+
+
+def test_errors_are_raised_in_client(server):
+    client = StoreClient(server.address, authkey=b"test")
+    with pytest.raises(KeyError):
+        client.get_user_consents("Nobody")
+    with pytest.raises(AttributeError):
+        client._call("initialize_data")
+    # The connection is still usable after an error
+    assert client.get_users() == []
+    client.close()
+
+
+class UnpicklableError(Exception):
+    def __reduce__(self):
+        raise TypeError("cannot pickle")
+
+
+class FailingDB(DBMockup):
+    def get_users(self):
+        raise UnpicklableError("no users")
+
+
+def test_unpicklable_errors_are_raised_as_runtime_errors(tmp_path):
+    server = StoreServer(FailingDB(), str(tmp_path / "store.sock"), authkey=b"test")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = StoreClient(server.address, authkey=b"test")
+    with pytest.raises(RuntimeError, match="no users"):
+        client.get_users()
+    assert client.user_exists("Nobody") is False
+    client.close()
+    server.close()
+
+
+def test_stopped_iteration_does_not_break_pool(server):
+    client = StoreClient(server.address, authkey=b"test", pool_size=1)
+    client.bulk_write(usernames=[f"user{i}" for i in range(10)])
+    batches = client.iter_users(batch_size=2)
+    assert len(next(batches)) == 2
+    batches.close()
+    assert [len(batch) for batch in client.iter_users(batch_size=4)] == [4, 4, 2]
+    client.close()
+
+
+def test_wrong_authkey_is_rejected(server):
+    client = StoreClient(server.address, authkey=b"wrong")
+    with pytest.raises(Exception):
+        client.get_users()
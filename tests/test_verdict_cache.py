@@ -0,0 +1,79 @@
+import pytest
+from datetime import datetime, timedelta
+from app.logic_handler import LogicHandler
+from app.models import Consent
+from app.verdict_cache import VerdictCache
+from tests.test_data import anyio_backend, database_adapter, database_mockup_with_data
+
+VERDICT = {"username": "John", "consent_name": "telemarketing", "valid": True, "reason": "User has given consent"}
+
+
+def test_get_put():
+    cache = VerdictCache(maxsize=10, ttl=timedelta(seconds=30))
+    now = datetime.now()
+    assert cache.get("John", "telemarketing", now) is None
+    cache.put("John", "telemarketing", VERDICT, now)
+    assert cache.get("John", "telemarketing", now) == VERDICT
+    assert cache.get("John", "telemarketing", now + timedelta(seconds=31)) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_entry_does_not_outlive_grant():
+    cache = VerdictCache(ttl=timedelta(seconds=30))
+    now = datetime.now()
+    cache.put("John", "telemarketing", VERDICT, now, valid_until=now + timedelta(seconds=5))
+    assert cache.get("John", "telemarketing", now + timedelta(seconds=5)) == VERDICT
+    assert cache.get("John", "telemarketing", now + timedelta(seconds=6)) is None
+
+
+def test_eviction():
+    cache = VerdictCache(maxsize=2)
+    now = datetime.now()
+    cache.put("John", "telemarketing", VERDICT, now)
+    cache.put("Mike", "telemarketing", VERDICT, now)
+    cache.get("John", "telemarketing", now)
+    cache.put("Wayne", "telemarketing", VERDICT, now)
+    assert cache.get("Mike", "telemarketing", now) is None
+    assert cache.get("John", "telemarketing", now) == VERDICT
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidation():
+    cache = VerdictCache()
+    now = datetime.now()
+    cache.put("John", "telemarketing", VERDICT, now)
+    cache.put("Mike", "telemarketing", VERDICT, now)
+    cache.invalidate("John", "telemarketing")
+    assert cache.get("John", "telemarketing", now) is None
+    assert cache.get("Mike", "telemarketing", now) == VERDICT
+    cache.invalidate_consent("telemarketing")
+    assert cache.get("Mike", "telemarketing", now) is None
+
+    # Verdicts computed before an invalidation are not stored
+    version = cache.version
+    cache.invalidate("John", "telemarketing")
+    cache.put("John", "telemarketing", VERDICT, now, version=version)
+    assert cache.get("John", "telemarketing", now) is None
+
+
+@pytest.mark.anyio
+async def test_logic_handler_with_cache(database_mockup_with_data):
+    cache = VerdictCache()
+    logic_handler = LogicHandler(database_mockup_with_data, verdict_cache=cache)
+    response = await logic_handler.check_user_consent_valid("John", "telemarketing")
+    assert response["valid"] is True
+    assert await logic_handler.check_user_consent_valid("John", "telemarketing") == response
+    assert cache.hits == 1
+
+    await logic_handler.revoke_user_consent("John", "telemarketing")
+    response = await logic_handler.check_user_consent_valid("John", "telemarketing")
+    assert response["reason"] == "User has not given consent"
+
+    await logic_handler.add_user_consent("John", "telemarketing")
+    response = await logic_handler.check_user_consent_valid("John", "telemarketing")
+    assert response["valid"] is True
+
+    await logic_handler.create_consent(Consent(consent_name="telemarketing", validity=timedelta(0)))
+    response = await logic_handler.check_user_consent_valid("John", "telemarketing")
+    assert response["reason"] == "User consent has expired"